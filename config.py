@@ -19,6 +19,8 @@ config_data = load_config()
 TELEGRAM_BOT_TOKEN = config_data['bot']['token']
 BOT_USERNAME = config_data['bot']['username']
 ADMIN_USER_IDS = config_data['bot']['admin_user_ids']
+TELEGRAM_SENDER_POOL_SIZE = config_data['bot']['sender']['connection_pool_size']
+TELEGRAM_SENDER_TIMEOUT = config_data['bot']['sender']['send_timeout']
 
 # 数据库配置
 DB_HOST = config_data['database']['host']
@@ -26,14 +28,49 @@ DB_PORT = config_data['database']['port']
 DB_USER = config_data['database']['user']
 DB_PASSWORD = config_data['database']['password']
 DB_NAME = config_data['database']['name']
+DB_USER_PAGE_SIZE = config_data['database']['user_page_size']
+DB_AUDIENCE_CHUNK_SIZE = config_data['database']['audience_chunk_size']
+SCHEMA_CHECK_MIN_ROWS = config_data['database']['schema_check_min_rows']
+SCHEMA_CHECK_ON_MIGRATE = config_data['database']['schema_check_on_migrate']
+
+# 数据库连接池配置
+DB_POOL_MIN_SIZE = config_data['database']['pool']['min_size']
+DB_POOL_MAX_SIZE = config_data['database']['pool']['max_size']
+DB_POOL_IDLE_TIMEOUT = config_data['database']['pool']['idle_timeout']
+DB_POOL_WAIT_TIMEOUT = config_data['database']['pool']['wait_timeout']
+DB_POOL_PING_INTERVAL = config_data['database']['pool']['ping_interval']
+
+# 只读副本配置
+DB_REPLICAS = config_data['database']['replicas']['hosts'] or []
+DB_REPLICA_MAX_LAG = config_data['database']['replicas']['max_lag_seconds']
+DB_REPLICA_CHECK_INTERVAL = config_data['database']['replicas']['check_interval']
+DB_REPLICA_READ_AFTER_WRITE = config_data['database']['replicas']['read_after_write_seconds']
+
+# 异步数据库配置
+DB_ASYNC_BACKEND = config_data['database']['async']['backend']
+DB_ASYNC_SQLITE_PATH = config_data['database']['async']['sqlite_path']
+
+# 缓存配置
+USER_CACHE_MAX_SIZE = config_data['cache']['user']['max_size']
+USER_CACHE_TTL = config_data['cache']['user']['ttl_seconds']
+UNREAD_CACHE_MAX_SIZE = config_data['cache']['unread']['max_size']
+UNREAD_CACHE_TTL = config_data['cache']['unread']['ttl_seconds']
+VIP_INDEX_REFRESH_INTERVAL = config_data['cache']['vip_index']['refresh_interval']
 
 # 支付配置
 CRYPTO_PAYMENT_ENABLED = config_data['payment']['crypto_enabled']
 THIRD_PARTY_PAYMENT_ENABLED = config_data['payment']['third_party_enabled']
 CARD_PAYMENT_ENABLED = config_data['payment']['card_enabled']
 
+# 卡密配置
+CARD_KEY_LENGTH = config_data['card_key']['length']
+CARD_KEY_MINT_CHUNK_SIZE = config_data['card_key']['mint_chunk_size']
+CARD_KEY_MINT_MAX_RETRIES = config_data['card_key']['mint_max_retries']
+
 # 订阅配置
 SUBSCRIPTION_PLANS = config_data['subscription']['plans']
+SUBSCRIPTION_REMINDER_DAYS = config_data['subscription']['reminder_days']
+SUBSCRIPTION_SWEEP_PAGE_SIZE = config_data['subscription']['sweep_page_size']
 
 # 通知配置
 EMAIL_NOTIFICATIONS_ENABLED = config_data['email']['notifications_enabled']
@@ -42,11 +79,52 @@ SMTP_SERVER = config_data['email']['smtp']['server']
 SMTP_PORT = config_data['email']['smtp']['port']
 SMTP_USER = config_data['email']['smtp']['username']
 SMTP_PASSWORD = config_data['email']['smtp']['password']
+SMTP_STARTTLS = config_data['email']['smtp']['starttls']
+SMTP_TIMEOUT = config_data['email']['smtp']['timeout']
+SMTP_POOL_SIZE = config_data['email']['smtp']['pool']['size']
+SMTP_POOL_IDLE_TIMEOUT = config_data['email']['smtp']['pool']['idle_timeout']
+SMTP_POOL_WAIT_TIMEOUT = config_data['email']['smtp']['pool']['wait_timeout']
+SMTP_POOL_PING_INTERVAL = config_data['email']['smtp']['pool']['ping_interval']
+SMTP_MAX_MESSAGES_PER_CONNECTION = config_data['email']['smtp']['max_messages_per_connection']
+
+# 通知发送配置
+NOTIFICATION_EMAIL_CONCURRENCY = config_data['notifications']['email_concurrency']
+NOTIFICATION_TELEGRAM_CONCURRENCY = config_data['notifications']['telegram_concurrency']
+NOTIFICATION_TELEGRAM_RATE = config_data['notifications']['telegram_rate_per_second']
+NOTIFICATION_TELEGRAM_BURST = config_data['notifications']['telegram_burst']
+NOTIFICATION_TELEGRAM_CHAT_INTERVAL = config_data['notifications']['telegram_per_chat_interval']
+NOTIFICATION_MAX_RETRIES = config_data['notifications']['max_retries']
+NOTIFICATION_CLAIM_BATCH_SIZE = config_data['notifications']['claim_batch_size']
+NOTIFICATION_LEASE_SECONDS = config_data['notifications']['lease_seconds']
+NOTIFICATION_POLL_INTERVAL = config_data['notifications']['poll_interval']
+NOTIFICATION_RETRY_BASE_DELAY = config_data['notifications']['retry_base_delay']
+NOTIFICATION_RETRY_MAX_DELAY = config_data['notifications']['retry_max_delay']
+NOTIFICATION_MAX_ATTEMPTS = config_data['notifications']['max_attempts']
+NOTIFICATION_COALESCE_WINDOW = config_data['notifications']['coalesce_window']
+NOTIFICATION_DIGEST_MAX_SIZE = config_data['notifications']['digest_max_size']
+OUTBOX_ENABLED = config_data['notifications']['outbox']['enabled']
+OUTBOX_PATH = os.path.join(os.path.dirname(__file__), config_data['notifications']['outbox']['path'])
+OUTBOX_SEGMENT_MAX_BYTES = config_data['notifications']['outbox']['segment_max_bytes']
+OUTBOX_FSYNC_INTERVAL = config_data['notifications']['outbox']['fsync_interval']
+OUTBOX_REPLAY_INTERVAL = config_data['notifications']['outbox']['replay_interval']
+OUTBOX_REPLAY_BATCH_SIZE = config_data['notifications']['outbox']['replay_batch_size']
+
+# 消息群发配置
+BROADCAST_CONCURRENCY = config_data['broadcast']['concurrency']
+BROADCAST_PAGE_SIZE = config_data['broadcast']['page_size']
+
+# 消息已读回执配置
+READ_RECEIPT_BATCH_SIZE = config_data['read_receipts']['batch_size']
+READ_RECEIPT_FLUSH_INTERVAL = config_data['read_receipts']['flush_interval']
 
 # 消息配置
 WELCOME_MESSAGE = config_data['messages']['welcome']
 HELP_MESSAGE = config_data['messages']['help']
 
+# 通知模板配置
+NOTIFICATION_DEFAULT_LOCALE = config_data['notification_templates']['default_locale']
+NOTIFICATION_TEMPLATES = config_data['notification_templates']['templates']
+
 # 系统配置
 LOG_LEVEL = config_data['system']['log_level']
 TIMEZONE = config_data['system']['timezone']
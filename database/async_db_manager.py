@@ -0,0 +1,821 @@
+# 异步数据库管理器
+
+import asyncio
+import datetime
+import decimal
+import json
+import re
+import sqlite3
+from contextlib import asynccontextmanager
+
+from config import (
+    DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, DB_USER_PAGE_SIZE, DB_AUDIENCE_CHUNK_SIZE,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_IDLE_TIMEOUT,
+    DB_ASYNC_BACKEND, DB_ASYNC_SQLITE_PATH
+)
+from database.db_manager import generate_card_keys
+from database.models import init_database
+
+
+class AsyncResult:
+    """
+    异步查询结果
+    """
+
+    def __init__(self, rows, lastrowid=None, rowcount=-1):
+        self.rows = rows
+        self.lastrowid = lastrowid
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+# ===== MySQL后端（aiomysql） =====
+
+class AiomysqlSession:
+    """
+    aiomysql连接上的会话
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def execute(self, query, params=None):
+        async with self._conn.cursor() as cursor:
+            await cursor.execute(query, params or ())
+            rows = list(await cursor.fetchall()) if cursor.description else []
+            return AsyncResult(rows, cursor.lastrowid, cursor.rowcount)
+
+    async def executemany(self, query, seq_of_params):
+        async with self._conn.cursor() as cursor:
+            await cursor.executemany(query, seq_of_params)
+            return AsyncResult([], cursor.lastrowid, cursor.rowcount)
+
+
+class AiomysqlBackend:
+    """
+    基于aiomysql连接池的MySQL后端
+    """
+
+    def __init__(self, host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD, db=DB_NAME,
+                 minsize=DB_POOL_MIN_SIZE, maxsize=DB_POOL_MAX_SIZE, pool_recycle=DB_POOL_IDLE_TIMEOUT):
+        self._options = {
+            'host': host,
+            'port': port,
+            'user': user,
+            'password': password,
+            'db': db,
+            'minsize': minsize,
+            'maxsize': maxsize,
+            'pool_recycle': pool_recycle,
+        }
+        self._pool = None
+        self._open_lock = None
+
+    async def open(self):
+        """
+        创建aiomysql连接池
+        """
+        if self._pool is not None:
+            return
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+        async with self._open_lock:
+            if self._pool is None:
+                import aiomysql
+                self._pool = await aiomysql.create_pool(
+                    charset='utf8mb4',
+                    autocommit=False,
+                    cursorclass=aiomysql.DictCursor,
+                    **self._options
+                )
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    @asynccontextmanager
+    async def transaction(self):
+        await self.open()
+        async with self._pool.acquire() as conn:
+            try:
+                yield AiomysqlSession(conn)
+                await conn.commit()
+            except BaseException:
+                await conn.rollback()
+                raise
+
+    async def init_schema(self):
+        # 建表语句与同步版本共用，只在启动时执行一次
+        await asyncio.to_thread(init_database)
+
+
+# ===== SQLite后端（进程内替身，用于离线测试） =====
+
+# MySQL语法到SQLite语法的改写规则
+_SQLITE_REWRITES = [
+    (re.compile(r'\bINSERT\s+IGNORE\b', re.IGNORECASE), 'INSERT OR IGNORE'),
+    (re.compile(r'\bNOW\(\)', re.IGNORECASE), 'CURRENT_TIMESTAMP'),
+    (re.compile(r'\bJSON_MERGE_PATCH\(', re.IGNORECASE), 'json_patch('),
+    (re.compile(r'\s+FOR\s+(UPDATE|SHARE)(\s+SKIP\s+LOCKED)?', re.IGNORECASE), ''),
+    # INSERT ... SELECT必须带WHERE子句，否则SQLite无法区分ON CONFLICT和联表的ON
+    (re.compile(r'\bON\s+DUPLICATE\s+KEY\s+UPDATE\b', re.IGNORECASE), 'ON CONFLICT DO UPDATE SET'),
+]
+
+# SQLite表结构与MySQL（database.models.init_database + database.migrations）保持一致，
+# 修改MySQL表结构时同步修改这里（test/test_async_db_manager.py会检查列是否一致）
+
+SQLITE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE NOT NULL,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        email TEXT,
+        is_vip BOOLEAN DEFAULT FALSE,
+        subscription_end_date DATETIME,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        plan_type TEXT NOT NULL,
+        start_date DATETIME NOT NULL,
+        end_date DATETIME NOT NULL,
+        is_active BOOLEAN DEFAULT TRUE,
+        auto_renew BOOLEAN DEFAULT FALSE,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        subscription_id INTEGER REFERENCES subscriptions(id) ON DELETE SET NULL,
+        payment_type TEXT NOT NULL,
+        amount NUMERIC NOT NULL,
+        currency TEXT DEFAULT 'CNY',
+        status TEXT DEFAULT 'pending',
+        transaction_id TEXT,
+        payment_data TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS card_keys (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        card_key TEXT UNIQUE NOT NULL,
+        plan_type TEXT NOT NULL,
+        is_used BOOLEAN DEFAULT FALSE,
+        used_by INTEGER REFERENCES users(id) ON DELETE SET NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        used_at DATETIME
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        is_vip_only BOOLEAN DEFAULT TRUE,
+        created_by INTEGER REFERENCES users(id) ON DELETE SET NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS message_deliveries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id INTEGER NOT NULL REFERENCES messages(id) ON DELETE CASCADE,
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        is_read BOOLEAN DEFAULT FALSE,
+        delivered_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        read_at DATETIME,
+        UNIQUE (message_id, user_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        type TEXT NOT NULL,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        is_sent BOOLEAN DEFAULT FALSE,
+        is_email BOOLEAN DEFAULT FALSE,
+        is_telegram BOOLEAN DEFAULT TRUE,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        sent_at DATETIME,
+        claimed_by TEXT,
+        lease_until DATETIME,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_error TEXT,
+        is_dead BOOLEAN NOT NULL DEFAULT FALSE,
+        dedupe_key TEXT UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS subscription_reminders (
+        subscription_id INTEGER NOT NULL REFERENCES subscriptions(id) ON DELETE CASCADE,
+        tier INTEGER NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (subscription_id, tier)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS job_watermarks (
+        job_name TEXT PRIMARY KEY,
+        watermark DATETIME,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS broadcast_checkpoints (
+        message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'completed', 'failed')),
+        last_error TEXT,
+        run_started_at DATETIME,
+        run_processed INTEGER NOT NULL DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        finished_at DATETIME
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_unread_counters (
+        user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+        unread INTEGER NOT NULL DEFAULT 0,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+]
+
+
+def _to_sqlite_query(query):
+    for pattern, replacement in _SQLITE_REWRITES:
+        query = pattern.sub(replacement, query)
+    return query.replace('%s', '?')
+
+
+def _to_sqlite_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+
+def _to_sqlite_params(params):
+    return tuple(_to_sqlite_value(v) for v in (params or ()))
+
+
+def _dict_row_factory(cursor, row):
+    return {column[0]: row[index] for index, column in enumerate(cursor.description)}
+
+
+class SQLiteSession:
+    """
+    SQLite连接上的会话，执行前把MySQL语法改写为SQLite语法
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def execute(self, query, params=None):
+        cursor = self._conn.execute(_to_sqlite_query(query), _to_sqlite_params(params))
+        rows = cursor.fetchall() if cursor.description else []
+        return AsyncResult(rows, cursor.lastrowid, cursor.rowcount)
+
+    async def executemany(self, query, seq_of_params):
+        cursor = self._conn.executemany(
+            _to_sqlite_query(query), [_to_sqlite_params(p) for p in seq_of_params]
+        )
+        return AsyncResult([], cursor.lastrowid, cursor.rowcount)
+
+
+class SQLiteBackend:
+    """
+    进程内SQLite后端
+    作为MySQL的离线替身，所有事务在同一个连接上串行执行
+    """
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._conn = None
+        self._lock = None
+
+    async def open(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._conn.row_factory = _dict_row_factory
+            self._conn.execute("PRAGMA foreign_keys = ON")
+            self._lock = asyncio.Lock()
+
+    async def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @asynccontextmanager
+    async def transaction(self):
+        await self.open()
+        async with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield SQLiteSession(self._conn)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def init_schema(self):
+        async with self.transaction() as session:
+            for statement in SQLITE_SCHEMA:
+                await session.execute(statement)
+
+
+# ===== 后端管理 =====
+
+_backend = None
+
+
+def create_async_backend(name=DB_ASYNC_BACKEND):
+    """
+    根据名称创建异步后端（mysql 或 sqlite）
+    """
+    if name == 'mysql':
+        return AiomysqlBackend()
+    if name == 'sqlite':
+        return SQLiteBackend(DB_ASYNC_SQLITE_PATH)
+    raise ValueError(f"未知的异步数据库后端: {name}")
+
+
+def get_async_backend():
+    """
+    获取当前异步后端（首次调用时按配置创建）
+    """
+    global _backend
+    if _backend is None:
+        _backend = create_async_backend()
+    return _backend
+
+
+def set_async_backend(backend):
+    """
+    替换当前异步后端（如测试时换成SQLiteBackend）
+    """
+    global _backend
+    _backend = backend
+
+
+@asynccontextmanager
+async def async_transaction(conn=None):
+    """
+    异步事务上下文，语义与database.models.transaction一致：
+    传入conn时复用外部事务，否则新开事务并在结束时提交
+    """
+    if conn is not None:
+        yield conn
+        return
+    async with get_async_backend().transaction() as session:
+        yield session
+
+
+class AsyncDatabaseManager:
+    """
+    异步数据库管理器，方法与DatabaseManager一致，所有查询均可await
+    """
+
+    @staticmethod
+    async def initialize_database():
+        """
+        初始化数据库表结构
+        """
+        try:
+            await get_async_backend().init_schema()
+            return True
+        except Exception as e:
+            print(f"初始化数据库失败: {e}")
+            return False
+
+    @staticmethod
+    async def execute_query(query, params=None, fetch_one=False, conn=None):
+        """
+        执行SQL查询
+        """
+        is_select = query.strip().upper().startswith('SELECT')
+        try:
+            async with async_transaction(conn) as conn:
+                result = await conn.execute(query, params)
+                if is_select:
+                    if fetch_one:
+                        return result.fetchone()
+                    return result.fetchall()
+                return result.lastrowid if result.lastrowid else True
+        except Exception as e:
+            print(f"执行查询失败: {e}")
+            raise e
+
+    @staticmethod
+    async def get_all_users(is_vip=None, conn=None):
+        """
+        获取所有用户，可选择只获取VIP用户
+        """
+        query = "SELECT * FROM users"
+        params = []
+
+        if is_vip is not None:
+            query += " WHERE is_vip = %s"
+            params.append(is_vip)
+
+        return await AsyncDatabaseManager.execute_query(query, params, conn=conn)
+
+    @staticmethod
+    async def iter_user_pages(is_vip=None, page_size=DB_USER_PAGE_SIZE, columns='*', conn=None):
+        """
+        按id顺序分页遍历用户（键集分页），每次产出一页用户列表
+        """
+        last_id = 0
+        while True:
+            query = f"SELECT {columns} FROM users WHERE id > %s"
+            params = [last_id]
+
+            if is_vip is not None:
+                query += " AND is_vip = %s"
+                params.append(is_vip)
+
+            query += " ORDER BY id LIMIT %s"
+            params.append(page_size)
+
+            users = await AsyncDatabaseManager.execute_query(query, params, conn=conn)
+            if not users:
+                return
+
+            yield users
+
+            if len(users) < page_size:
+                return
+            last_id = users[-1]['id']
+
+    @staticmethod
+    async def iter_users(is_vip=None, page_size=DB_USER_PAGE_SIZE, conn=None):
+        """
+        逐个遍历用户，可选择只遍历VIP用户
+        """
+        async for users in AsyncDatabaseManager.iter_user_pages(is_vip, page_size, conn=conn):
+            for user in users:
+                yield user
+
+    @staticmethod
+    async def iter_user_ids(is_vip=None, page_size=DB_USER_PAGE_SIZE, conn=None):
+        """
+        分页遍历用户ID，每次产出一页ID列表
+        """
+        async for users in AsyncDatabaseManager.iter_user_pages(is_vip, page_size, columns='id', conn=conn):
+            yield [user['id'] for user in users]
+
+    @staticmethod
+    async def get_user_by_id(user_id, conn=None):
+        """
+        通过ID获取用户
+        """
+        query = "SELECT * FROM users WHERE id = %s"
+        return await AsyncDatabaseManager.execute_query(query, (user_id,), fetch_one=True, conn=conn)
+
+    @staticmethod
+    async def get_user_by_telegram_id(telegram_id, conn=None):
+        """
+        通过Telegram ID获取用户
+        """
+        query = "SELECT * FROM users WHERE telegram_id = %s"
+        return await AsyncDatabaseManager.execute_query(query, (telegram_id,), fetch_one=True, conn=conn)
+
+    @staticmethod
+    async def create_card_key(plan_type, count=1, conn=None):
+        """
+        生成卡密（一条多行INSERT写入，再按卡密查回ID）
+        """
+        try:
+            card_keys = generate_card_keys(count)
+            async with async_transaction(conn) as conn:
+                await conn.executemany(
+                    "INSERT INTO card_keys (card_key, plan_type) VALUES (%s, %s)",
+                    [(card_key, plan_type) for card_key in card_keys]
+                )
+                result = await conn.execute(
+                    f"""SELECT id, card_key FROM card_keys
+                    WHERE card_key IN ({', '.join(['%s'] * len(card_keys))})""",
+                    card_keys
+                )
+                ids = {row['card_key']: row['id'] for row in result.fetchall()}
+            return [
+                {'id': ids[card_key], 'card_key': card_key, 'plan_type': plan_type}
+                for card_key in card_keys
+            ]
+        except Exception as e:
+            print(f"创建卡密失败: {e}")
+            raise e
+
+    @staticmethod
+    async def use_card_key(card_key, user_id, conn=None):
+        """
+        使用卡密
+        """
+        try:
+            async with async_transaction(conn) as conn:
+                # 检查卡密是否存在且未使用
+                result = await conn.execute(
+                    "SELECT * FROM card_keys WHERE card_key = %s AND is_used = FALSE FOR UPDATE",
+                    (card_key,)
+                )
+                card = result.fetchone()
+
+                if not card:
+                    return None
+
+                # 标记卡密为已使用
+                await conn.execute(
+                    """UPDATE card_keys
+                    SET is_used = TRUE, used_by = %s, used_at = NOW()
+                    WHERE id = %s""",
+                    (user_id, card['id'])
+                )
+                return card
+        except Exception as e:
+            print(f"使用卡密失败: {e}")
+            raise e
+
+    @staticmethod
+    async def create_payment(user_id, payment_type, amount, currency='CNY', subscription_id=None, payment_data=None,
+                             conn=None):
+        """
+        创建支付记录
+        """
+        try:
+            async with async_transaction(conn) as conn:
+                result = await conn.execute(
+                    """INSERT INTO payments
+                    (user_id, subscription_id, payment_type, amount, currency, payment_data)
+                    VALUES (%s, %s, %s, %s, %s, %s)""",
+                    (user_id, subscription_id, payment_type, amount, currency,
+                     json.dumps(payment_data) if payment_data else None)
+                )
+                return result.lastrowid
+        except Exception as e:
+            print(f"创建支付记录失败: {e}")
+            raise e
+
+    @staticmethod
+    async def update_payment_status(payment_id, status, transaction_id=None, payment_data=None, conn=None):
+        """
+        更新支付状态
+        """
+        try:
+            async with async_transaction(conn) as conn:
+                update_fields = ["status = %s"]
+                params = [status]
+
+                if transaction_id:
+                    update_fields.append("transaction_id = %s")
+                    params.append(transaction_id)
+
+                if payment_data:
+                    update_fields.append("payment_data = JSON_MERGE_PATCH(IFNULL(payment_data, '{}'), %s)")
+                    params.append(json.dumps(payment_data))
+
+                params.append(payment_id)
+
+                query = f"""UPDATE payments
+                SET {', '.join(update_fields)}
+                WHERE id = %s"""
+
+                await conn.execute(query, params)
+                return True
+        except Exception as e:
+            print(f"更新支付状态失败: {e}")
+            raise e
+
+    @staticmethod
+    async def create_message(title, content, is_vip_only=True, created_by=None, conn=None):
+        """
+        创建消息
+        """
+        try:
+            async with async_transaction(conn) as conn:
+                result = await conn.execute(
+                    """INSERT INTO messages
+                    (title, content, is_vip_only, created_by)
+                    VALUES (%s, %s, %s, %s)""",
+                    (title, content, is_vip_only, created_by)
+                )
+                return result.lastrowid
+        except Exception as e:
+            print(f"创建消息失败: {e}")
+            raise e
+
+    @staticmethod
+    async def send_message_to_users(message_id, user_ids=None, conn=None):
+        """
+        发送消息给用户
+        如果user_ids为None，则发送给所有用户
+
+        返回:
+            新写入的发送记录数量，消息不存在时返回False
+        """
+        chunks = await AsyncDatabaseManager.materialize_audience(message_id, user_ids, conn=conn)
+        if chunks is None:
+            return False
+        return sum(chunk['count'] for chunk in chunks)
+
+    @staticmethod
+    async def materialize_audience(message_id, user_ids=None, chunk_size=DB_AUDIENCE_CHUNK_SIZE, conn=None):
+        """
+        为消息写入发送记录并增加未读数，按块执行（与DatabaseManager.materialize_audience一致）
+
+        返回:
+            [{'first_id', 'last_id', 'count'}] 每块的用户ID范围（含两端）和新写入的记录数，
+            消息不存在时返回None
+        """
+        try:
+            message = await AsyncDatabaseManager.execute_query(
+                "SELECT is_vip_only FROM messages WHERE id = %s", (message_id,), fetch_one=True, conn=conn
+            )
+            if not message:
+                return None
+
+            # 如果是VIP专属消息，只发送给VIP用户
+            vip_filter = " AND is_vip = TRUE" if message['is_vip_only'] else ""
+
+            chunks = []
+            if user_ids is None:
+                after_id = 0
+                while True:
+                    async with async_transaction(conn) as session:
+                        await AsyncDatabaseManager._lock_message(session, message_id)
+                        result = await session.execute(
+                            f"""SELECT MIN(id) AS first_id, MAX(id) AS last_id, COUNT(*) AS users
+                            FROM (
+                                SELECT id FROM users WHERE id > %s{vip_filter} ORDER BY id LIMIT %s
+                            ) AS chunk""",
+                            (after_id, chunk_size)
+                        )
+                        bounds = result.fetchone()
+                        if not bounds['users']:
+                            return chunks
+                        first_id, last_id = bounds['first_id'], bounds['last_id']
+
+                        max_id = await AsyncDatabaseManager._max_delivery_id(session, message_id, first_id, last_id)
+                        result = await session.execute(
+                            f"""INSERT IGNORE INTO message_deliveries (message_id, user_id)
+                            SELECT %s, id FROM users WHERE id BETWEEN %s AND %s{vip_filter}""",
+                            (message_id, first_id, last_id)
+                        )
+                        await AsyncDatabaseManager._increment_unread_counters(
+                            session, message_id, max_id, first_id, last_id, result.rowcount
+                        )
+                        chunks.append({'first_id': first_id, 'last_id': last_id, 'count': result.rowcount})
+                    if bounds['users'] < chunk_size:
+                        return chunks
+                    after_id = last_id
+            else:
+                user_ids = sorted(set(user_ids))
+                for start in range(0, len(user_ids), chunk_size):
+                    page = user_ids[start:start + chunk_size]
+                    async with async_transaction(conn) as session:
+                        await AsyncDatabaseManager._lock_message(session, message_id)
+                        max_id = await AsyncDatabaseManager._max_delivery_id(session, message_id, page[0], page[-1])
+                        result = await session.executemany(
+                            """INSERT IGNORE INTO message_deliveries
+                            (message_id, user_id) VALUES (%s, %s)""",
+                            [(message_id, user_id) for user_id in page]
+                        )
+                        await AsyncDatabaseManager._increment_unread_counters(
+                            session, message_id, max_id, page[0], page[-1], result.rowcount
+                        )
+                        chunks.append({'first_id': page[0], 'last_id': page[-1], 'count': result.rowcount})
+            return chunks
+        except Exception as e:
+            print(f"写入消息发送记录失败: {e}")
+            raise e
+
+    @staticmethod
+    async def _lock_message(session, message_id):
+        """
+        锁定消息行（见DatabaseManager._lock_message）
+        """
+        await session.execute("SELECT id FROM messages WHERE id = %s FOR UPDATE", (message_id,))
+
+    @staticmethod
+    async def _max_delivery_id(session, message_id, first_id, last_id):
+        """
+        加锁读取范围内已有发送记录的最大ID（见DatabaseManager._max_delivery_id）
+        """
+        result = await session.execute(
+            """SELECT COALESCE(MAX(id), 0) AS max_id FROM message_deliveries
+            WHERE message_id = %s AND user_id BETWEEN %s AND %s FOR SHARE""",
+            (message_id, first_id, last_id)
+        )
+        return result.fetchone()['max_id']
+
+    @staticmethod
+    async def _increment_unread_counters(session, message_id, max_id, first_id, last_id, inserted):
+        """
+        为本事务刚写入的发送记录的用户的未读数加1（见DatabaseManager._increment_unread_counters）
+        """
+        if not inserted:
+            return
+        await session.execute(
+            """INSERT INTO user_unread_counters (user_id, unread)
+            SELECT user_id, 1 FROM message_deliveries
+            WHERE message_id = %s AND user_id BETWEEN %s AND %s AND id > %s
+            ON DUPLICATE KEY UPDATE unread = unread + 1""",
+            (message_id, first_id, last_id, max_id)
+        )
+
+    @staticmethod
+    async def get_unread_count(user_id, conn=None):
+        """
+        获取用户的未读消息数（读取user_unread_counters的一行），没有计数行的用户未读数为0
+        """
+        row = await AsyncDatabaseManager.execute_query(
+            "SELECT unread FROM user_unread_counters WHERE user_id = %s", (user_id,), fetch_one=True, conn=conn
+        )
+        return row['unread'] if row else 0
+
+    @staticmethod
+    async def create_notification(user_id, notification_type, title, content, is_email=False, is_telegram=True,
+                                  dedupe_key=None, conn=None):
+        """
+        创建通知
+        """
+        try:
+            async with async_transaction(conn) as conn:
+                result = await conn.execute(
+                    """INSERT INTO notifications
+                    (user_id, type, title, content, is_email, is_telegram, dedupe_key)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                    (user_id, notification_type, title, content, is_email, is_telegram, dedupe_key)
+                )
+                return result.lastrowid
+        except Exception as e:
+            print(f"创建通知失败: {e}")
+            raise e
+
+    @staticmethod
+    async def mark_notification_sent(notification_id, conn=None):
+        """
+        标记通知为已发送
+        """
+        try:
+            async with async_transaction(conn) as conn:
+                await conn.execute(
+                    """UPDATE notifications
+                    SET is_sent = TRUE, sent_at = NOW()
+                    WHERE id = %s""",
+                    (notification_id,)
+                )
+                return True
+        except Exception as e:
+            print(f"标记通知失败: {e}")
+            raise e
+
+    @staticmethod
+    async def get_pending_notifications(is_email=None, is_telegram=None, conn=None):
+        """
+        获取待发送的通知（联表带上接收人的email和telegram_id）
+        不包括死信和未到重试时间的通知
+        """
+        query = """SELECT n.*, u.email, u.telegram_id
+        FROM notifications n
+        JOIN users u ON u.id = n.user_id
+        WHERE n.is_sent = FALSE AND n.is_dead = FALSE AND n.next_attempt_at <= NOW()"""
+        params = []
+
+        if is_email is not None:
+            query += " AND n.is_email = %s"
+            params.append(is_email)
+
+        if is_telegram is not None:
+            query += " AND n.is_telegram = %s"
+            params.append(is_telegram)
+
+        return await AsyncDatabaseManager.execute_query(query, params, conn=conn)
@@ -0,0 +1,205 @@
+# 进程内缓存
+
+import collections
+import threading
+import time
+
+from config import USER_CACHE_MAX_SIZE, USER_CACHE_TTL, UNREAD_CACHE_MAX_SIZE, UNREAD_CACHE_TTL
+
+# 缓存未命中标记
+MISSING = object()
+
+
+class LRUCache:
+    """
+    线程安全的LRU + TTL缓存
+
+    读穿透时先用generation()取得当前代数，查询数据库后把代数传给set()；
+    查询期间该条目被失效过时set()不写入，避免把失效前读到的旧数据写回缓存。
+
+    参数:
+        max_size: 最大条目数，超出时淘汰最久未使用的条目
+        ttl: 条目有效秒数，为0时不过期
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()  # key -> (过期时间, 值)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._generation = 0
+        self._invalidations = collections.OrderedDict()  # key -> 最近一次失效时的代数
+        self._forgotten = 0  # 已从_invalidations中清理的最大代数
+
+    def get(self, key, default=MISSING):
+        """
+        读取缓存，未命中或已过期时返回default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._misses += 1
+                return default
+
+            expires_at, value = entry
+            if expires_at and expires_at <= time.monotonic():
+                del self._data[key]
+                self._removed(key, value)
+                self._misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def generation(self):
+        """
+        获取当前代数，在读取数据库之前调用，并传给set()
+        """
+        with self._lock:
+            return self._generation
+
+    def set(self, key, value, generation=None):
+        """
+        写入缓存
+        传入generation时，如果该条目在这一代之后被失效过则不写入，返回是否写入
+        """
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0
+        with self._lock:
+            if generation is not None and self._is_stale(key, value, generation):
+                return False
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._removed(key, old[1])
+            self._data[key] = (expires_at, value)
+            self._added(key, value)
+            while len(self._data) > self.max_size:
+                evicted_key, (_, evicted_value) = self._data.popitem(last=False)
+                self._removed(evicted_key, evicted_value)
+                self._evictions += 1
+            return True
+
+    def invalidate(self, key):
+        """
+        删除缓存条目
+        """
+        with self._lock:
+            self._record_invalidation(key)
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._removed(key, entry[1])
+
+    def clear(self):
+        with self._lock:
+            # 正在进行的读穿透全部作废
+            self._generation += 1
+            self._forgotten = self._generation
+            self._invalidations.clear()
+            for key, (_, value) in self._data.items():
+                self._removed(key, value)
+            self._data.clear()
+
+    def stats(self):
+        """
+        获取命中统计
+        """
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': self._hits / total if total else 0.0,
+            }
+
+    def _record_invalidation(self, key):
+        """
+        记录key在新的一代被失效（持有锁时调用）
+        失效记录最多保留max_size条，更早的记录被清理后，早于它们的代数一律视为过期
+        """
+        self._generation += 1
+        self._invalidations[key] = self._generation
+        self._invalidations.move_to_end(key)
+        while len(self._invalidations) > self.max_size:
+            _, forgotten = self._invalidations.popitem(last=False)
+            self._forgotten = max(self._forgotten, forgotten)
+
+    def _is_stale(self, key, value, generation):
+        """
+        generation这一代读到的value是否已被之后的失效作废（持有锁时调用）
+        """
+        return generation < self._forgotten or self._invalidations.get(key, 0) > generation
+
+    def _added(self, key, value):
+        """
+        条目写入后的钩子（持有锁时调用）
+        """
+
+    def _removed(self, key, value):
+        """
+        条目被删除、淘汰或过期后的钩子（持有锁时调用）
+        """
+
+
+class UserCache(LRUCache):
+    """
+    以telegram_id为键的用户缓存，同时记录用户ID到telegram_id的映射，
+    以便只知道用户ID的写操作（如更新VIP状态）也能失效对应条目
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        super().__init__(max_size, ttl)
+        self._telegram_ids = {}
+
+    def invalidate_user_id(self, user_id):
+        """
+        通过用户ID失效缓存
+        条目不在缓存中时也记录失效，使正在读取该用户的读穿透不写入旧数据
+        """
+        with self._lock:
+            self._record_invalidation(('user_id', user_id))
+            telegram_id = self._telegram_ids.get(user_id)
+        if telegram_id is not None:
+            self.invalidate(telegram_id)
+
+    def _is_stale(self, key, value, generation):
+        return (super()._is_stale(key, value, generation)
+                or self._invalidations.get(('user_id', value['id']), 0) > generation)
+
+    def _added(self, key, value):
+        self._telegram_ids[value['id']] = key
+
+    def _removed(self, key, value):
+        if self._telegram_ids.get(value['id']) == key:
+            del self._telegram_ids[value['id']]
+
+
+class UnreadCounterCache(LRUCache):
+    """
+    以用户ID为键的未读消息数缓存
+    消息群发按用户ID范围写入发送记录，可以按范围失效
+    """
+
+    def invalidate_range(self, first_id, last_id):
+        """
+        失效用户ID在 [first_id, last_id] 范围内的条目
+        范围内的用户不逐个记录，正在进行的读穿透全部作废
+        """
+        with self._lock:
+            self._generation += 1
+            self._forgotten = self._generation
+            for user_id in [key for key in self._data if first_id <= key <= last_id]:
+                _, value = self._data.pop(user_id)
+                self._removed(user_id, value)
+
+
+# 全局用户缓存
+user_cache = UserCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL)
+
+# 全局未读消息数缓存
+unread_cache = UnreadCounterCache(UNREAD_CACHE_MAX_SIZE, UNREAD_CACHE_TTL)
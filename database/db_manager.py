@@ -1,11 +1,51 @@
 # 数据库管理器
 
+import csv
 import json
+import os
+import string
 
-from database.models import get_db_connection, init_database
+import pymysql
+
+from config import DB_USER_PAGE_SIZE, DB_AUDIENCE_CHUNK_SIZE, CARD_KEY_LENGTH, CARD_KEY_MINT_CHUNK_SIZE, CARD_KEY_MINT_MAX_RETRIES
+from database.cache import unread_cache
+from database.models import init_database, transaction, read_transaction, on_commit, User
+from database.rows import RowCursor
 
 from Crypto.Random import get_random_bytes
-import base64
+
+# 卡密字符集（字母和数字）
+CARD_KEY_ALPHABET = (string.ascii_letters + string.digits).encode('ascii')
+
+# 随机字节到卡密字符的映射表：只接受小于_CARD_KEY_LIMIT的字节（拒绝采样，避免取模偏差）
+_CARD_KEY_LIMIT = 256 - 256 % len(CARD_KEY_ALPHABET)
+_CARD_KEY_TABLE = bytes(CARD_KEY_ALPHABET[b % len(CARD_KEY_ALPHABET)] for b in range(256))
+_CARD_KEY_REJECTED = bytes(range(_CARD_KEY_LIMIT, 256))
+
+
+def generate_card_keys(count, length=CARD_KEY_LENGTH):
+    """
+    批量生成不重复的随机卡密（只包含字母和数字）
+    一次取足整批的随机字节，用bytes.translate整体映射成字符后再切分
+    """
+    keys = set()
+    while len(keys) < count:
+        needed = (count - len(keys)) * length
+        # 约3%的字节会被拒绝，多取一些避免再次循环
+        random_bytes = get_random_bytes(needed + needed // 16 + length)
+        chars = random_bytes.translate(_CARD_KEY_TABLE, _CARD_KEY_REJECTED).decode('ascii')
+        for start in range(0, len(chars) - length + 1, length):
+            keys.add(chars[start:start + length])
+            if len(keys) == count:
+                break
+    return list(keys)
+
+
+def generate_card_key():
+    """
+    生成一个随机卡密（只包含字母和数字）
+    """
+    return generate_card_keys(1)[0]
 
 
 class DatabaseManager:
@@ -26,31 +66,30 @@ class DatabaseManager:
             return False
 
     @staticmethod
-    def execute_query(query, params=None, fetch_one=False):
+    def execute_query(query, params=None, fetch_one=False, conn=None, as_dict=False):
         """
         执行SQL查询
+        传入conn时在调用方的事务中执行，由调用方负责提交；
+        否则SELECT路由到只读副本（不可用时回退主库），其他语句在主库执行
+        SELECT返回Row对象（支持row['列名']访问），as_dict=True时返回dict
         """
-        conn = get_db_connection()
+        is_select = query.strip().upper().startswith('SELECT')
+        context = read_transaction if is_select else transaction
+        cursor_class = pymysql.cursors.DictCursor if as_dict or not is_select else RowCursor
         try:
-            with conn.cursor() as cursor:
+            with context(conn) as conn, conn.cursor(cursor_class) as cursor:
                 cursor.execute(query, params or ())
-                if query.strip().upper().startswith('SELECT'):
+                if is_select:
                     if fetch_one:
                         return cursor.fetchone()
                     return cursor.fetchall()
-                else:
-                    conn.commit()
-                    return cursor.lastrowid if cursor.lastrowid else True
+                return cursor.lastrowid if cursor.lastrowid else True
         except Exception as e:
-            if not query.strip().upper().startswith('SELECT'):
-                conn.rollback()
             print(f"执行查询失败: {e}")
             raise e
-        finally:
-            conn.close()
 
     @staticmethod
-    def get_all_users(is_vip=None):
+    def get_all_users(is_vip=None, conn=None, as_dict=False):
         """
         获取所有用户，可选择只获取VIP用户
         """
@@ -61,39 +100,76 @@ class DatabaseManager:
             query += " WHERE is_vip = %s"
             params.append(is_vip)
 
-        return DatabaseManager.execute_query(query, params)
+        return DatabaseManager.execute_query(query, params, conn=conn, as_dict=as_dict)
 
     @staticmethod
-    def get_user_by_id(user_id):
+    def iter_user_pages(is_vip=None, page_size=DB_USER_PAGE_SIZE, columns='*', conn=None, as_dict=False):
+        """
+        按id顺序分页遍历用户（键集分页），每次产出一页用户列表
+        每页都通过主键范围定位，内存占用只与page_size有关，与用户总数无关
+        """
+        last_id = 0
+        while True:
+            query = f"SELECT {columns} FROM users WHERE id > %s"
+            params = [last_id]
+
+            if is_vip is not None:
+                query += " AND is_vip = %s"
+                params.append(is_vip)
+
+            query += " ORDER BY id LIMIT %s"
+            params.append(page_size)
+
+            users = DatabaseManager.execute_query(query, params, conn=conn, as_dict=as_dict)
+            if not users:
+                return
+
+            yield users
+
+            if len(users) < page_size:
+                return
+            last_id = users[-1]['id']
+
+    @staticmethod
+    def iter_users(is_vip=None, page_size=DB_USER_PAGE_SIZE, conn=None):
+        """
+        逐个遍历用户，可选择只遍历VIP用户
+        """
+        for users in DatabaseManager.iter_user_pages(is_vip, page_size, conn=conn):
+            yield from users
+
+    @staticmethod
+    def iter_user_ids(is_vip=None, page_size=DB_USER_PAGE_SIZE, conn=None):
+        """
+        分页遍历用户ID，每次产出一页ID列表（用于消息群发等批量目标）
+        """
+        for users in DatabaseManager.iter_user_pages(is_vip, page_size, columns='id', conn=conn):
+            yield [user['id'] for user in users]
+
+    @staticmethod
+    def get_user_by_id(user_id, conn=None):
         """
         通过ID获取用户
         """
         query = "SELECT * FROM users WHERE id = %s"
-        return DatabaseManager.execute_query(query, (user_id,), fetch_one=True)
+        return DatabaseManager.execute_query(query, (user_id,), fetch_one=True, conn=conn)
 
     @staticmethod
-    def get_user_by_telegram_id(telegram_id):
+    def get_user_by_telegram_id(telegram_id, conn=None):
         """
-        通过Telegram ID获取用户
+        通过Telegram ID获取用户（经过用户缓存）
         """
-        query = "SELECT * FROM users WHERE telegram_id = %s"
-        return DatabaseManager.execute_query(query, (telegram_id,), fetch_one=True)
+        return User.get_by_telegram_id(telegram_id, conn=conn)
 
     @staticmethod
-    def create_card_key(plan_type, count=1):
+    def create_card_key(plan_type, count=1, conn=None):
         """
         生成卡密
         """
-        conn = get_db_connection()
         try:
             created_keys = []
-            with conn.cursor() as cursor:
-                for _ in range(count):
-                    # 生成随机卡密
-                    random_bytes = get_random_bytes(16)
-                    card_key = base64.b64encode(random_bytes).decode('utf-8')[:20]
-                    card_key = ''.join(c for c in card_key if c.isalnum())  # 确保只包含字母和数字
-
+            with transaction(conn) as conn, conn.cursor() as cursor:
+                for card_key in generate_card_keys(count):
                     # 插入数据库
                     cursor.execute(
                         "INSERT INTO card_keys (card_key, plan_type) VALUES (%s, %s)",
@@ -104,26 +180,113 @@ class DatabaseManager:
                         'card_key': card_key,
                         'plan_type': plan_type
                     })
-            conn.commit()
             return created_keys
         except Exception as e:
-            conn.rollback()
             print(f"创建卡密失败: {e}")
             raise e
-        finally:
-            conn.close()
 
     @staticmethod
-    def use_card_key(card_key, user_id):
+    def mint_card_keys(plan_type, count, export_path, export_format=None, chunk_size=CARD_KEY_MINT_CHUNK_SIZE):
+        """
+        批量生成卡密并流式导出到文件（用于一次生成大量卡密）
+
+        卡密按chunk_size分块生成，每块先查出与库中已有卡密冲突的部分并只重新生成这些卡密，
+        再用多行INSERT写入并单独提交；每块提交后立即追加到导出文件，不在内存中保留全部结果。
+
+        参数:
+            plan_type: 订阅计划类型
+            count: 生成数量
+            export_path: 导出文件路径
+            export_format: 'csv' 或 'jsonl'，为None时按文件扩展名判断
+            chunk_size: 每块的卡密数量
+
+        返回:
+            {'count': 生成数量, 'chunks': 块数, 'collisions': 重新生成的卡密数, 'path': 导出文件路径}
+        """
+        if export_format is None:
+            export_format = 'jsonl' if os.path.splitext(export_path)[1].lower() == '.jsonl' else 'csv'
+        if export_format not in ('csv', 'jsonl'):
+            raise ValueError(f"不支持的导出格式: {export_format}")
+
+        minted = 0
+        chunks = 0
+        collisions = 0
+        try:
+            with open(export_path, 'w', encoding='utf-8', newline='') as export_file:
+                writer = None
+                if export_format == 'csv':
+                    writer = csv.writer(export_file)
+                    writer.writerow(['card_key', 'plan_type'])
+
+                while minted < count:
+                    size = min(chunk_size, count - minted)
+                    card_keys, replaced = DatabaseManager._insert_card_key_chunk(plan_type, size)
+
+                    for card_key in card_keys:
+                        if writer:
+                            writer.writerow([card_key, plan_type])
+                        else:
+                            export_file.write(json.dumps({'card_key': card_key, 'plan_type': plan_type}) + '\n')
+                    export_file.flush()
+
+                    minted += size
+                    chunks += 1
+                    collisions += replaced
+
+            return {'count': minted, 'chunks': chunks, 'collisions': collisions, 'path': export_path}
+        except Exception as e:
+            print(f"批量生成卡密失败（已生成{minted}个）: {e}")
+            raise e
+
+    @staticmethod
+    def _insert_card_key_chunk(plan_type, size):
+        """
+        生成并写入一块卡密，返回 (卡密列表, 因冲突重新生成的数量)
+        """
+        for _ in range(CARD_KEY_MINT_MAX_RETRIES):
+            card_keys = generate_card_keys(size)
+            replaced = 0
+            try:
+                with transaction() as conn, conn.cursor() as cursor:
+                    # 只替换与库中已有卡密冲突的部分
+                    while True:
+                        placeholders = ', '.join(['%s'] * len(card_keys))
+                        cursor.execute(
+                            f"SELECT card_key FROM card_keys WHERE card_key IN ({placeholders})",
+                            card_keys
+                        )
+                        existing = {row['card_key'] for row in cursor.fetchall()}
+                        if not existing:
+                            break
+
+                        kept = set(card_keys) - existing
+                        while len(kept) < size:
+                            kept.update(generate_card_keys(size - len(kept)))
+                        card_keys = list(kept)
+                        replaced += len(existing)
+
+                    # pymysql会把executemany的INSERT改写为多行INSERT
+                    cursor.executemany(
+                        "INSERT INTO card_keys (card_key, plan_type) VALUES (%s, %s)",
+                        [(card_key, plan_type) for card_key in card_keys]
+                    )
+                return card_keys, replaced
+            except pymysql.err.IntegrityError:
+                # 检查后被并发写入了相同卡密，整块回滚后重试
+                continue
+
+        raise RuntimeError(f"卡密写入连续{CARD_KEY_MINT_MAX_RETRIES}次发生冲突")
+
+    @staticmethod
+    def use_card_key(card_key, user_id, conn=None):
         """
         使用卡密
         """
-        conn = get_db_connection()
         try:
-            with conn.cursor() as cursor:
+            with transaction(conn) as conn, conn.cursor() as cursor:
                 # 检查卡密是否存在且未使用
                 cursor.execute(
-                    "SELECT * FROM card_keys WHERE card_key = %s AND is_used = FALSE",
+                    "SELECT * FROM card_keys WHERE card_key = %s AND is_used = FALSE FOR UPDATE",
                     (card_key,)
                 )
                 card = cursor.fetchone()
@@ -139,23 +302,18 @@ class DatabaseManager:
                     (user_id, card['id'])
                 )
 
-                conn.commit()
                 return card
         except Exception as e:
-            conn.rollback()
             print(f"使用卡密失败: {e}")
             raise e
-        finally:
-            conn.close()
 
     @staticmethod
-    def create_payment(user_id, payment_type, amount, currency='CNY', subscription_id=None, payment_data=None):
+    def create_payment(user_id, payment_type, amount, currency='CNY', subscription_id=None, payment_data=None, conn=None):
         """
         创建支付记录
         """
-        conn = get_db_connection()
         try:
-            with conn.cursor() as cursor:
+            with transaction(conn) as conn, conn.cursor() as cursor:
                 cursor.execute(
                     """INSERT INTO payments 
                     (user_id, subscription_id, payment_type, amount, currency, payment_data) 
@@ -164,23 +322,18 @@ class DatabaseManager:
                      json.dumps(payment_data) if payment_data else None)
                 )
                 payment_id = cursor.lastrowid
-                conn.commit()
                 return payment_id
         except Exception as e:
-            conn.rollback()
             print(f"创建支付记录失败: {e}")
             raise e
-        finally:
-            conn.close()
 
     @staticmethod
-    def update_payment_status(payment_id, status, transaction_id=None, payment_data=None):
+    def update_payment_status(payment_id, status, transaction_id=None, payment_data=None, conn=None):
         """
         更新支付状态
         """
-        conn = get_db_connection()
         try:
-            with conn.cursor() as cursor:
+            with transaction(conn) as conn, conn.cursor() as cursor:
                 update_fields = ["status = %s"]
                 params = [status]
 
@@ -199,23 +352,18 @@ class DatabaseManager:
                 WHERE id = %s"""
 
                 cursor.execute(query, params)
-                conn.commit()
                 return True
         except Exception as e:
-            conn.rollback()
             print(f"更新支付状态失败: {e}")
             raise e
-        finally:
-            conn.close()
 
     @staticmethod
-    def create_message(title, content, is_vip_only=True, created_by=None):
+    def create_message(title, content, is_vip_only=True, created_by=None, conn=None):
         """
         创建消息
         """
-        conn = get_db_connection()
         try:
-            with conn.cursor() as cursor:
+            with transaction(conn) as conn, conn.cursor() as cursor:
                 cursor.execute(
                     """INSERT INTO messages 
                     (title, content, is_vip_only, created_by) 
@@ -223,127 +371,658 @@ class DatabaseManager:
                     (title, content, is_vip_only, created_by)
                 )
                 message_id = cursor.lastrowid
-                conn.commit()
                 return message_id
         except Exception as e:
-            conn.rollback()
             print(f"创建消息失败: {e}")
             raise e
-        finally:
-            conn.close()
 
     @staticmethod
-    def send_message_to_users(message_id, user_ids=None):
+    def send_message_to_users(message_id, user_ids=None, conn=None):
         """
         发送消息给用户
         如果user_ids为None，则发送给所有用户
+
+        返回:
+            新写入的发送记录数量，消息不存在时返回False
+        """
+        chunks = DatabaseManager.materialize_audience(message_id, user_ids, conn=conn)
+        if chunks is None:
+            return False
+        return sum(chunk['count'] for chunk in chunks)
+
+    @staticmethod
+    def materialize_audience(message_id, user_ids=None, chunk_size=DB_AUDIENCE_CHUNK_SIZE, conn=None):
+        """
+        为消息写入发送记录（message_deliveries），按块执行并返回每块的数量
+
+        user_ids为None时按消息的is_vip_only选择接收用户，按users.id键集分块：每块先在MySQL中
+        取接收用户中id大于上一块的前chunk_size个的ID范围，再执行INSERT IGNORE ... SELECT，
+        用户ID不经过客户端，VIP用户稀疏时每块也是满的；
+        传入user_ids时先排序去重，再按chunk_size分块多行INSERT。
+        不传conn时每块单独提交，锁只持有一块的时间；中断后重新执行时已写入的记录被忽略。
+
+        返回:
+            [{'first_id', 'last_id', 'count'}] 每块的用户ID范围（含两端）和新写入的记录数，
+            消息不存在时返回None
+        """
+        try:
+            with transaction(conn) as tx, tx.cursor() as cursor:
+                cursor.execute("SELECT is_vip_only FROM messages WHERE id = %s", (message_id,))
+                message = cursor.fetchone()
+                if not message:
+                    return None
+
+            # 如果是VIP专属消息，只发送给VIP用户
+            vip_filter = " AND is_vip = TRUE" if message['is_vip_only'] else ""
+
+            chunks = []
+            if user_ids is None:
+                after_id = 0
+                while True:
+                    with transaction(conn) as tx, tx.cursor() as cursor:
+                        # 先锁定消息行，再读取本块的范围和已有的发送记录
+                        DatabaseManager._lock_message(cursor, message_id)
+                        # 本块的ID范围：接收用户中id大于上一块的前chunk_size个（走主键顺序读取）
+                        cursor.execute(
+                            f"""SELECT MIN(id) AS first_id, MAX(id) AS last_id, COUNT(*) AS users
+                            FROM (
+                                SELECT id FROM users WHERE id > %s{vip_filter} ORDER BY id LIMIT %s
+                            ) AS chunk""",
+                            (after_id, chunk_size)
+                        )
+                        bounds = cursor.fetchone()
+                        if not bounds['users']:
+                            return chunks
+                        first_id, last_id = bounds['first_id'], bounds['last_id']
+
+                        max_id = DatabaseManager._max_delivery_id(cursor, message_id, first_id, last_id)
+                        cursor.execute(
+                            f"""INSERT IGNORE INTO message_deliveries (message_id, user_id)
+                            SELECT %s, id FROM users WHERE id BETWEEN %s AND %s{vip_filter}""",
+                            (message_id, first_id, last_id)
+                        )
+                        count = cursor.rowcount
+                        DatabaseManager._increment_unread_counters(
+                            cursor, message_id, max_id, first_id, last_id, count
+                        )
+                        chunks.append({'first_id': first_id, 'last_id': last_id, 'count': count})
+                        on_commit(tx, lambda first=first_id, last=last_id: unread_cache.invalidate_range(first, last))
+                    if bounds['users'] < chunk_size:
+                        return chunks
+                    after_id = last_id
+            else:
+                # 排序去重：每块的ID范围有意义，重复的ID也不会让一块变小
+                user_ids = sorted(set(user_ids))
+                for start in range(0, len(user_ids), chunk_size):
+                    page = user_ids[start:start + chunk_size]
+                    with transaction(conn) as tx, tx.cursor() as cursor:
+                        DatabaseManager._lock_message(cursor, message_id)
+                        max_id = DatabaseManager._max_delivery_id(cursor, message_id, page[0], page[-1])
+                        # pymysql会把executemany的INSERT改写为多行INSERT
+                        cursor.executemany(
+                            """INSERT IGNORE INTO message_deliveries
+                            (message_id, user_id) VALUES (%s, %s)""",
+                            [(message_id, user_id) for user_id in page]
+                        )
+                        count = cursor.rowcount
+                        DatabaseManager._increment_unread_counters(
+                            cursor, message_id, max_id, page[0], page[-1], count
+                        )
+                        on_commit(tx, lambda page=page: [unread_cache.invalidate(user_id) for user_id in page])
+                        chunks.append({'first_id': page[0], 'last_id': page[-1], 'count': count})
+            return chunks
+        except Exception as e:
+            print(f"写入消息发送记录失败: {e}")
+            raise e
+
+    @staticmethod
+    def _lock_message(cursor, message_id):
+        """
+        锁定消息行，同一条消息的发送记录写入互斥（直到事务提交）
+        """
+        cursor.execute("SELECT id FROM messages WHERE id = %s FOR UPDATE", (message_id,))
+
+    @staticmethod
+    def _max_delivery_id(cursor, message_id, first_id, last_id):
+        """
+        读取消息在用户ID范围 [first_id, last_id] 内已有发送记录的最大ID（没有时为0）
+        需要在_lock_message之后、写入发送记录之前调用，之后本事务在该范围写入的发送记录ID都大于返回值
+
+        用加锁读取：读到的是最新提交的数据，不受事务快照影响
+        （否则等待消息锁期间其他事务提交的发送记录会被当作本事务写入的而重复计数）；
+        锁住的是本事务接下来要写入的索引范围，不影响其他消息和其他范围的写入
+        """
+        cursor.execute(
+            """SELECT COALESCE(MAX(id), 0) AS max_id FROM message_deliveries
+            WHERE message_id = %s AND user_id BETWEEN %s AND %s FOR SHARE""",
+            (message_id, first_id, last_id)
+        )
+        return cursor.fetchone()['max_id']
+
+    @staticmethod
+    def _increment_unread_counters(cursor, message_id, max_id, first_id, last_id, inserted):
+        """
+        为本事务刚写入的发送记录（ID大于max_id，用户ID在 [first_id, last_id] 范围内）的用户的未读数加1
+
+        计数以实际写入的行为准：INSERT IGNORE忽略的已有记录不会计数，
+        同一消息的写入由_lock_message串行化，并发写入同一批用户时也不会重复计数。
+
+        参数:
+            inserted: INSERT IGNORE实际写入的行数，为0时不需要更新计数
+        """
+        if not inserted:
+            return
+        cursor.execute(
+            """INSERT INTO user_unread_counters (user_id, unread)
+            SELECT user_id, 1 FROM message_deliveries
+            WHERE message_id = %s AND user_id BETWEEN %s AND %s AND id > %s
+            ON DUPLICATE KEY UPDATE unread = unread + 1""",
+            (message_id, first_id, last_id, max_id)
+        )
+
+    @staticmethod
+    def _decrement_unread_counters(cursor, conn, read_counts):
+        """
+        按 {user_id: 新标记为已读的数量} 减少未读数，提交后失效未读数缓存
+        """
+        if not read_counts:
+            return
+        cursor.executemany(
+            "UPDATE user_unread_counters SET unread = GREATEST(unread - %s, 0) WHERE user_id = %s",
+            [(count, user_id) for user_id, count in read_counts.items()]
+        )
+        on_commit(conn, lambda: [unread_cache.invalidate(user_id) for user_id in read_counts])
+
+    @staticmethod
+    def mark_messages_read(receipts, conn=None):
         """
-        conn = get_db_connection()
+        批量标记消息为已读（一条UPDATE，按unique_message_user索引逐行定位），并减少对应用户的未读数
+
+        参数:
+            receipts: (message_id, user_id) 列表
+
+        返回:
+            实际由未读变为已读的数量
+        """
+        if not receipts:
+            return 0
         try:
-            with conn.cursor() as cursor:
-                # 获取消息信息
+            with transaction(conn) as conn, conn.cursor() as cursor:
+                placeholders = ', '.join(['(%s, %s)'] * len(receipts))
+                params = [value for receipt in receipts for value in receipt]
+                # 先锁定并统计各用户将要变为已读的记录数
                 cursor.execute(
-                    "SELECT * FROM messages WHERE id = %s",
-                    (message_id,)
+                    f"""SELECT user_id, COUNT(*) AS unread FROM message_deliveries
+                    WHERE (message_id, user_id) IN ({placeholders}) AND is_read = FALSE
+                    GROUP BY user_id FOR UPDATE""",
+                    params
                 )
-                message = cursor.fetchone()
+                read_counts = {row['user_id']: row['unread'] for row in cursor.fetchall()}
+                if not read_counts:
+                    return 0
 
-                if not message:
-                    return False
+                cursor.execute(
+                    f"""UPDATE message_deliveries
+                    SET is_read = TRUE, read_at = NOW()
+                    WHERE (message_id, user_id) IN ({placeholders}) AND is_read = FALSE""",
+                    params
+                )
+                marked = cursor.rowcount
+                DatabaseManager._decrement_unread_counters(cursor, conn, read_counts)
+                return marked
+        except Exception as e:
+            print(f"批量标记消息已读失败: {e}")
+            raise e
 
-                # 确定接收用户
-                if user_ids is None:
-                    # 如果是VIP专属消息，只发送给VIP用户
-                    if message['is_vip_only']:
-                        cursor.execute("SELECT id FROM users WHERE is_vip = TRUE")
-                    else:
-                        cursor.execute("SELECT id FROM users")
+    @staticmethod
+    def mark_messages_read_before(user_id, delivered_at=None, message_id=None, conn=None):
+        """
+        把用户在 (delivered_at, message_id) 及之前送达的未读消息全部标记为已读（一条UPDATE）
+        delivered_at为None时标记该用户的全部未读消息
+
+        返回:
+            标记的数量
+        """
+        try:
+            with transaction(conn) as conn, conn.cursor() as cursor:
+                query = """UPDATE message_deliveries
+                SET is_read = TRUE, read_at = NOW()
+                WHERE user_id = %s AND is_read = FALSE"""
+                params = [user_id]
+                if delivered_at is not None:
+                    query += " AND delivered_at <= %s AND (delivered_at < %s OR message_id <= %s)"
+                    params.extend([delivered_at, delivered_at, message_id])
+                cursor.execute(query, params)
+                marked = cursor.rowcount
+                if marked:
+                    DatabaseManager._decrement_unread_counters(cursor, conn, {user_id: marked})
+                return marked
+        except Exception as e:
+            print(f"标记消息已读失败: {e}")
+            raise e
 
-                    users = cursor.fetchall()
-                    user_ids = [user['id'] for user in users]
+    @staticmethod
+    def get_unread_count(user_id, conn=None):
+        """
+        获取用户的未读消息数（读取user_unread_counters的一行，不统计发送记录）
+        不在事务中时优先读取未读数缓存，未命中时从主库读取（从库的延迟值不能写入缓存）；没有计数行的用户未读数为0
+        """
+        cached = conn is None
+        if cached:
+            unread = unread_cache.get(user_id, None)
+            if unread is not None:
+                return unread
+            # 读取期间计数被修改（缓存被失效）时不写入读到的旧值
+            generation = unread_cache.generation()
 
-                # 批量插入消息发送记录
-                values = []
-                for user_id in user_ids:
-                    values.append((message_id, user_id))
+        with read_transaction(conn, primary=True) as conn:
+            row = DatabaseManager.execute_query(
+                "SELECT unread FROM user_unread_counters WHERE user_id = %s", (user_id,), fetch_one=True, conn=conn
+            )
+        unread = row['unread'] if row else 0
+        if cached:
+            unread_cache.set(user_id, unread, generation)
+        return unread
 
-                if values:
-                    cursor.executemany(
-                        """INSERT IGNORE INTO message_deliveries 
-                        (message_id, user_id) VALUES (%s, %s)""",
-                        values
-                    )
+    @staticmethod
+    def rebuild_unread_counters(user_id=None, chunk_size=DB_AUDIENCE_CHUNK_SIZE):
+        """
+        根据message_deliveries重新计算未读数，按users.id范围分块执行，每块单独提交
+        重算期间并发的群发和已读可能使个别计数产生偏差，可在低峰期运行
+
+        参数:
+            user_id: 只重算该用户，为None时重算全部用户
+            chunk_size: 每块覆盖的用户ID范围
+
+        返回:
+            重算的用户数
+        """
+        query = """INSERT INTO user_unread_counters (user_id, unread)
+            SELECT u.id, COUNT(md.id) FROM users u
+            LEFT JOIN message_deliveries md ON md.user_id = u.id AND md.is_read = FALSE
+            WHERE u.id BETWEEN %s AND %s
+            GROUP BY u.id
+            ON DUPLICATE KEY UPDATE unread = VALUES(unread)"""
+        try:
+            if user_id is not None:
+                ranges = [(user_id, user_id)]
+            else:
+                bounds = DatabaseManager.execute_query(
+                    "SELECT MIN(id) AS first_id, MAX(id) AS last_id FROM users", fetch_one=True
+                )
+                if bounds['first_id'] is None:
+                    return 0
+                ranges = [
+                    (first_id, min(first_id + chunk_size - 1, bounds['last_id']))
+                    for first_id in range(bounds['first_id'], bounds['last_id'] + 1, chunk_size)
+                ]
 
-                conn.commit()
-                return len(values)
+            rebuilt = 0
+            for first_id, last_id in ranges:
+                with transaction() as conn, conn.cursor() as cursor:
+                    cursor.execute(query, (first_id, last_id))
+                    cursor.execute(
+                        "SELECT COUNT(*) AS users FROM users WHERE id BETWEEN %s AND %s", (first_id, last_id)
+                    )
+                    rebuilt += cursor.fetchone()['users']
+                unread_cache.invalidate_range(first_id, last_id)
+            return rebuilt
         except Exception as e:
-            conn.rollback()
-            print(f"发送消息失败: {e}")
+            print(f"重算未读消息数失败: {e}")
             raise e
-        finally:
-            conn.close()
 
     @staticmethod
-    def create_notification(user_id, notification_type, title, content, is_email=False, is_telegram=True):
+    def create_notification(user_id, notification_type, title, content, is_email=False, is_telegram=True,
+                            dedupe_key=None, conn=None):
         """
         创建通知
+        dedupe_key与本地发件箱回放共用唯一索引，写入结果未知时转存到发件箱不会产生重复的通知
         """
-        conn = get_db_connection()
         try:
-            with conn.cursor() as cursor:
+            with transaction(conn) as conn, conn.cursor() as cursor:
                 cursor.execute(
                     """INSERT INTO notifications 
-                    (user_id, type, title, content, is_email, is_telegram) 
-                    VALUES (%s, %s, %s, %s, %s, %s)""",
-                    (user_id, notification_type, title, content, is_email, is_telegram)
+                    (user_id, type, title, content, is_email, is_telegram, dedupe_key) 
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                    (user_id, notification_type, title, content, is_email, is_telegram, dedupe_key)
                 )
                 notification_id = cursor.lastrowid
-                conn.commit()
                 return notification_id
         except Exception as e:
-            conn.rollback()
             print(f"创建通知失败: {e}")
             raise e
-        finally:
-            conn.close()
 
     @staticmethod
-    def mark_notification_sent(notification_id):
+    def create_notifications(notifications, conn=None):
+        """
+        批量创建通知（多行INSERT）
+
+        参数:
+            notifications: (user_id, type, title, content, is_email, is_telegram) 列表
+
+        返回:
+            创建的数量
+        """
+        if not notifications:
+            return 0
+        try:
+            with transaction(conn) as conn, conn.cursor() as cursor:
+                # pymysql会把executemany的INSERT改写为多行INSERT
+                cursor.executemany(
+                    """INSERT INTO notifications
+                    (user_id, type, title, content, is_email, is_telegram)
+                    VALUES (%s, %s, %s, %s, %s, %s)""",
+                    notifications
+                )
+                return len(notifications)
+        except Exception as e:
+            print(f"批量创建通知失败: {e}")
+            raise e
+
+    @staticmethod
+    def insert_spooled_notifications(records, conn=None):
+        """
+        批量写入本地发件箱中的通知（多行INSERT IGNORE）
+        dedupe_key已存在的通知会被忽略，同一批记录可以安全地重复写入
+
+        参数:
+            records: 发件箱记录列表（dict）
+
+        返回:
+            实际写入的数量
+        """
+        if not records:
+            return 0
+        try:
+            with transaction(conn) as conn, conn.cursor() as cursor:
+                cursor.executemany(
+                    """INSERT IGNORE INTO notifications
+                    (user_id, type, title, content, is_email, is_telegram, created_at, dedupe_key)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                    [(r['user_id'], r['type'], r['title'], r['content'], r['is_email'], r['is_telegram'],
+                      r['created_at'], r['dedupe_key']) for r in records]
+                )
+                return cursor.rowcount
+        except Exception as e:
+            print(f"回放发件箱通知失败: {e}")
+            raise e
+
+    @staticmethod
+    def get_job_watermark(job_name, conn=None):
+        """
+        获取定时任务的水位线，并锁定该行直到事务结束
+
+        返回:
+            (watermark, last_id)，没有记录时返回None
+        """
+        with transaction(conn) as conn, conn.cursor(RowCursor) as cursor:
+            cursor.execute(
+                "SELECT watermark, last_id FROM job_watermarks WHERE job_name = %s FOR UPDATE",
+                (job_name,)
+            )
+            row = cursor.fetchone()
+            return (row['watermark'], row['last_id']) if row else None
+
+    @staticmethod
+    def set_job_watermark(job_name, watermark, last_id=0, conn=None):
+        """
+        保存定时任务的水位线
+        """
+        try:
+            with transaction(conn) as conn, conn.cursor() as cursor:
+                cursor.execute(
+                    """INSERT INTO job_watermarks (job_name, watermark, last_id)
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE watermark = VALUES(watermark), last_id = VALUES(last_id)""",
+                    (job_name, watermark, last_id)
+                )
+                return True
+        except Exception as e:
+            print(f"保存任务水位线失败: {e}")
+            raise e
+
+    @staticmethod
+    def mark_notification_sent(notification_id, conn=None):
         """
         标记通知为已发送
         """
-        conn = get_db_connection()
         try:
-            with conn.cursor() as cursor:
+            with transaction(conn) as conn, conn.cursor() as cursor:
                 cursor.execute(
                     """UPDATE notifications 
                     SET is_sent = TRUE, sent_at = NOW() 
                     WHERE id = %s""",
                     (notification_id,)
                 )
-                conn.commit()
                 return True
         except Exception as e:
-            conn.rollback()
             print(f"标记通知失败: {e}")
             raise e
-        finally:
-            conn.close()
 
     @staticmethod
-    def get_pending_notifications(is_email=None, is_telegram=None):
+    def mark_notifications_sent(notification_ids, conn=None):
+        """
+        批量标记通知为已发送（一条UPDATE）
+        """
+        if not notification_ids:
+            return 0
+        try:
+            with transaction(conn) as conn, conn.cursor() as cursor:
+                placeholders = ', '.join(['%s'] * len(notification_ids))
+                cursor.execute(
+                    f"""UPDATE notifications
+                    SET is_sent = TRUE, sent_at = NOW()
+                    WHERE id IN ({placeholders})""",
+                    list(notification_ids)
+                )
+                return cursor.rowcount
+        except Exception as e:
+            print(f"批量标记通知失败: {e}")
+            raise e
+
+    @staticmethod
+    def claim_notifications(worker_id, limit, lease_seconds, is_email=None, is_telegram=None,
+                            coalesce_window=0, conn=None):
+        """
+        认领一批待发送的通知
+
+        用SELECT ... FOR UPDATE SKIP LOCKED选出已到重试时间、未被认领（或租约已过期）的通知，
+        写入claimed_by和lease_until后提交。多个进程同时认领时拿到的通知互不重复；
+        进程崩溃后，其认领的通知在租约到期后可以被其他进程重新认领。
+
+        coalesce_window大于0时，只认领创建超过coalesce_window秒的通知，
+        并同时认领这些通知的用户在同一渠道上其他已到重试时间的待发送通知（用于合并发送）。
+
+        参数:
+            worker_id: 认领者标识
+            limit: 最多认领的数量（不含合并认领的同用户通知）
+            lease_seconds: 租约时长（秒），应大于发送一批通知所需的时间
+            is_email: 只认领需要发送邮件的通知
+            is_telegram: 只认领需要发送Telegram消息的通知
+            coalesce_window: 合并窗口秒数
+
+        返回:
+            认领到的通知列表
+        """
+        channel = ""
+        channel_params = []
+
+        if is_email is not None:
+            channel += " AND is_email = %s"
+            channel_params.append(is_email)
+
+        if is_telegram is not None:
+            channel += " AND is_telegram = %s"
+            channel_params.append(is_telegram)
+
+        # 只认领已到重试时间的通知，按到期时间顺序（走idx_due_*索引）
+        query = f"""SELECT id, user_id FROM notifications
+        WHERE is_sent = FALSE AND is_dead = FALSE{channel}
+        AND next_attempt_at <= NOW() AND (lease_until IS NULL OR lease_until < NOW())"""
+        params = list(channel_params)
+
+        if coalesce_window:
+            query += " AND created_at <= NOW() - INTERVAL %s SECOND"
+            params.append(coalesce_window)
+
+        query += " ORDER BY next_attempt_at, id LIMIT %s FOR UPDATE SKIP LOCKED"
+        params.append(limit)
+
+        try:
+            with transaction(conn) as conn, conn.cursor(RowCursor) as cursor:
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+                if not rows:
+                    return []
+                ids = [row['id'] for row in rows]
+
+                if coalesce_window:
+                    # 同一用户在窗口内陆续产生的通知一起认领（走idx_user_id索引）；
+                    # 正在退避等待重试的通知不合并，到期后再单独认领
+                    user_ids = sorted({row['user_id'] for row in rows})
+                    cursor.execute(
+                        f"""SELECT id FROM notifications
+                        WHERE user_id IN ({', '.join(['%s'] * len(user_ids))})
+                        AND is_sent = FALSE AND is_dead = FALSE{channel}
+                        AND next_attempt_at <= NOW() AND (lease_until IS NULL OR lease_until < NOW())
+                        AND id NOT IN ({', '.join(['%s'] * len(ids))})
+                        FOR UPDATE SKIP LOCKED""",
+                        [*user_ids, *channel_params, *ids]
+                    )
+                    ids += [row['id'] for row in cursor.fetchall()]
+
+                placeholders = ', '.join(['%s'] * len(ids))
+                cursor.execute(
+                    f"""UPDATE notifications
+                    SET claimed_by = %s, lease_until = NOW() + INTERVAL %s SECOND
+                    WHERE id IN ({placeholders})""",
+                    [worker_id, lease_seconds, *ids]
+                )
+                # 联表带上接收人的邮箱和Telegram ID，发送时不需要再逐条查询用户
+                cursor.execute(
+                    f"""SELECT n.*, u.email, u.telegram_id
+                    FROM notifications n
+                    JOIN users u ON u.id = n.user_id
+                    WHERE n.id IN ({placeholders})
+                    ORDER BY n.id""",
+                    ids
+                )
+                return cursor.fetchall()
+        except Exception as e:
+            print(f"认领通知失败: {e}")
+            raise e
+
+    @staticmethod
+    def release_notifications(notification_ids, worker_id, conn=None):
+        """
+        释放认领但未发送成功的通知，使其可以被重新认领
+        """
+        if not notification_ids:
+            return 0
+        try:
+            with transaction(conn) as conn, conn.cursor() as cursor:
+                placeholders = ', '.join(['%s'] * len(notification_ids))
+                cursor.execute(
+                    f"""UPDATE notifications
+                    SET claimed_by = NULL, lease_until = NULL
+                    WHERE id IN ({placeholders}) AND claimed_by = %s AND is_sent = FALSE""",
+                    [*notification_ids, worker_id]
+                )
+                return cursor.rowcount
+        except Exception as e:
+            print(f"释放通知失败: {e}")
+            raise e
+
+    @staticmethod
+    def reschedule_notifications(failures, worker_id, max_attempts, conn=None):
+        """
+        记录发送失败并安排下一次重试，达到最大尝试次数的通知进入死信状态
+
+        参数:
+            failures: (notification_id, 延迟秒数, 错误信息) 列表
+            worker_id: 认领者标识，只处理自己认领的通知
+            max_attempts: 最大尝试次数
+
+        返回:
+            进入死信状态的通知ID列表
+        """
+        if not failures:
+            return []
+        try:
+            with transaction(conn) as conn, conn.cursor(RowCursor) as cursor:
+                # SET按顺序执行，is_dead使用的是加1后的attempts
+                cursor.executemany(
+                    """UPDATE notifications
+                    SET attempts = attempts + 1,
+                        next_attempt_at = NOW() + INTERVAL %s SECOND,
+                        last_error = %s,
+                        is_dead = attempts >= %s,
+                        claimed_by = NULL, lease_until = NULL
+                    WHERE id = %s AND claimed_by = %s AND is_sent = FALSE""",
+                    [(delay, (error or '')[:255], max_attempts, notification_id, worker_id)
+                     for notification_id, delay, error in failures]
+                )
+                placeholders = ', '.join(['%s'] * len(failures))
+                cursor.execute(
+                    f"SELECT id FROM notifications WHERE id IN ({placeholders}) AND is_dead = TRUE",
+                    [notification_id for notification_id, _, _ in failures]
+                )
+                return [row['id'] for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"记录通知发送失败: {e}")
+            raise e
+
+    @staticmethod
+    def get_dead_notifications(limit=100, conn=None):
+        """
+        获取死信状态（多次发送失败后不再重试）的通知
+        """
+        return DatabaseManager.execute_query(
+            """SELECT * FROM notifications
+            WHERE is_sent = FALSE AND is_dead = TRUE
+            ORDER BY id LIMIT %s""",
+            (limit,), conn=conn
+        )
+
+    @staticmethod
+    def requeue_dead_notifications(notification_ids, conn=None):
+        """
+        将死信通知重新加入发送队列（如用户修正了邮箱后）
+        """
+        if not notification_ids:
+            return 0
+        try:
+            with transaction(conn) as conn, conn.cursor() as cursor:
+                placeholders = ', '.join(['%s'] * len(notification_ids))
+                cursor.execute(
+                    f"""UPDATE notifications
+                    SET is_dead = FALSE, attempts = 0, next_attempt_at = NOW(), last_error = NULL
+                    WHERE id IN ({placeholders}) AND is_sent = FALSE""",
+                    list(notification_ids)
+                )
+                return cursor.rowcount
+        except Exception as e:
+            print(f"重新加入通知队列失败: {e}")
+            raise e
+
+    @staticmethod
+    def get_pending_notifications(is_email=None, is_telegram=None, conn=None, as_dict=False):
         """
-        获取待发送的通知
+        获取待发送的通知（联表带上接收人的email和telegram_id）
+        不包括死信和未到重试时间的通知
         """
-        query = "SELECT * FROM notifications WHERE is_sent = FALSE"
+        query = """SELECT n.*, u.email, u.telegram_id
+        FROM notifications n
+        JOIN users u ON u.id = n.user_id
+        WHERE n.is_sent = FALSE AND n.is_dead = FALSE AND n.next_attempt_at <= NOW()"""
         params = []
 
         if is_email is not None:
-            query += " AND is_email = %s"
+            query += " AND n.is_email = %s"
             params.append(is_email)
 
         if is_telegram is not None:
-            query += " AND is_telegram = %s"
+            query += " AND n.is_telegram = %s"
             params.append(is_telegram)
 
-        return DatabaseManager.execute_query(query, params)
+        return DatabaseManager.execute_query(query, params, conn=conn, as_dict=as_dict)
@@ -0,0 +1,354 @@
+# 数据库结构版本迁移
+
+import sys
+
+import pymysql
+
+from config import SCHEMA_CHECK_MIN_ROWS, SCHEMA_CHECK_ON_MIGRATE
+from database.models import get_db_connection
+
+# MySQL错误码：重复执行迁移时可以忽略的错误
+ER_DUP_FIELDNAME = 1060
+ER_DUP_KEYNAME = 1061
+ER_CANT_DROP_FIELD_OR_KEY = 1091
+IGNORABLE_ERRORS = (ER_DUP_FIELDNAME, ER_DUP_KEYNAME, ER_CANT_DROP_FIELD_OR_KEY)
+
+# 迁移锁名称和等待秒数，避免多个进程同时执行迁移
+MIGRATION_LOCK = 'telegram_vip_bot_schema_migrations'
+MIGRATION_LOCK_TIMEOUT = 60
+
+# 迁移列表：(版本号, 描述, SQL语句列表)，版本号必须递增，已发布的迁移不能修改
+MIGRATIONS = [
+    (1, '热点查询的复合索引', [
+        # get_pending_notifications: is_sent + is_email / is_telegram
+        "ALTER TABLE notifications ADD INDEX idx_pending_email (is_sent, is_email)",
+        "ALTER TABLE notifications ADD INDEX idx_pending_telegram (is_sent, is_telegram)",
+        # get_user_messages: user_id + is_read，按时间排序
+        "ALTER TABLE message_deliveries ADD INDEX idx_user_read_delivered (user_id, is_read, delivered_at)",
+        # get_active_by_user_id: user_id + is_active，按end_date排序
+        "ALTER TABLE subscriptions ADD INDEX idx_user_active_end (user_id, is_active, end_date)",
+    ]),
+    (2, '通知认领租约', [
+        # 认领者和租约到期时间，多个进程并发发送通知时使用
+        "ALTER TABLE notifications ADD COLUMN claimed_by VARCHAR(64) NULL",
+        "ALTER TABLE notifications ADD COLUMN lease_until DATETIME NULL",
+    ]),
+    (3, '订阅到期提醒去重和任务水位线', [
+        # 每个订阅在每个提醒档位（到期前天数）只提醒一次
+        """CREATE TABLE IF NOT EXISTS subscription_reminders (
+            subscription_id INT NOT NULL,
+            tier INT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (subscription_id, tier),
+            FOREIGN KEY (subscription_id) REFERENCES subscriptions(id) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        # 增量任务的水位线：(watermark, last_id) 之前的数据已经处理过
+        """CREATE TABLE IF NOT EXISTS job_watermarks (
+            job_name VARCHAR(100) PRIMARY KEY,
+            watermark DATETIME NULL,
+            last_id INT NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+    ]),
+    (4, '通知失败重试和死信', [
+        # 尝试次数、下次重试时间、最后一次错误，多次失败后进入死信状态
+        "ALTER TABLE notifications ADD COLUMN attempts INT NOT NULL DEFAULT 0",
+        "ALTER TABLE notifications ADD COLUMN next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP",
+        "ALTER TABLE notifications ADD COLUMN last_error VARCHAR(255) NULL",
+        "ALTER TABLE notifications ADD COLUMN is_dead BOOLEAN NOT NULL DEFAULT FALSE",
+        # 认领时按渠道过滤到期的通知并按next_attempt_at排序，替换迁移1中的两个索引
+        "ALTER TABLE notifications ADD INDEX idx_due_email (is_sent, is_dead, is_email, next_attempt_at)",
+        "ALTER TABLE notifications ADD INDEX idx_due_telegram (is_sent, is_dead, is_telegram, next_attempt_at)",
+        "ALTER TABLE notifications DROP INDEX idx_pending_email",
+        "ALTER TABLE notifications DROP INDEX idx_pending_telegram",
+    ]),
+    (5, '通知去重键（本地发件箱回放）', [
+        # 发件箱中的每条通知带有唯一的去重键，重复回放时由唯一索引忽略
+        "ALTER TABLE notifications ADD COLUMN dedupe_key CHAR(32) NULL",
+        "ALTER TABLE notifications ADD UNIQUE INDEX uk_dedupe_key (dedupe_key)",
+    ]),
+    (6, '消息群发进度检查点', [
+        # 按user_id顺序群发，last_user_id之前的发送记录已处理；
+        # run_started_at和run_processed是本次运行开始的时间和当时已处理的数量，用于估算剩余时间
+        """CREATE TABLE IF NOT EXISTS broadcast_checkpoints (
+            message_id INT PRIMARY KEY,
+            last_user_id INT NOT NULL DEFAULT 0,
+            total INT NOT NULL DEFAULT 0,
+            sent INT NOT NULL DEFAULT 0,
+            failed INT NOT NULL DEFAULT 0,
+            status ENUM('running', 'completed') NOT NULL DEFAULT 'running',
+            run_started_at DATETIME NULL,
+            run_processed INT NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            finished_at DATETIME NULL,
+            FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE CASCADE,
+            INDEX idx_status (status)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+    ]),
+    (7, '收件箱游标分页覆盖索引', [
+        # get_user_messages_page: 按 (delivered_at, message_id) 键集分页，
+        # 过滤、排序和返回的发送记录列都在索引中，只对本页消息回表读取messages
+        """ALTER TABLE message_deliveries ADD INDEX idx_user_read_delivered_cover
+        (user_id, is_read, delivered_at, message_id, read_at)""",
+        # include_read=True 时不按is_read过滤
+        """ALTER TABLE message_deliveries ADD INDEX idx_user_delivered
+        (user_id, delivered_at, message_id, is_read, read_at)""",
+        # 已被覆盖索引的前缀取代
+        "ALTER TABLE message_deliveries DROP INDEX idx_user_read_delivered",
+    ]),
+    (8, '用户未读消息数', [
+        # 写入发送记录时加1，标记已读时减少；可通过 python -m services.message_service rebuild-unread 重算
+        """CREATE TABLE IF NOT EXISTS user_unread_counters (
+            user_id INT PRIMARY KEY,
+            unread INT NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        # 根据已有的发送记录初始化
+        """INSERT IGNORE INTO user_unread_counters (user_id, unread)
+        SELECT user_id, COUNT(*) FROM message_deliveries WHERE is_read = FALSE GROUP BY user_id""",
+    ]),
+    (9, '群发失败状态', [
+        # 群发中途出错时记录failed和错误原因，重启后与running一起继续
+        """ALTER TABLE broadcast_checkpoints
+        MODIFY status ENUM('running', 'completed', 'failed') NOT NULL DEFAULT 'running'""",
+        "ALTER TABLE broadcast_checkpoints ADD COLUMN last_error VARCHAR(1000) NULL AFTER status",
+    ]),
+]
+
+# 热点查询：(名称, 需要走索引的表, SQL, 示例参数)，用于EXPLAIN检查
+HOT_QUERIES = [
+    (
+        'get_pending_notifications(email)',
+        'n',
+        """SELECT n.*, u.email, u.telegram_id
+        FROM notifications n
+        JOIN users u ON u.id = n.user_id
+        WHERE n.is_sent = FALSE AND n.is_dead = FALSE AND n.next_attempt_at <= NOW() AND n.is_email = %s""",
+        (True,),
+    ),
+    (
+        'get_pending_notifications(telegram)',
+        'n',
+        """SELECT n.*, u.email, u.telegram_id
+        FROM notifications n
+        JOIN users u ON u.id = n.user_id
+        WHERE n.is_sent = FALSE AND n.is_dead = FALSE AND n.next_attempt_at <= NOW() AND n.is_telegram = %s""",
+        (True,),
+    ),
+    (
+        'claim_notifications(email)',
+        'notifications',
+        """SELECT id FROM notifications WHERE is_sent = FALSE AND is_dead = FALSE AND is_email = %s
+        AND next_attempt_at <= NOW() AND (lease_until IS NULL OR lease_until < NOW())
+        ORDER BY next_attempt_at, id LIMIT %s FOR UPDATE SKIP LOCKED""",
+        (True, 100),
+    ),
+    (
+        'claim_notifications(telegram)',
+        'notifications',
+        """SELECT id FROM notifications WHERE is_sent = FALSE AND is_dead = FALSE AND is_telegram = %s
+        AND next_attempt_at <= NOW() AND (lease_until IS NULL OR lease_until < NOW())
+        ORDER BY next_attempt_at, id LIMIT %s FOR UPDATE SKIP LOCKED""",
+        (True, 100),
+    ),
+    (
+        'get_user_messages',
+        'md',
+        """SELECT m.*, md.is_read, md.delivered_at, md.read_at
+        FROM messages m
+        JOIN message_deliveries md ON m.id = md.message_id
+        WHERE md.user_id = %s AND md.is_read = FALSE
+        ORDER BY m.created_at DESC LIMIT %s OFFSET %s""",
+        (1, 20, 0),
+    ),
+    (
+        'get_user_messages_page(unread)',
+        'md',
+        """SELECT m.*, md.is_read, md.delivered_at, md.read_at
+        FROM message_deliveries md
+        JOIN messages m ON m.id = md.message_id
+        WHERE md.user_id = %s AND md.is_read = FALSE
+        AND md.delivered_at <= %s AND (md.delivered_at < %s OR md.message_id < %s)
+        ORDER BY md.delivered_at DESC, md.message_id DESC LIMIT %s""",
+        (1, '2100-01-01', '2100-01-01', 0, 21),
+    ),
+    (
+        'get_user_messages_page(all)',
+        'md',
+        """SELECT m.*, md.is_read, md.delivered_at, md.read_at
+        FROM message_deliveries md
+        JOIN messages m ON m.id = md.message_id
+        WHERE md.user_id = %s
+        AND md.delivered_at <= %s AND (md.delivered_at < %s OR md.message_id < %s)
+        ORDER BY md.delivered_at DESC, md.message_id DESC LIMIT %s""",
+        (1, '2100-01-01', '2100-01-01', 0, 21),
+    ),
+    (
+        'get_active_by_user_id',
+        'subscriptions',
+        """SELECT * FROM subscriptions
+        WHERE user_id = %s AND is_active = TRUE
+        ORDER BY end_date DESC LIMIT 1""",
+        (1,),
+    ),
+    (
+        'broadcast_page',
+        'md',
+        """SELECT md.user_id, u.telegram_id
+        FROM message_deliveries md
+        JOIN users u ON u.id = md.user_id
+        WHERE md.message_id = %s AND md.user_id > %s
+        ORDER BY md.user_id LIMIT %s""",
+        (1, 0, 500),
+    ),
+    (
+        'expiry_sweep',
+        's',
+        """SELECT s.id, s.user_id, s.plan_type, s.end_date, s.auto_renew
+        FROM subscriptions s
+        WHERE s.is_active = TRUE AND s.end_date >= %s AND s.end_date < %s
+        AND (s.end_date > %s OR s.id > %s)
+        AND NOT EXISTS (
+            SELECT 1 FROM subscriptions r
+            WHERE r.user_id = s.user_id AND r.is_active = TRUE AND r.end_date > s.end_date
+        )
+        ORDER BY s.end_date, s.id LIMIT %s""",
+        ('2000-01-01', '2000-01-08', '2000-01-01', 0, 500),
+    ),
+]
+
+
+class SchemaCheckError(Exception):
+    """
+    热点查询没有走索引
+    """
+
+
+def get_schema_version(cursor):
+    """
+    获取已执行的迁移版本集合
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row['version'] for row in cursor.fetchall()}
+
+
+def migrate(check=SCHEMA_CHECK_ON_MIGRATE):
+    """
+    按版本号顺序执行所有未执行的迁移
+
+    DDL语句在MySQL中会隐式提交，无法整体回滚；中途失败后重新执行时，
+    已经生效的语句（重复的列或索引）会被跳过。
+    check为真时迁移完成后执行check_hot_queries()，热点查询没有走索引时抛出SchemaCheckError。
+
+    返回:
+        本次执行的版本号列表
+    """
+    conn = get_db_connection()
+    applied_now = []
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT GET_LOCK(%s, %s) AS locked", (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+            if not cursor.fetchone()['locked']:
+                raise RuntimeError("等待数据库迁移锁超时")
+
+            try:
+                applied = get_schema_version(cursor)
+                for version, description, statements in MIGRATIONS:
+                    if version in applied:
+                        continue
+
+                    for statement in statements:
+                        try:
+                            cursor.execute(statement)
+                        except pymysql.err.MySQLError as e:
+                            if e.args[0] not in IGNORABLE_ERRORS:
+                                raise
+                            print(f"迁移{version}跳过已生效的语句: {e}")
+
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (version, description)
+                    )
+                    conn.commit()
+                    applied_now.append(version)
+                    print(f"已执行数据库迁移{version}: {description}")
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+
+    if check:
+        check_hot_queries()
+    return applied_now
+
+
+def find_scans(name, table, plan, min_rows=SCHEMA_CHECK_MIN_ROWS):
+    """
+    检查一条热点查询的EXPLAIN结果，返回目标表上全表扫描或全索引扫描的问题列表
+
+    以下情况视为没有走索引：
+    - 全表扫描（type为ALL）且目标表没有任何可用索引（possible_keys为空），与数据量无关；
+    - 全表扫描或全索引扫描（type为index，按索引顺序读取整个索引），且估算行数不少于min_rows
+      （数据量很小时扫描本身是合理的执行计划）。
+    """
+    failures = []
+    for row in plan:
+        if row['table'] != table or row['type'] not in ('ALL', 'index'):
+            continue
+        if row['type'] == 'ALL' and not row['possible_keys']:
+            failures.append(f"{name}: 表{table}没有可用索引")
+        elif (row['rows'] or 0) >= min_rows:
+            scan = '全表扫描' if row['type'] == 'ALL' else f"全索引扫描（{row['key']}）"
+            failures.append(f"{name}: 表{table}{scan}（约{row['rows']}行）")
+    return failures
+
+
+def check_hot_queries(min_rows=SCHEMA_CHECK_MIN_ROWS):
+    """
+    用EXPLAIN检查热点查询是否走索引，判断规则见find_scans()
+
+    返回:
+        {查询名称: EXPLAIN结果}
+    """
+    conn = get_db_connection()
+    plans = {}
+    failures = []
+    try:
+        with conn.cursor() as cursor:
+            for name, table, query, params in HOT_QUERIES:
+                cursor.execute("EXPLAIN " + query, params)
+                plan = cursor.fetchall()
+                plans[name] = plan
+                failures.extend(find_scans(name, table, plan, min_rows))
+    finally:
+        conn.close()
+
+    if failures:
+        raise SchemaCheckError("热点查询没有走索引:\n" + "\n".join(failures))
+    return plans
+
+
+if __name__ == '__main__':
+    # 用法: python -m database.migrations [migrate|check]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    if command == 'migrate':
+        versions = migrate()
+        print(f"执行了{len(versions)}个迁移" if versions else "数据库结构已是最新版本")
+    elif command == 'check':
+        check_hot_queries()
+        print("所有热点查询都走索引")
+    else:
+        print(f"未知命令: {command}")
+        sys.exit(1)
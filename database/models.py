@@ -1,29 +1,184 @@
 # 数据库模型定义
 
 import datetime
+import functools
+import threading
+from contextlib import contextmanager
 import pymysql
 import json
 
-from config import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME
+from config import (
+    DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_IDLE_TIMEOUT, DB_POOL_WAIT_TIMEOUT, DB_POOL_PING_INTERVAL,
+    DB_REPLICAS, DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL, DB_REPLICA_READ_AFTER_WRITE
+)
+from database.pool import ConnectionPool
+from database.replicas import Replica, ReplicaRouter
+from database.rows import RowCursor
+from database.cache import user_cache
+from database.vip_index import vip_index
 
+# 全局连接池和只读副本路由器（首次使用时创建）
+_pool = None
+_router = None
+_pool_lock = threading.Lock()
 
-# 数据库连接初始化
-def get_db_connection():
+
+def create_raw_connection(host=DB_HOST, port=DB_PORT):
     """
-    获取数据库连接
+    建立一个新的数据库连接（不经过连接池）
     """
-
-    # 建立数据库连接
-    connection = pymysql.connect(
-        host=DB_HOST,
+    return pymysql.connect(
+        host=host,
         user=DB_USER,
         password=DB_PASSWORD,
-        port=DB_PORT,
+        port=port,
         db=DB_NAME,
         charset='utf8mb4',
         cursorclass=pymysql.cursors.DictCursor
     )
-    return connection
+
+
+def _create_pool(connect):
+    return ConnectionPool(
+        connect,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        idle_timeout=DB_POOL_IDLE_TIMEOUT,
+        wait_timeout=DB_POOL_WAIT_TIMEOUT,
+        ping_interval=DB_POOL_PING_INTERVAL
+    )
+
+
+def get_pool():
+    """
+    获取全局连接池
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = _create_pool(create_raw_connection)
+                pool.fill()
+                _pool = pool
+    return _pool
+
+
+def get_replica_router():
+    """
+    获取只读副本路由器（副本连接池在首次使用时才建立连接）
+    """
+    global _router
+    if _router is None:
+        with _pool_lock:
+            if _router is None:
+                replicas = []
+                for replica in DB_REPLICAS:
+                    host, port = replica['host'], replica.get('port', DB_PORT)
+                    pool = _create_pool(functools.partial(create_raw_connection, host, port))
+                    replicas.append(Replica(f"{host}:{port}", pool))
+                _router = ReplicaRouter(
+                    replicas,
+                    max_lag=DB_REPLICA_MAX_LAG,
+                    check_interval=DB_REPLICA_CHECK_INTERVAL,
+                    read_after_write=DB_REPLICA_READ_AFTER_WRITE
+                )
+    return _router
+
+
+def get_pool_stats():
+    """
+    获取连接池统计信息（使用中连接数、等待数、取连接耗时等）
+    """
+    return get_pool().stats()
+
+
+# 数据库连接初始化
+def get_db_connection():
+    """
+    从连接池获取数据库连接
+    用法与原连接一致，调用close()时连接会归还给连接池
+    """
+    return get_pool().acquire()
+
+
+@contextmanager
+def transaction(conn=None):
+    """
+    事务上下文（工作单元）
+
+    不传conn时从连接池获取连接，代码块正常结束时提交、发生异常时回滚，最后归还连接；
+    传入conn时直接复用外部事务的连接，由外层transaction负责提交和回滚。
+    模型类和DatabaseManager的方法都接受conn参数，多步操作可以共用一个连接一次提交：
+
+        with transaction() as conn:
+            card = DatabaseManager.use_card_key(card_key, user_id, conn=conn)
+            Subscription(user_id, ...).save(conn=conn)
+    """
+    if conn is not None:
+        yield conn
+        return
+
+    conn = get_db_connection()
+    conn.commit_callbacks = []
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        callbacks, conn.commit_callbacks = conn.commit_callbacks, None
+        conn.close()
+
+    # 之后一段时间内当前线程的读查询走主库
+    get_replica_router().mark_write()
+
+    # 提交成功后执行注册的回调（如缓存失效）
+    for callback in callbacks:
+        callback()
+
+
+@contextmanager
+def read_transaction(conn=None, primary=False):
+    """
+    只读查询上下文
+
+    传入conn时复用外部事务；否则优先使用只读副本连接，
+    副本不可用、延迟过大或当前线程刚写入过时使用主库连接。
+    primary=True时直接读取主库（用于不能容忍复制延迟的读取），
+    与transaction()不同，不提交也不会把当前线程之后的读查询固定到主库。
+    代码块内只能执行读查询。
+    """
+    if conn is not None:
+        yield conn
+        return
+
+    replica_conn = None if primary else get_replica_router().acquire_read_connection()
+    if replica_conn is None:
+        conn = get_db_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+
+    try:
+        yield replica_conn
+    finally:
+        replica_conn.close()
+
+
+def on_commit(conn, callback):
+    """
+    注册在conn所属事务提交后执行的回调
+    conn不在transaction中时立即执行
+    """
+    callbacks = getattr(conn, 'commit_callbacks', None)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
 
 
 # 初始化数据库表
@@ -161,6 +316,10 @@ def init_database():
     finally:
         conn.close()
 
+    # 建表之后的结构变更（索引、新增列等）统一通过版本迁移执行
+    from database.migrations import migrate
+    migrate()
+
 
 # 用户模型类
 class User:
@@ -173,83 +332,109 @@ class User:
         self.is_vip = False
         self.subscription_end_date = None
 
-    def save(self):
+    def save(self, conn=None):
         """
         保存或更新用户信息
         """
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                # 检查用户是否已存在
+        with transaction(conn) as conn, conn.cursor() as cursor:
+            # 检查用户是否已存在
+            cursor.execute(
+                "SELECT id FROM users WHERE telegram_id = %s",
+                (self.telegram_id,)
+            )
+            user = cursor.fetchone()
+
+            if user:
+                # 更新现有用户
                 cursor.execute(
-                    "SELECT id FROM users WHERE telegram_id = %s",
-                    (self.telegram_id,)
+                    """UPDATE users 
+                    SET username = %s, first_name = %s, last_name = %s, email = %s 
+                    WHERE telegram_id = %s""",
+                    (self.username, self.first_name, self.last_name, self.email, self.telegram_id)
                 )
-                user = cursor.fetchone()
-
-                if user:
-                    # 更新现有用户
-                    cursor.execute(
-                        """UPDATE users 
-                        SET username = %s, first_name = %s, last_name = %s, email = %s 
-                        WHERE telegram_id = %s""",
-                        (self.username, self.first_name, self.last_name, self.email, self.telegram_id)
-                    )
-                    user_id = user['id']
-                else:
-                    # 创建新用户
-                    cursor.execute(
-                        """INSERT INTO users 
-                        (telegram_id, username, first_name, last_name, email) 
-                        VALUES (%s, %s, %s, %s, %s)""",
-                        (self.telegram_id, self.username, self.first_name, self.last_name, self.email)
-                    )
-                    user_id = cursor.lastrowid
-
-                conn.commit()
-                return user_id
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+                user_id = user['id']
+            else:
+                # 创建新用户
+                cursor.execute(
+                    """INSERT INTO users 
+                    (telegram_id, username, first_name, last_name, email) 
+                    VALUES (%s, %s, %s, %s, %s)""",
+                    (self.telegram_id, self.username, self.first_name, self.last_name, self.email)
+                )
+                user_id = cursor.lastrowid
+
+            User._invalidate_cache(conn, telegram_id=self.telegram_id)
+            return user_id
 
     @staticmethod
-    def get_by_telegram_id(telegram_id):
+    def get_by_telegram_id(telegram_id, conn=None):
         """
         通过Telegram ID获取用户
+        不在事务中时优先读取用户缓存，事务内总是查询数据库以读到本事务的修改
+        缓存未命中时从主库读取（只读副本可能还没有最新的修改），
+        读取期间该用户被失效过时不写入缓存
         """
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    "SELECT * FROM users WHERE telegram_id = %s",
-                    (telegram_id,)
-                )
-                return cursor.fetchone()
-        finally:
-            conn.close()
+        in_transaction = conn is not None
+        generation = None
+        if not in_transaction:
+            user = user_cache.get(telegram_id, None)
+            if user is not None:
+                return user
+            generation = user_cache.generation()
+
+        with read_transaction(conn, primary=True) as conn, conn.cursor(RowCursor) as cursor:
+            cursor.execute(
+                "SELECT * FROM users WHERE telegram_id = %s",
+                (telegram_id,)
+            )
+            user = cursor.fetchone()
+
+            if user is not None and not in_transaction:
+                user_cache.set(telegram_id, user, generation)
+            return user
 
     @staticmethod
-    def update_vip_status(user_id, is_vip, subscription_end_date=None):
+    def update_vip_status(user_id, is_vip, subscription_end_date=None, conn=None):
         """
         更新用户VIP状态
         """
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """UPDATE users 
-                    SET is_vip = %s, subscription_end_date = %s 
-                    WHERE id = %s""",
-                    (is_vip, subscription_end_date, user_id)
-                )
-                conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+        with transaction(conn) as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """UPDATE users 
+                SET is_vip = %s, subscription_end_date = %s 
+                WHERE id = %s""",
+                (is_vip, subscription_end_date, user_id)
+            )
+            User._invalidate_cache(conn, user_id=user_id)
+
+            # 已加载VIP索引时，提交后增量更新索引
+            if vip_index.loaded_at is not None:
+                telegram_id = vip_index.telegram_id_for(user_id)
+                if telegram_id is None:
+                    cursor.execute("SELECT telegram_id FROM users WHERE id = %s", (user_id,))
+                    row = cursor.fetchone()
+                    telegram_id = row['telegram_id'] if row else None
+
+                if telegram_id is not None:
+                    if is_vip:
+                        on_commit(conn, lambda: vip_index.grant(telegram_id, subscription_end_date, user_id))
+                    else:
+                        on_commit(conn, lambda: vip_index.revoke(telegram_id))
+
+    @staticmethod
+    def _invalidate_cache(conn, telegram_id=None, user_id=None):
+        """
+        失效用户缓存：立即失效一次，事务提交后再失效一次，
+        避免其他线程在提交前把旧数据重新写回缓存
+        """
+        def invalidate():
+            if telegram_id is not None:
+                user_cache.invalidate(telegram_id)
+            if user_id is not None:
+                user_cache.invalidate_user_id(user_id)
+
+        invalidate()
+        on_commit(conn, invalidate)
 
 
 # 订阅模型类
@@ -262,117 +447,95 @@ class Subscription:
         self.auto_renew = auto_renew
         self.is_active = True
 
-    def save(self):
+    def save(self, conn=None):
         """
-        保存订阅信息
+        保存订阅信息（与用户VIP状态的更新在同一事务中提交）
         """
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """INSERT INTO subscriptions 
-                    (user_id, plan_type, start_date, end_date, is_active, auto_renew) 
-                    VALUES (%s, %s, %s, %s, %s, %s)""",
-                    (self.user_id, self.plan_type, self.start_date, self.end_date,
-                     self.is_active, self.auto_renew)
-                )
-                subscription_id = cursor.lastrowid
-                conn.commit()
+        with transaction(conn) as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO subscriptions 
+                (user_id, plan_type, start_date, end_date, is_active, auto_renew) 
+                VALUES (%s, %s, %s, %s, %s, %s)""",
+                (self.user_id, self.plan_type, self.start_date, self.end_date,
+                 self.is_active, self.auto_renew)
+            )
+            subscription_id = cursor.lastrowid
 
-                # 更新用户VIP状态
-                User.update_vip_status(self.user_id, True, self.end_date)
+            # 更新用户VIP状态
+            User.update_vip_status(self.user_id, True, self.end_date, conn=conn)
 
-                return subscription_id
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+            return subscription_id
 
     @staticmethod
-    def get_active_by_user_id(user_id):
+    def get_active_by_user_id(user_id, conn=None):
         """
         获取用户的活跃订阅
         """
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """SELECT * FROM subscriptions 
-                    WHERE user_id = %s AND is_active = TRUE 
-                    ORDER BY end_date DESC LIMIT 1""",
-                    (user_id,)
-                )
-                return cursor.fetchone()
-        finally:
-            conn.close()
+        with read_transaction(conn) as conn, conn.cursor(RowCursor) as cursor:
+            cursor.execute(
+                """SELECT * FROM subscriptions 
+                WHERE user_id = %s AND is_active = TRUE 
+                ORDER BY end_date DESC LIMIT 1""",
+                (user_id,)
+            )
+            return cursor.fetchone()
 
     @staticmethod
-    def cancel_subscription(subscription_id):
+    def cancel_subscription(subscription_id, conn=None):
         """
         取消订阅
         """
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                # 获取订阅信息
-                cursor.execute(
-                    "SELECT user_id FROM subscriptions WHERE id = %s",
-                    (subscription_id,)
-                )
-                subscription = cursor.fetchone()
-
-                if not subscription:
-                    return False
-
-                # 更新订阅状态
-                cursor.execute(
-                    """UPDATE subscriptions 
-                    SET is_active = FALSE, auto_renew = FALSE 
-                    WHERE id = %s""",
-                    (subscription_id,)
-                )
-
-                # 检查用户是否还有其他活跃订阅
-                cursor.execute(
-                    """SELECT COUNT(*) as count FROM subscriptions 
-                    WHERE user_id = %s AND is_active = TRUE""",
-                    (subscription['user_id'],)
-                )
-                result = cursor.fetchone()
-
-                # 如果没有其他活跃订阅，更新用户VIP状态
-                if result['count'] == 0:
-                    User.update_vip_status(subscription['user_id'], False, None)
-
-                conn.commit()
-                return True
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+        with transaction(conn) as conn, conn.cursor() as cursor:
+            # 获取订阅信息
+            cursor.execute(
+                "SELECT user_id FROM subscriptions WHERE id = %s",
+                (subscription_id,)
+            )
+            subscription = cursor.fetchone()
+
+            if not subscription:
+                return False
+
+            # 更新订阅状态
+            cursor.execute(
+                """UPDATE subscriptions 
+                SET is_active = FALSE, auto_renew = FALSE 
+                WHERE id = %s""",
+                (subscription_id,)
+            )
+
+            # 检查用户是否还有其他活跃订阅
+            cursor.execute(
+                """SELECT COUNT(*) as count FROM subscriptions 
+                WHERE user_id = %s AND is_active = TRUE""",
+                (subscription['user_id'],)
+            )
+            result = cursor.fetchone()
+
+            # 如果没有其他活跃订阅，更新用户VIP状态
+            if result['count'] == 0:
+                User.update_vip_status(subscription['user_id'], False, None, conn=conn)
+            else:
+                User._invalidate_cache(conn, user_id=subscription['user_id'])
+
+            return True
 
     @staticmethod
-    def get_expiring_subscriptions(days=3):
+    def get_expiring_subscriptions(days=3, conn=None):
         """
         获取即将到期的订阅（用于发送提醒）
         """
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                expiry_date = datetime.datetime.now() + datetime.timedelta(days=days)
-                cursor.execute(
-                    """SELECT s.*, u.telegram_id, u.email 
-                    FROM subscriptions s 
-                    JOIN users u ON s.user_id = u.id 
-                    WHERE s.is_active = TRUE 
-                    AND s.end_date BETWEEN NOW() AND %s""",
-                    (expiry_date,)
-                )
-                return cursor.fetchall()
-        finally:
-            conn.close()
+        with read_transaction(conn) as conn, conn.cursor(RowCursor) as cursor:
+            expiry_date = datetime.datetime.now() + datetime.timedelta(days=days)
+            cursor.execute(
+                """SELECT s.*, u.telegram_id, u.email 
+                FROM subscriptions s 
+                JOIN users u ON s.user_id = u.id 
+                WHERE s.is_active = TRUE 
+                AND s.end_date BETWEEN NOW() AND %s""",
+                (expiry_date,)
+            )
+            return cursor.fetchall()
 
 
 # 支付模型类
@@ -387,63 +550,31 @@ class Payment:
         self.transaction_id = None
         self.payment_data = {}
 
-    def save(self):
+    def save(self, conn=None):
         """
         保存支付记录
         """
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """INSERT INTO payments 
-                    (user_id, subscription_id, payment_type, amount, currency, status, transaction_id, payment_data) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
-                    (self.user_id, self.subscription_id, self.payment_type, self.amount,
-                     self.currency, self.status, self.transaction_id,
-                     json.dumps(self.payment_data) if self.payment_data else None)
-                )
-                payment_id = cursor.lastrowid
-                conn.commit()
-                return payment_id
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+        with transaction(conn) as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO payments 
+                (user_id, subscription_id, payment_type, amount, currency, status, transaction_id, payment_data) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                (self.user_id, self.subscription_id, self.payment_type, self.amount,
+                 self.currency, self.status, self.transaction_id,
+                 json.dumps(self.payment_data) if self.payment_data else None)
+            )
+            return cursor.lastrowid
 
     @staticmethod
-    def get_by_telegram_id(telegram_id):
+    def get_by_telegram_id(telegram_id, conn=None):
         """
         通过Telegram ID获取用户
         """
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    "SELECT * FROM users WHERE telegram_id = %s",
-                    (telegram_id,)
-                )
-                return cursor.fetchone()
-        finally:
-            conn.close()
+        return User.get_by_telegram_id(telegram_id, conn=conn)
 
     @staticmethod
-    def update_vip_status(user_id, is_vip, subscription_end_date=None):
+    def update_vip_status(user_id, is_vip, subscription_end_date=None, conn=None):
         """
         更新用户VIP状态
         """
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """UPDATE users 
-                    SET is_vip = %s, subscription_end_date = %s 
-                    WHERE id = %s""",
-                    (is_vip, subscription_end_date, user_id)
-                )
-                conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+        User.update_vip_status(user_id, is_vip, subscription_end_date, conn=conn)
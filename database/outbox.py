@@ -0,0 +1,355 @@
+# 通知本地发件箱（数据库不可用时暂存通知，恢复后批量回放）
+
+import atexit
+import datetime
+import json
+import os
+import threading
+import time
+import uuid
+import zlib
+
+import pymysql
+
+from config import (
+    OUTBOX_PATH, OUTBOX_SEGMENT_MAX_BYTES, OUTBOX_FSYNC_INTERVAL,
+    OUTBOX_REPLAY_INTERVAL, OUTBOX_REPLAY_BATCH_SIZE
+)
+from database.db_manager import DatabaseManager
+from database.pool import PoolTimeoutError
+
+# 表示数据库暂时不可用的异常，出现时通知写入发件箱
+DB_UNAVAILABLE_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError, PoolTimeoutError)
+
+# 段文件后缀：正在写入 / 已封存等待回放 / 正在回放
+ACTIVE_SUFFIX = '.log'
+SEALED_SUFFIX = '.sealed'
+REPLAYING_SUFFIX = '.replaying'
+
+# 全局发件箱（首次使用时创建）
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def new_dedupe_key():
+    """
+    生成通知的dedupe_key
+    """
+    return uuid.uuid4().hex
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class NotificationOutbox:
+    """
+    只追加的本地通知发件箱
+
+    通知以一行一条记录（CRC32 + JSON）追加到段文件，段文件超过segment_max_bytes后封存并新建；
+    append()只做一次write系统调用，durable=True时等待后台线程fsync。
+    后台线程每隔fsync_interval秒把这段时间内的所有追加合并为一次fsync（组提交），
+    并每隔replay_interval秒尝试把已封存的段批量回放到数据库，回放成功后删除段文件。
+
+    每条记录带有唯一的dedupe_key，回放用INSERT IGNORE写入，
+    回放中途失败或进程崩溃后重新回放不会产生重复的通知。
+    同一目录可以被同一台主机上的多个进程共用：段文件名中带有进程号，
+    回放前通过重命名认领段文件；进程退出后遗留的段在下次启动时重新封存。
+
+    参数:
+        path: 发件箱目录
+        segment_max_bytes: 单个段文件的最大字节数
+        fsync_interval: 组提交的间隔秒数
+        replay_interval: 尝试回放的间隔秒数
+        replay_batch_size: 每次回放写入的通知数量
+    """
+
+    def __init__(self, path=OUTBOX_PATH, segment_max_bytes=OUTBOX_SEGMENT_MAX_BYTES,
+                 fsync_interval=OUTBOX_FSYNC_INTERVAL, replay_interval=OUTBOX_REPLAY_INTERVAL,
+                 replay_batch_size=OUTBOX_REPLAY_BATCH_SIZE):
+        self.path = path
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_interval = fsync_interval
+        self.replay_interval = replay_interval
+        self.replay_batch_size = replay_batch_size
+        self._cond = threading.Condition()
+        self._replay_lock = threading.Lock()
+        self._fd = None
+        self._segment = None
+        self._segment_bytes = 0
+        self._written = 0  # 已写入的记录序号
+        self._synced = 0  # 已fsync的记录序号
+        self._closed = False
+        self._thread = None
+        self._appended = 0
+        self._replayed = 0
+        self._fsyncs = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._recover()
+
+    def append(self, user_id, notification_type, title, content, is_email=False, is_telegram=True,
+               durable=True, dedupe_key=None):
+        """
+        追加一条通知
+
+        参数:
+            durable: 是否等待记录fsync到磁盘后再返回
+            dedupe_key: 通知的dedupe_key，为None时新生成；
+                        直接写入数据库失败后转存时应传入写入时使用的dedupe_key
+
+        返回:
+            记录的dedupe_key
+        """
+        record = {
+            'dedupe_key': dedupe_key or new_dedupe_key(),
+            'user_id': user_id,
+            'type': notification_type,
+            'title': title,
+            'content': content,
+            'is_email': bool(is_email),
+            'is_telegram': bool(is_telegram),
+            'created_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        line = b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("发件箱已关闭")
+            if self._fd is None or self._segment_bytes >= self.segment_max_bytes:
+                self._rotate()
+            os.write(self._fd, line)
+            self._segment_bytes += len(line)
+            self._written += 1
+            self._appended += 1
+            seq = self._written
+            self._start()
+            self._cond.notify_all()
+
+            if durable:
+                while self._synced < seq and not self._closed:
+                    self._cond.wait()
+        return record['dedupe_key']
+
+    def replay(self):
+        """
+        把已封存的段回放到数据库，返回回放的记录数
+        回放失败时段文件保留，下次继续回放
+        """
+        with self._replay_lock:
+            replayed = 0
+            for name in sorted(os.listdir(self.path)):
+                if not name.endswith(SEALED_SUFFIX):
+                    continue
+                sealed = os.path.join(self.path, name)
+                claimed = f"{sealed[:-len(SEALED_SUFFIX)]}.{os.getpid()}{REPLAYING_SUFFIX}"
+                try:
+                    os.rename(sealed, claimed)
+                except FileNotFoundError:
+                    # 已被其他进程认领
+                    continue
+
+                try:
+                    records = list(self.read_segment(claimed))
+                    for start in range(0, len(records), self.replay_batch_size):
+                        DatabaseManager.insert_spooled_notifications(records[start:start + self.replay_batch_size])
+                except Exception:
+                    os.rename(claimed, sealed)
+                    raise
+
+                os.unlink(claimed)
+                replayed += len(records)
+
+            with self._cond:
+                self._replayed += replayed
+            return replayed
+
+    def flush(self):
+        """
+        封存当前段并立即回放（如确认数据库已恢复时）
+        """
+        with self._cond:
+            if self._segment_bytes:
+                self._seal()
+        return self.replay()
+
+    def pending_segments(self):
+        """
+        等待回放的段数量（包括当前正在写入的段）
+        """
+        return sum(
+            1 for name in os.listdir(self.path)
+            if name.endswith(SEALED_SUFFIX) or (name.endswith(ACTIVE_SUFFIX) and self._owns(name))
+        )
+
+    def stats(self):
+        """
+        获取追加、fsync和回放的统计信息
+        """
+        with self._cond:
+            return {
+                'appended': self._appended,
+                'fsyncs': self._fsyncs,
+                'replayed': self._replayed,
+                'unsynced': self._written - self._synced,
+            }
+
+    def close(self, timeout=10):
+        """
+        fsync并关闭当前段（不回放，下次启动后继续回放）
+        """
+        with self._cond:
+            if self._closed:
+                return
+            if self._segment_bytes:
+                self._seal()
+            elif self._fd is not None:
+                os.close(self._fd)
+                os.unlink(self._segment)
+                self._fd = None
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @staticmethod
+    def read_segment(path):
+        """
+        逐条读取段文件中的记录，跳过校验失败的行（如崩溃时写了一半的最后一行）
+        """
+        with open(path, 'rb') as f:
+            for line_no, line in enumerate(f, 1):
+                try:
+                    crc, payload = line.rstrip(b'\n').split(b' ', 1)
+                    if int(crc, 16) != zlib.crc32(payload):
+                        raise ValueError("CRC校验失败")
+                    yield json.loads(payload)
+                except ValueError as e:
+                    print(f"跳过发件箱损坏的记录 {path}:{line_no}: {e}")
+
+    def _rotate(self):
+        """
+        封存当前段（如果有）并新建一个段，调用方需持有self._cond
+        """
+        if self._fd is not None:
+            self._seal()
+        name = f"{time.time_ns():020d}-{os.getpid()}{ACTIVE_SUFFIX}"
+        self._segment = os.path.join(self.path, name)
+        self._fd = os.open(self._segment, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._segment_bytes = 0
+
+    def _seal(self):
+        """
+        fsync并关闭当前段，改名为已封存，调用方需持有self._cond
+        """
+        os.fsync(self._fd)
+        os.close(self._fd)
+        os.rename(self._segment, self._segment[:-len(ACTIVE_SUFFIX)] + SEALED_SUFFIX)
+        self._fsync_dir()
+        self._fd = None
+        self._segment = None
+        self._segment_bytes = 0
+        self._mark_synced()
+
+    def _mark_synced(self, target=None):
+        self._synced = max(self._synced, self._written if target is None else target)
+        self._fsyncs += 1
+        self._cond.notify_all()
+
+    def _fsync_dir(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _owns(self, name):
+        return name.split('.')[0].endswith(f"-{os.getpid()}")
+
+    def _recover(self):
+        """
+        重新封存已退出进程遗留的段：未封存的段和回放到一半的段
+        """
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            base = name.split('.')[0]
+            if name.endswith(ACTIVE_SUFFIX):
+                owner = int(base.rsplit('-', 1)[1])
+            elif name.endswith(REPLAYING_SUFFIX):
+                owner = int(name.split('.')[1])
+            else:
+                continue
+            if owner != os.getpid() and _pid_alive(owner):
+                continue
+            if os.path.getsize(path) == 0:
+                os.unlink(path)
+            else:
+                os.rename(path, os.path.join(self.path, base + SEALED_SUFFIX))
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='notification-outbox', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # 启动后先回放一次之前遗留的段
+        next_replay = time.monotonic()
+        while True:
+            with self._cond:
+                while (not self._closed and self._synced == self._written
+                       and time.monotonic() < next_replay):
+                    self._cond.wait(max(0.0, next_replay - time.monotonic()))
+                if self._closed:
+                    return
+                dirty = self._synced < self._written
+
+            if dirty:
+                # 等待一小段时间，让这段时间内的追加合并为一次fsync
+                time.sleep(self.fsync_interval)
+                with self._cond:
+                    if self._fd is None or self._synced >= self._written:
+                        fd = None
+                    else:
+                        # 在复制的文件描述符上fsync，不阻塞追加，也不受段轮换影响
+                        fd, target = os.dup(self._fd), self._written
+                if fd is not None:
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                    with self._cond:
+                        self._mark_synced(target)
+
+            if time.monotonic() >= next_replay:
+                next_replay = time.monotonic() + self.replay_interval
+                try:
+                    if self.pending_segments():
+                        replayed = self.flush()
+                        if replayed:
+                            print(f"发件箱已回放{replayed}条通知")
+                except DB_UNAVAILABLE_ERRORS as e:
+                    print(f"数据库仍不可用，稍后重新回放发件箱: {e}")
+                except Exception as e:
+                    print(f"回放发件箱失败: {e}")
+
+
+def get_outbox():
+    """
+    获取全局通知发件箱（进程退出时关闭），启动时回放已有的段
+    """
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                outbox = NotificationOutbox()
+                atexit.register(outbox.close)
+                outbox._start()
+                _outbox = outbox
+    return _outbox
@@ -0,0 +1,295 @@
+# 数据库连接池
+
+import collections
+import threading
+import time
+
+# MySQL服务端状态标志：当前连接处于事务中
+SERVER_STATUS_IN_TRANS = 1
+
+
+class PoolTimeoutError(Exception):
+    """
+    等待可用连接超时
+    """
+
+
+class PooledConnection:
+    """
+    连接池中的连接包装类
+    除close()外的所有属性和方法都代理到底层连接，close()会把连接归还给连接池
+    """
+
+    def __init__(self, pool, raw_connection):
+        self._pool = pool
+        self._raw = raw_connection
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def raw_connection(self):
+        return self._raw
+
+    def close(self):
+        """
+        归还连接到连接池（重复调用无副作用）
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._pool.release(self._raw)
+
+
+class ConnectionPool:
+    """
+    有界、线程安全的数据库连接池
+
+    参数:
+        connect: 创建新连接的函数
+        min_size: 预先建立并保持的最小空闲连接数
+        max_size: 最大连接数（使用中 + 空闲）
+        idle_timeout: 空闲连接最长保留秒数，超过后关闭
+        wait_timeout: 连接耗尽时获取连接的最长等待秒数
+        ping_interval: 空闲超过该秒数的连接在取出时先ping检测，为0时每次取出都检测
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, idle_timeout=300, wait_timeout=10, ping_interval=30):
+        if max_size < 1:
+            raise ValueError("max_size必须大于0")
+        self._connect = connect
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.ping_interval = ping_interval
+
+        self._lock = threading.Condition()
+        self._idle = collections.deque()  # (连接, 归还时间)
+        self._size = 0
+        self._in_use = 0
+        self._waiters = 0
+
+        # 统计信息
+        self._created = 0
+        self._discarded = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def fill(self):
+        """
+        预先建立min_size个空闲连接
+        """
+        while True:
+            with self._lock:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self._size -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                self._created += 1
+                self._idle.append((conn, time.monotonic()))
+                self._lock.notify()
+
+    def acquire(self):
+        """
+        从连接池获取连接，返回PooledConnection
+        """
+        start = time.monotonic()
+        deadline = start + self.wait_timeout
+        while True:
+            conn, idle_since, create = self._checkout(deadline)
+
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+                with self._lock:
+                    self._created += 1
+            elif not self._is_healthy(conn, idle_since):
+                self._discard(conn)
+                continue
+
+            self._record_checkout(time.monotonic() - start)
+            return PooledConnection(self, conn)
+
+    def release(self, conn):
+        """
+        归还连接，未提交的事务会被回滚
+        """
+        try:
+            if self._in_transaction(conn):
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+
+        with self._lock:
+            self._in_use -= 1
+            if self._size > self.max_size:
+                # 连接池已被缩小，直接关闭多余连接
+                self._size -= 1
+                self._discarded += 1
+                self._lock.notify()
+                self._close_quietly(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    def close_all(self):
+        """
+        关闭所有空闲连接（使用中的连接归还后仍会进入连接池）
+        """
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._lock.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        """
+        获取连接池统计信息
+        """
+        with self._lock:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiters': self._waiters,
+                'max_size': self.max_size,
+                'created': self._created,
+                'discarded': self._discarded,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'avg_checkout_ms': (self._wait_total / self._checkouts * 1000) if self._checkouts else 0.0,
+                'max_checkout_ms': self._wait_max * 1000,
+            }
+
+    def _checkout(self, deadline):
+        """
+        取出一个空闲连接或预留一个新建名额
+        返回 (连接, 空闲开始时间, 是否需要新建)
+        """
+        with self._lock:
+            while True:
+                expired = self._evict_expired()
+                if expired:
+                    # 在锁外关闭过期连接
+                    self._lock.release()
+                    try:
+                        for conn in expired:
+                            self._close_quietly(conn)
+                    finally:
+                        self._lock.acquire()
+                    continue
+
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    self._in_use += 1
+                    return conn, idle_since, False
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    self._in_use += 1
+                    return None, None, True
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(
+                        f"获取数据库连接超时（{self.wait_timeout}秒），使用中连接数: {self._in_use}"
+                    )
+                self._waiters += 1
+                try:
+                    self._lock.wait(remaining)
+                finally:
+                    self._waiters -= 1
+
+    def _evict_expired(self):
+        """
+        移除空闲超时的连接（调用方需持有锁），保留min_size个
+        """
+        if not self.idle_timeout:
+            return []
+        now = time.monotonic()
+        expired = []
+        # 最早归还的连接在队列左侧
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self._discarded += 1
+            expired.append(conn)
+        return expired
+
+    def _is_healthy(self, conn, idle_since):
+        """
+        空闲时间超过ping_interval的连接取出前先ping检测
+        """
+        if time.monotonic() - idle_since < self.ping_interval:
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        """
+        丢弃失效的使用中连接
+        """
+        self._close_quietly(conn)
+        with self._lock:
+            self._discarded += 1
+        self._forget()
+
+    def _forget(self):
+        """
+        释放一个使用中名额
+        """
+        with self._lock:
+            self._size -= 1
+            self._in_use -= 1
+            self._lock.notify()
+
+    def _record_checkout(self, waited):
+        with self._lock:
+            self._checkouts += 1
+            self._wait_total += waited
+            if waited > self._wait_max:
+                self._wait_max = waited
+
+    @staticmethod
+    def _in_transaction(conn):
+        """
+        根据服务端状态判断连接是否有未结束的事务，无法判断时按有事务处理
+        """
+        server_status = getattr(conn, 'server_status', None)
+        if server_status is None:
+            return True
+        return bool(server_status & SERVER_STATUS_IN_TRANS)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -0,0 +1,155 @@
+# 读写分离（只读副本路由）
+
+import itertools
+import threading
+import time
+
+
+class Replica:
+    """
+    一个只读副本及其健康状态
+    """
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.lag = None
+        self.healthy = False
+        self.checked_at = None
+        self.reads = 0
+        self.errors = 0
+        self._check_lock = threading.Lock()
+
+
+class ReplicaRouter:
+    """
+    只读查询路由器
+
+    读查询轮询分配到复制延迟不超过max_lag的副本；以下情况回退到主库：
+    没有配置副本、所有副本不健康或延迟过大、副本连接失败、
+    当前线程在read_after_write秒内提交过写事务（保证读到自己的写入）。
+
+    参数:
+        replicas: Replica列表
+        max_lag: 允许的最大复制延迟（秒）
+        check_interval: 复制延迟检查间隔（秒）
+        read_after_write: 写入后当前线程的读查询固定走主库的时长（秒）
+    """
+
+    def __init__(self, replicas, max_lag=5, check_interval=10, read_after_write=5):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.read_after_write = read_after_write
+        self._round_robin = itertools.count()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._primary_reads = 0
+
+    def mark_write(self):
+        """
+        记录当前线程刚提交过写事务
+        """
+        self._local.last_write = time.monotonic()
+
+    def acquire_read_connection(self):
+        """
+        获取只读副本连接，应使用主库时返回None
+        """
+        if not self.replicas or self._recently_wrote():
+            self._count_primary_read()
+            return None
+
+        start = next(self._round_robin)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if not self._is_usable(replica):
+                continue
+            try:
+                conn = replica.pool.acquire()
+            except Exception as e:
+                print(f"获取只读副本{replica.name}连接失败: {e}")
+                self._mark_unhealthy(replica)
+                continue
+            with self._lock:
+                replica.reads += 1
+            return conn
+
+        self._count_primary_read()
+        return None
+
+    def stats(self):
+        """
+        获取各副本的延迟、健康状态和读查询数
+        """
+        with self._lock:
+            return {
+                'primary_reads': self._primary_reads,
+                'replicas': [
+                    {
+                        'name': replica.name,
+                        'healthy': replica.healthy,
+                        'lag': replica.lag,
+                        'reads': replica.reads,
+                        'errors': replica.errors,
+                    }
+                    for replica in self.replicas
+                ],
+            }
+
+    def _recently_wrote(self):
+        last_write = getattr(self._local, 'last_write', None)
+        return last_write is not None and time.monotonic() - last_write < self.read_after_write
+
+    def _count_primary_read(self):
+        with self._lock:
+            self._primary_reads += 1
+
+    def _is_usable(self, replica):
+        """
+        按检查间隔刷新副本延迟，返回副本当前是否可用
+        """
+        checked_at = replica.checked_at
+        if checked_at is None or time.monotonic() - checked_at > self.check_interval:
+            # 只有一个线程执行检查，其他线程沿用上次结果
+            if replica._check_lock.acquire(blocking=checked_at is None):
+                try:
+                    self._check(replica)
+                finally:
+                    replica._check_lock.release()
+        return replica.healthy
+
+    def _check(self, replica):
+        """
+        查询副本的复制延迟
+        """
+        try:
+            with replica.pool.acquire() as conn, conn.cursor() as cursor:
+                try:
+                    cursor.execute("SHOW REPLICA STATUS")
+                except Exception:
+                    # MySQL 8.0.22 之前的版本
+                    cursor.execute("SHOW SLAVE STATUS")
+                status = cursor.fetchone()
+
+            if not status:
+                lag = None
+            else:
+                lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+
+            replica.lag = lag
+            # 延迟为NULL表示复制线程已停止
+            replica.healthy = lag is not None and lag <= self.max_lag
+        except Exception as e:
+            print(f"检查只读副本{replica.name}复制延迟失败: {e}")
+            replica.lag = None
+            replica.healthy = False
+            with self._lock:
+                replica.errors += 1
+        replica.checked_at = time.monotonic()
+
+    def _mark_unhealthy(self, replica):
+        replica.healthy = False
+        replica.checked_at = time.monotonic()
+        with self._lock:
+            replica.errors += 1
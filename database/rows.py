@@ -0,0 +1,127 @@
+# 轻量行对象（替代DictCursor返回的dict）
+
+import threading
+
+from pymysql.cursors import Cursor, SSCursor
+
+# 列名元组 -> 行类，相同结构的查询结果共用一个行类
+_row_classes = {}
+_row_classes_lock = threading.Lock()
+
+
+class Row(tuple):
+    """
+    数据库行：底层是tuple，列名只在行类上保存一份，不像dict那样每行都有一张哈希表
+
+    兼容原DictCursor返回值的用法：row['列名']、row.get()、keys()、items()、
+    '列名' in row、dict(row)；同时可以用row.列名访问。
+    需要真正的dict时（如JSON序列化、修改字段）调用as_dict()。
+    注意：迭代行得到的是列值，不是列名。
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        values = ', '.join(f"{name}={value!r}" for name, value in zip(self._fields, self))
+        return f"Row({values})"
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        if index is None:
+            return default
+        return tuple.__getitem__(self, index)
+
+    def keys(self):
+        return self._fields
+
+    def values(self):
+        return tuple(self)
+
+    def items(self):
+        return zip(self._fields, self)
+
+    def as_dict(self):
+        """
+        转换为dict（与DictCursor的返回值相同）
+        """
+        return dict(zip(self._fields, self))
+
+
+def _column_property(index):
+    return property(lambda row: tuple.__getitem__(row, index))
+
+
+def row_class(fields):
+    """
+    获取指定列名元组对应的行类
+    """
+    row_cls = _row_classes.get(fields)
+    if row_cls is not None:
+        return row_cls
+
+    with _row_classes_lock:
+        row_cls = _row_classes.get(fields)
+        if row_cls is None:
+            namespace = {
+                '__slots__': (),
+                '_fields': fields,
+                '_index': {name: index for index, name in enumerate(fields)},
+            }
+            for index, name in enumerate(fields):
+                # 与Row方法同名的列（如get、count）和非标识符列名只能用row['列名']访问
+                if name.isidentifier() and not hasattr(Row, name):
+                    namespace[name] = _column_property(index)
+            row_cls = type('Row', (Row,), namespace)
+            _row_classes[fields] = row_cls
+    return row_cls
+
+
+class RowCursorMixin:
+    """
+    把查询结果转换为Row的游标混入类（列名处理规则与pymysql的DictCursorMixin一致）
+    """
+
+    def _do_get_result(self):
+        super()._do_get_result()
+        fields = []
+        if self.description:
+            for f in self._result.fields:
+                name = f.name
+                if name in fields:
+                    name = f.table_name + "." + name
+                fields.append(name)
+            self._row_cls = row_class(tuple(fields))
+
+        if fields and self._rows:
+            row_cls = self._row_cls
+            self._rows = [tuple.__new__(row_cls, r) for r in self._rows]
+
+    def _conv_row(self, row):
+        if row is None:
+            return None
+        return tuple.__new__(self._row_cls, row)
+
+
+class RowCursor(RowCursorMixin, Cursor):
+    """
+    返回Row的游标
+    """
+
+
+class SSRowCursor(RowCursorMixin, SSCursor):
+    """
+    返回Row的无缓冲游标（逐行从服务器读取，用于遍历大结果集）
+    """
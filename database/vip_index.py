@@ -0,0 +1,306 @@
+# VIP权益内存索引
+
+import datetime
+import heapq
+import threading
+import time
+from array import array
+
+from config import VIP_INDEX_REFRESH_INTERVAL, DB_USER_PAGE_SIZE
+
+# 无到期时间（永久VIP）
+NO_EXPIRY = float('inf')
+
+# 后台重新加载失败后，至少间隔这么多秒再重试
+VIP_INDEX_RETRY_DELAY = 30
+
+
+def _to_timestamp(expiry):
+    if expiry is None:
+        return NO_EXPIRY
+    if isinstance(expiry, datetime.datetime):
+        return expiry.timestamp()
+    return float(expiry)
+
+
+def _to_datetime(timestamp):
+    if timestamp == NO_EXPIRY:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp)
+
+
+class VipIndex:
+    """
+    内存中的VIP权益索引
+
+    telegram_id映射到槽位，槽位里保存到期时间戳（array('d')，每个用户8字节）；
+    另有一个按到期时间排序的最小堆，到期的条目在查询时按堆顶顺序批量清除，无需查询数据库。
+    堆采用惰性删除：续期或撤销时不修改堆，出堆时与槽位中的当前值比对，不一致即丢弃。
+
+    load()读取数据期间到达的grant()/revoke()同时记入日志，新索引换入后按顺序重放，
+    加载期间提交的激活或撤销不会因为读取时机（或读到的快照较旧）而丢失。
+
+    请求路径上调用ensure_loaded()：首次加载在调用线程中完成，之后超过刷新间隔时
+    只启动一个后台线程重新加载，请求线程继续查询原索引，不等待。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}          # telegram_id -> 槽位
+        self._expiries = array('d')
+        self._free_slots = []
+        self._heap = []           # (到期时间戳, telegram_id)
+        self._telegram_ids = {}   # 用户ID -> telegram_id
+        self._journal = None      # 加载期间的 (操作, telegram_id, 到期时间戳, 用户ID)
+        self._load_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._reload_thread = None
+        self._reload_started_at = None
+        self.loaded_at = None
+
+    def load(self, entries):
+        """
+        用 (telegram_id, 到期时间, 用户ID) 序列整体重建索引
+        同一telegram_id出现多次时取最晚的到期时间
+        """
+        with self._lock:
+            self._journal = []
+        try:
+            self._load(entries)
+        finally:
+            with self._lock:
+                self._journal = None
+
+    def reload(self, source):
+        """
+        用source()返回的 (telegram_id, 到期时间, 用户ID) 序列重新加载，失败时保留原索引并返回False
+        """
+        try:
+            self.load(source())
+            return True
+        except Exception as e:
+            print(f"加载VIP索引失败: {e}")
+            return False
+
+    def ensure_loaded(self, source):
+        """
+        确保索引已加载，首次加载失败时返回False
+
+        首次加载在调用线程中完成（并发的请求等待同一次加载）；之后超过刷新间隔时
+        在后台线程重新加载，同一时间只有一个加载线程，失败后至少间隔VIP_INDEX_RETRY_DELAY秒再重试
+        """
+        if self.loaded_at is None:
+            with self._load_lock:
+                if self.loaded_at is None:
+                    return self.reload(source)
+            return True
+
+        if self.is_stale():
+            self._start_background_reload(source)
+        return True
+
+    def _start_background_reload(self, source):
+        with self._reload_lock:
+            if self._reload_thread is not None and self._reload_thread.is_alive():
+                return
+            now = time.monotonic()
+            if self._reload_started_at is not None and now - self._reload_started_at < VIP_INDEX_RETRY_DELAY:
+                return
+            self._reload_started_at = now
+            self._reload_thread = threading.Thread(
+                target=self.reload, args=(source,), name='vip-index-reload', daemon=True
+            )
+            self._reload_thread.start()
+
+    def _load(self, entries):
+        slots = {}
+        expiries = array('d')
+        heap = []
+        telegram_ids = {}
+        now = time.time()
+
+        for telegram_id, expiry, user_id in entries:
+            timestamp = _to_timestamp(expiry)
+            if user_id is not None:
+                telegram_ids[user_id] = telegram_id
+            if timestamp <= now:
+                continue
+            slot = slots.get(telegram_id)
+            if slot is None:
+                slots[telegram_id] = len(expiries)
+                expiries.append(timestamp)
+            elif timestamp > expiries[slot]:
+                expiries[slot] = timestamp
+            else:
+                continue
+            if timestamp != NO_EXPIRY:
+                heap.append((timestamp, telegram_id))
+
+        heapq.heapify(heap)
+        with self._lock:
+            journal = self._journal
+            self._slots = slots
+            self._expiries = expiries
+            self._free_slots = []
+            self._heap = heap
+            self._telegram_ids = telegram_ids
+            self._journal = None
+            # 重放加载期间的修改
+            for action, telegram_id, timestamp, user_id in journal or ():
+                if action == 'grant':
+                    self._grant(telegram_id, timestamp, user_id)
+                else:
+                    self._release(telegram_id)
+            self.loaded_at = time.monotonic()
+
+    def grant(self, telegram_id, expiry, user_id=None):
+        """
+        授予或续期VIP，expiry为None表示永久
+        """
+        timestamp = _to_timestamp(expiry)
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append(('grant', telegram_id, timestamp, user_id))
+            self._grant(telegram_id, timestamp, user_id)
+
+    def revoke(self, telegram_id):
+        """
+        撤销VIP
+        """
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append(('revoke', telegram_id, None, None))
+            self._release(telegram_id)
+
+    def lookup(self, telegram_id):
+        """
+        查询VIP状态，返回 (是否VIP, 到期时间)
+        """
+        with self._lock:
+            self._expire(time.time())
+            slot = self._slots.get(telegram_id)
+            if slot is None:
+                return False, None
+            return True, _to_datetime(self._expiries[slot])
+
+    def is_vip(self, telegram_id):
+        return self.lookup(telegram_id)[0]
+
+    def telegram_id_for(self, user_id):
+        """
+        查询用户ID对应的telegram_id（未记录时返回None）
+        """
+        with self._lock:
+            return self._telegram_ids.get(user_id)
+
+    def is_stale(self):
+        """
+        索引是否需要（重新）加载
+        """
+        if self.loaded_at is None:
+            return True
+        if not VIP_INDEX_REFRESH_INTERVAL:
+            return False
+        return time.monotonic() - self.loaded_at > VIP_INDEX_REFRESH_INTERVAL
+
+    def stats(self):
+        with self._lock:
+            return {
+                'vip_count': len(self._slots),
+                'heap_size': len(self._heap),
+                'free_slots': len(self._free_slots),
+                'loaded': self.loaded_at is not None,
+            }
+
+    def _expire(self, now):
+        """
+        清除所有已到期的条目（调用方需持有锁）
+        """
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            timestamp, telegram_id = heapq.heappop(heap)
+            slot = self._slots.get(telegram_id)
+            # 续期后旧的堆条目已失效
+            if slot is not None and self._expiries[slot] == timestamp:
+                self._release(telegram_id)
+
+    def _grant(self, telegram_id, timestamp, user_id):
+        """
+        写入或更新槽位（调用方需持有锁）
+        """
+        if user_id is not None:
+            self._telegram_ids[user_id] = telegram_id
+
+        slot = self._slots.get(telegram_id)
+        if slot is None:
+            if self._free_slots:
+                slot = self._free_slots.pop()
+                self._expiries[slot] = timestamp
+            else:
+                slot = len(self._expiries)
+                self._expiries.append(timestamp)
+            self._slots[telegram_id] = slot
+        else:
+            self._expiries[slot] = timestamp
+
+        if timestamp != NO_EXPIRY:
+            heapq.heappush(self._heap, (timestamp, telegram_id))
+
+    def _release(self, telegram_id):
+        slot = self._slots.pop(telegram_id, None)
+        if slot is not None:
+            self._free_slots.append(slot)
+
+
+# 全局VIP索引（数据来自MySQL的subscriptions和users表）
+vip_index = VipIndex()
+
+
+def iter_vip_entries(page_size=DB_USER_PAGE_SIZE):
+    """
+    从主库按用户ID分页读取VIP权益，产出 (telegram_id, 到期时间, 用户ID)
+
+    到期时间取用户有效订阅中最晚的end_date；
+    users表中is_vip为真且没有到期时间的用户是永久VIP
+    """
+    from database.models import read_transaction
+
+    queries = [
+        # 有效订阅，走subscriptions的 (user_id, is_active, end_date) 索引
+        """SELECT s.user_id, u.telegram_id, MAX(s.end_date) AS end_date
+        FROM subscriptions s
+        JOIN users u ON u.id = s.user_id
+        WHERE s.is_active = TRUE AND s.end_date > NOW() AND s.user_id > %s
+        GROUP BY s.user_id, u.telegram_id
+        ORDER BY s.user_id LIMIT %s""",
+        # 永久VIP
+        """SELECT id AS user_id, telegram_id, NULL AS end_date FROM users
+        WHERE is_vip = TRUE AND subscription_end_date IS NULL AND id > %s
+        ORDER BY id LIMIT %s""",
+    ]
+    for query in queries:
+        last_user_id = 0
+        while True:
+            # 每页单独读取，避免长事务；读主库，刚提交的激活不会因副本延迟而缺失
+            with read_transaction(primary=True) as conn, conn.cursor() as cursor:
+                cursor.execute(query, (last_user_id, page_size))
+                rows = cursor.fetchall()
+            for row in rows:
+                yield row['telegram_id'], row['end_date'], row['user_id']
+            if len(rows) < page_size:
+                break
+            last_user_id = rows[-1]['user_id']
+
+
+def reload_vip_index():
+    """
+    重新加载VIP索引，失败时保留原索引并返回False
+    """
+    return vip_index.reload(iter_vip_entries)
+
+
+def ensure_vip_index_loaded():
+    """
+    确保VIP索引已加载，首次加载失败时返回False（见VipIndex.ensure_loaded）
+    """
+    return vip_index.ensure_loaded(iter_vip_entries)
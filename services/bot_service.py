@@ -27,6 +27,12 @@ from telegram.ext import (
 )
 from apscheduler.schedulers.background import BackgroundScheduler
 
+# 导入本地模块
+from database.vip_index import VipIndex
+
+# VIP状态内存索引，数据来自subscriptions.db
+vip_index = VipIndex()
+
 
 # ===== 邮件服务功能 =====
 
@@ -93,6 +99,33 @@ def update_user_subscription(user_id, duration_months=1):
     conn.commit()
     conn.close()
 
+    # 同步更新内存索引（数据库只保存到日期）
+    vip_index.grant(user_id, datetime.strptime(expiration_date.strftime('%Y-%m-%d'), '%Y-%m-%d'))
+
+
+def iter_vip_entries():
+    """
+    从数据库读取所有VIP用户及其到期日期，产出 (user_id, 到期时间, None)
+    """
+    conn = sqlite3.connect('subscriptions.db')
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id, vip_expiration_date FROM users WHERE is_vip = 1')
+        for user_id, expiration_date in cursor:
+            yield user_id, datetime.strptime(expiration_date, '%Y-%m-%d') if expiration_date else None, None
+    finally:
+        conn.close()
+
+
+def load_vip_index():
+    """
+    从数据库加载VIP状态内存索引
+
+    说明:
+        一次性读取所有VIP用户及其到期日期，之后的VIP检查只查询内存
+    """
+    return vip_index.reload(iter_vip_entries)
+
 
 def check_vip_status(user_id):
     """
@@ -105,28 +138,13 @@ def check_vip_status(user_id):
         bool: 用户是否为有效VIP会员
 
     说明:
-        查询数据库判断用户是否为VIP会员且未过期
+        查询内存VIP索引判断用户是否为VIP会员且未过期，
+        到期的用户会被索引自动移除，无需查询数据库；
+        索引超过刷新间隔时在后台线程重新加载，本次检查不等待
     """
-    conn = sqlite3.connect('subscriptions.db')
-    cursor = conn.cursor()
+    vip_index.ensure_loaded(iter_vip_entries)
 
-    # 查询用户VIP状态
-    cursor.execute('SELECT is_vip, vip_expiration_date FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-
-    if user:
-        is_vip, expiration_date = user
-        if is_vip:
-            # 检查是否过期
-            expiration_date = datetime.strptime(expiration_date, '%Y-%m-%d')
-            if expiration_date < datetime.now():
-                return False
-            else:
-                return True
-        else:
-            return False
-    else:
-        return False
+    return vip_index.is_vip(user_id)
 
 
 # ===== 支付处理功能 =====
@@ -246,6 +264,8 @@ def unsubscribe(update: Update, context: CallbackContext) -> None:
     conn.commit()
     conn.close()
 
+    vip_index.revoke(user_id)
+
     # 发送确认消息
     update.message.reply_text("您已成功取消VIP订阅。")
 
@@ -373,6 +393,9 @@ def main():
     dispatcher.add_handler(CommandHandler("purchase", send_purchase_confirmation))
     dispatcher.add_handler(CommandHandler("special_offer", send_special_offer))
 
+    # 加载VIP状态内存索引
+    load_vip_index()
+
     # 设置定时任务调度器
     scheduler = setup_scheduler(bot)
 
@@ -0,0 +1,344 @@
+# 消息群发（按页并发发送，断点续传）
+
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import BROADCAST_CONCURRENCY, BROADCAST_PAGE_SIZE
+from database.db_manager import DatabaseManager
+from database.models import get_db_connection, read_transaction, transaction
+from services.notification_dispatcher import get_notification_dispatcher
+from services.notification_service import NotificationService
+
+# 群发锁名称前缀，同一条消息同一时间只允许一个进程群发
+BROADCAST_LOCK_PREFIX = 'telegram_vip_bot_broadcast_'
+
+# 检查点中错误原因的最大长度（last_error列）
+BROADCAST_ERROR_MAX_LENGTH = 1000
+
+
+class Broadcast:
+    """
+    一条消息的群发任务
+
+    按user_id顺序分页读取该消息的发送记录（message_deliveries），每页用concurrency个线程
+    并发发送（线程池在本次群发的各页之间共用），限速与通知发送共用（全局令牌桶 + 单聊天间隔 + 429暂停）。
+    每页发送完成后把最后一个user_id和累计的成功、失败数量保存到broadcast_checkpoints，
+    进程崩溃后重新运行时从检查点继续，只有崩溃时正在发送的那一页可能重复发送。
+    群发中途出错时检查点的状态记为failed并保存错误原因，可通过get_progress查看，
+    机器人重启时与未完成的群发一起继续（resume_broadcasts）。
+
+    参数:
+        message_id: 消息ID
+        concurrency: 并发发送的线程数
+        page_size: 每页的发送记录数量
+        on_progress: 每页发送完成后的回调，参数为progress()的结果
+        dispatcher: 通知分发器（提供限速发送），默认使用全局分发器
+    """
+
+    def __init__(self, message_id, concurrency=BROADCAST_CONCURRENCY, page_size=BROADCAST_PAGE_SIZE,
+                 on_progress=None, dispatcher=None):
+        self.message_id = message_id
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.on_progress = on_progress
+        self.dispatcher = dispatcher or get_notification_dispatcher()
+        self.total = 0
+        self.sent = 0
+        self.failed = 0
+        self.status = 'running'
+        self.error = None
+        self._run_base = 0
+        self._run_started = None
+
+    def run(self):
+        """
+        执行（或继续）群发
+
+        返回:
+            群发进度，其他进程正在群发同一条消息时返回None
+        """
+        lock_name = f"{BROADCAST_LOCK_PREFIX}{self.message_id}"
+        lock_conn = get_db_connection()
+        try:
+            with lock_conn.cursor() as cursor:
+                cursor.execute("SELECT GET_LOCK(%s, 0) AS locked", (lock_name,))
+                if not cursor.fetchone()['locked']:
+                    print(f"消息{self.message_id}正在由其他进程群发")
+                    return None
+
+            try:
+                return self._run()
+            except Exception as e:
+                self._save_failure(e)
+                raise e
+            finally:
+                with lock_conn.cursor() as cursor:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (lock_name,))
+        finally:
+            lock_conn.close()
+
+    def progress(self):
+        """
+        获取群发进度：状态、总数、成功、失败、剩余、发送速率（条/秒）、预计剩余秒数和失败原因
+        """
+        processed = self.sent + self.failed
+        remaining = max(0, self.total - processed)
+        elapsed = time.monotonic() - self._run_started if self._run_started else 0
+        rate = (processed - self._run_base) / elapsed if elapsed > 0 else 0.0
+        return {
+            'message_id': self.message_id,
+            'status': self.status,
+            'total': self.total,
+            'sent': self.sent,
+            'failed': self.failed,
+            'remaining': remaining,
+            'rate': rate,
+            'eta_seconds': remaining / rate if rate else None,
+            'error': self.error,
+        }
+
+    def _run(self):
+        # 消息和发送记录可能刚刚写入，从主库读取，避免只读副本延迟导致提前结束群发
+        with read_transaction(primary=True) as conn:
+            message = DatabaseManager.execute_query(
+                "SELECT * FROM messages WHERE id = %s", (self.message_id,), fetch_one=True, conn=conn
+            )
+        if not message:
+            raise ValueError(f"消息不存在: {self.message_id}")
+        text = NotificationService.build_telegram_text(message)
+
+        checkpoint = self._load_checkpoint()
+        self.total, self.sent, self.failed = checkpoint['total'], checkpoint['sent'], checkpoint['failed']
+        self.status = checkpoint['status']
+        if self.status == 'completed':
+            return self.progress()
+
+        # 上次失败的群发重新开始运行
+        self.status = 'running'
+        last_user_id = checkpoint['last_user_id']
+        self._run_base = self.sent + self.failed
+        self._run_started = time.monotonic()
+        DatabaseManager.execute_query(
+            """UPDATE broadcast_checkpoints
+            SET status = 'running', last_error = NULL, run_started_at = NOW(), run_processed = %s
+            WHERE message_id = %s""",
+            (self._run_base, self.message_id)
+        )
+        if last_user_id:
+            print(f"消息{self.message_id}从检查点继续群发: 已处理{self._run_base}/{self.total}")
+
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency),
+                                thread_name_prefix=f'broadcast-{self.message_id}') as executor:
+            while True:
+                page = self._fetch_page(last_user_id)
+                if page:
+                    results = list(executor.map(lambda delivery: self._send(delivery, text), page))
+                    sent = sum(1 for ok in results if ok)
+                    self.sent += sent
+                    self.failed += len(results) - sent
+                    last_user_id = page[-1]['user_id']
+
+                if len(page) < self.page_size:
+                    self.status = 'completed'
+                    # 群发期间删除的用户不会被发送，完成时总数以实际处理的数量为准
+                    self.total = self.sent + self.failed
+                self._save_checkpoint(last_user_id)
+
+                progress = self.progress()
+                if self.on_progress:
+                    self.on_progress(progress)
+                else:
+                    self._print_progress(progress)
+                if self.status == 'completed':
+                    return progress
+
+    def _send(self, delivery, text):
+        try:
+            self.dispatcher.deliver_telegram(delivery['telegram_id'], text)
+            return True
+        except Exception as e:
+            print(f"群发消息{self.message_id}给用户{delivery['user_id']}失败: {e}")
+            return False
+
+    def _fetch_page(self, after_user_id):
+        # 走unique_message_user (message_id, user_id) 索引；从主库读取，原因同上
+        with read_transaction(primary=True) as conn:
+            return DatabaseManager.execute_query(
+                """SELECT md.user_id, u.telegram_id
+                FROM message_deliveries md
+                JOIN users u ON u.id = md.user_id
+                WHERE md.message_id = %s AND md.user_id > %s
+                ORDER BY md.user_id LIMIT %s""",
+                (self.message_id, after_user_id, self.page_size), conn=conn
+            )
+
+    def _load_checkpoint(self):
+        """
+        读取检查点，第一次群发时创建；每次运行开始时按当前的发送记录重新统计总数
+        （上次运行之后补写或删除的发送记录会反映在剩余数量和预计时间中）
+        """
+        with transaction() as conn:
+            DatabaseManager.execute_query(
+                """INSERT IGNORE INTO broadcast_checkpoints (message_id) VALUES (%s)""",
+                (self.message_id,), conn=conn
+            )
+            DatabaseManager.execute_query(
+                """UPDATE broadcast_checkpoints
+                SET total = (SELECT COUNT(*) FROM message_deliveries WHERE message_id = %s)
+                WHERE message_id = %s AND status != 'completed'""",
+                (self.message_id, self.message_id), conn=conn
+            )
+            return Broadcast.get_checkpoint(self.message_id, conn=conn)
+
+    def _save_checkpoint(self, last_user_id):
+        DatabaseManager.execute_query(
+            """UPDATE broadcast_checkpoints
+            SET last_user_id = %s, total = %s, sent = %s, failed = %s, status = %s,
+                finished_at = IF(%s = 'completed', NOW(), NULL)
+            WHERE message_id = %s""",
+            (last_user_id, self.total, self.sent, self.failed, self.status, self.status, self.message_id)
+        )
+
+    def _save_failure(self, error):
+        """
+        把检查点标记为failed并记录错误原因（已保存的发送进度不变）
+        """
+        self.status = 'failed'
+        self.error = str(error)[:BROADCAST_ERROR_MAX_LENGTH] or type(error).__name__
+        try:
+            DatabaseManager.execute_query(
+                """UPDATE broadcast_checkpoints SET status = 'failed', last_error = %s
+                WHERE message_id = %s""",
+                (self.error, self.message_id)
+            )
+        except Exception as e:
+            # 数据库不可用时检查点保持running，重启后同样会继续
+            print(f"保存消息{self.message_id}的群发失败状态失败: {e}")
+
+    @staticmethod
+    def _print_progress(progress):
+        eta = progress['eta_seconds']
+        eta_text = f"{int(eta // 60)}分{int(eta % 60)}秒" if eta is not None else "未知"
+        print(
+            f"群发消息{progress['message_id']}: 成功{progress['sent']}，失败{progress['failed']}，"
+            f"剩余{progress['remaining']}，{progress['rate']:.1f}条/秒，预计剩余{eta_text}"
+        )
+
+    @staticmethod
+    def get_checkpoint(message_id, conn=None):
+        """
+        读取群发检查点（不传conn时从只读副本读取）
+        """
+        return DatabaseManager.execute_query(
+            "SELECT * FROM broadcast_checkpoints WHERE message_id = %s",
+            (message_id,), fetch_one=True, conn=conn
+        )
+
+    @staticmethod
+    def get_progress(message_id):
+        """
+        从检查点读取群发进度（可在其他进程中查看），速率按本次运行开始以来的平均值估算
+
+        返回:
+            进度dict，没有群发记录时返回None
+        """
+        checkpoint = DatabaseManager.execute_query(
+            """SELECT *, TIMESTAMPDIFF(SECOND, run_started_at, updated_at) AS run_seconds
+            FROM broadcast_checkpoints WHERE message_id = %s""",
+            (message_id,), fetch_one=True
+        )
+        if not checkpoint:
+            return None
+
+        processed = checkpoint['sent'] + checkpoint['failed']
+        remaining = max(0, checkpoint['total'] - processed) if checkpoint['status'] != 'completed' else 0
+        run_seconds = checkpoint['run_seconds'] or 0
+        rate = (processed - checkpoint['run_processed']) / run_seconds if run_seconds > 0 else 0.0
+        return {
+            'message_id': message_id,
+            'status': checkpoint['status'],
+            'total': checkpoint['total'],
+            'sent': checkpoint['sent'],
+            'failed': checkpoint['failed'],
+            'remaining': remaining,
+            'rate': rate,
+            'eta_seconds': remaining / rate if rate else None,
+            'error': checkpoint['last_error'],
+        }
+
+    @staticmethod
+    def get_unfinished():
+        """
+        获取未完成（进行中或失败）的群发的消息ID列表
+        """
+        rows = DatabaseManager.execute_query(
+            """SELECT message_id FROM broadcast_checkpoints
+            WHERE status IN ('running', 'failed') ORDER BY message_id"""
+        )
+        return [row['message_id'] for row in rows]
+
+
+def start_broadcast(message_id, **kwargs):
+    """
+    在后台线程中群发一条消息，返回线程
+    失败原因记录在检查点中（Broadcast.get_progress）；
+    进程退出或失败后未完成的群发可以通过resume_broadcasts()或命令行继续
+    """
+    def run():
+        broadcast = Broadcast(message_id, **kwargs)
+        try:
+            broadcast.run()
+        except Exception as e:
+            # 群发过程中的失败已记录到检查点，这里只报告没能开始群发的情况（如连接不上数据库）
+            if broadcast.status != 'failed':
+                print(f"群发消息{message_id}失败: {e}")
+
+    thread = threading.Thread(target=run, name=f'broadcast-{message_id}', daemon=True)
+    thread.start()
+    return thread
+
+
+def resume_broadcasts():
+    """
+    依次继续所有未完成（进行中或失败）的群发，返回各消息的群发进度
+    一条消息群发失败时继续下一条，其进度中status为failed、error为失败原因
+    """
+    results = {}
+    for message_id in Broadcast.get_unfinished():
+        broadcast = Broadcast(message_id)
+        try:
+            results[message_id] = broadcast.run()
+        except Exception:
+            results[message_id] = broadcast.progress()
+    return results
+
+
+def resume_broadcasts_in_background():
+    """
+    在后台线程中继续所有未完成的群发（机器人启动时调用），返回线程
+    """
+    def run():
+        try:
+            resume_broadcasts()
+        except Exception as e:
+            print(f"继续未完成的群发失败: {e}")
+
+    thread = threading.Thread(target=run, name='broadcast-resume', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    # 用法: python -m services.broadcast [run <message_id>|resume|status <message_id>]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'resume'
+    if command == 'run' and len(sys.argv) > 2:
+        Broadcast(int(sys.argv[2])).run()
+    elif command == 'resume':
+        resume_broadcasts()
+    elif command == 'status' and len(sys.argv) > 2:
+        print(Broadcast.get_progress(int(sys.argv[2])) or "没有群发记录")
+    else:
+        print(f"未知命令: {' '.join(sys.argv[1:])}")
+        sys.exit(1)
@@ -0,0 +1,176 @@
+# 订阅到期提醒扫描（增量）
+
+import datetime
+import math
+
+from config import SUBSCRIPTION_PLANS, SUBSCRIPTION_REMINDER_DAYS, SUBSCRIPTION_SWEEP_PAGE_SIZE
+from database.db_manager import DatabaseManager
+from database.models import get_db_connection, transaction
+from database.rows import RowCursor
+from services.templates import get_template_registry
+
+# 扫描锁名称，同一时间只允许一个进程扫描
+SWEEP_LOCK = 'telegram_vip_bot_expiry_sweep'
+
+# 水位线任务名前缀，每个提醒档位一条水位线
+SWEEP_JOB_PREFIX = 'subscription_expiry_'
+
+
+class ExpirySweep:
+    """
+    订阅到期提醒扫描
+
+    每个提醒档位（到期前T天）维护一条水位线 (end_date, id)，每次只按idx_end_date
+    扫描上次水位线之后、现在起T天内到期的订阅，已处理过的订阅不会再读取。
+    档位按天数从小到大处理，每个档位只扫描 [now + 上一档天数, now + T天) 这一段，
+    同一次扫描中一个订阅只会收到离到期最近的那一档提醒。
+
+    subscription_reminders表的主键 (subscription_id, tier) 用于去重：
+    水位线丢失或多次手动执行时也不会重复提醒。
+    已续费（同一用户有更晚到期的有效订阅）的订阅不提醒。
+    每页的提醒记录、通知和水位线在同一个事务中写入，通知用多行INSERT批量创建。
+    """
+
+    @staticmethod
+    def run(tiers=SUBSCRIPTION_REMINDER_DAYS, page_size=SUBSCRIPTION_SWEEP_PAGE_SIZE, now=None):
+        """
+        执行一次扫描
+
+        返回:
+            {档位天数: 创建的通知数量}，其他进程正在扫描时返回None
+        """
+        now = now or datetime.datetime.now()
+        lock_conn = get_db_connection()
+        try:
+            with lock_conn.cursor() as cursor:
+                cursor.execute("SELECT GET_LOCK(%s, 0) AS locked", (SWEEP_LOCK,))
+                if not cursor.fetchone()['locked']:
+                    print("其他进程正在执行到期提醒扫描，跳过本次执行")
+                    return None
+
+            try:
+                created = {}
+                previous = 0
+                for tier in sorted(set(tiers)):
+                    lower = now + datetime.timedelta(days=previous)
+                    upper = now + datetime.timedelta(days=tier)
+                    created[tier] = ExpirySweep.sweep_tier(tier, lower, upper, now, page_size)
+                    previous = tier
+                return created
+            finally:
+                with lock_conn.cursor() as cursor:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (SWEEP_LOCK,))
+        except Exception as e:
+            print(f"订阅到期提醒扫描失败: {e}")
+            raise e
+        finally:
+            lock_conn.close()
+
+    @staticmethod
+    def sweep_tier(tier, lower, upper, now, page_size=SUBSCRIPTION_SWEEP_PAGE_SIZE):
+        """
+        扫描一个档位：从水位线开始逐页处理 end_date < upper 的订阅
+
+        参数:
+            tier: 档位（到期前天数）
+            lower: 本档位扫描的起点（不早于水位线）
+            upper: 本档位扫描的终点（不含）
+            now: 本次扫描的时间，用于计算剩余天数
+            page_size: 每页订阅数量
+
+        返回:
+            创建的通知数量
+        """
+        job_name = f"{SWEEP_JOB_PREFIX}{tier}d"
+        created = 0
+        while True:
+            with transaction() as conn:
+                watermark = DatabaseManager.get_job_watermark(job_name, conn=conn)
+                start = max(watermark, (lower, 0)) if watermark and watermark[0] else (lower, 0)
+                if start[0] >= upper:
+                    return created
+
+                subscriptions = ExpirySweep.fetch_page(conn, start, upper, page_size)
+                due = ExpirySweep.claim_reminders(conn, subscriptions, tier)
+                DatabaseManager.create_notifications(ExpirySweep.build_notifications(due, now), conn=conn)
+
+                if len(subscriptions) < page_size:
+                    # 本档位已扫描到终点，下次从upper开始
+                    DatabaseManager.set_job_watermark(job_name, upper, 0, conn=conn)
+                else:
+                    last = subscriptions[-1]
+                    DatabaseManager.set_job_watermark(job_name, last['end_date'], last['id'], conn=conn)
+                created += len(due)
+
+            if len(subscriptions) < page_size:
+                return created
+
+    @staticmethod
+    def fetch_page(conn, start, upper, page_size):
+        """
+        按 (end_date, id) 顺序读取水位线之后的一页有效订阅
+        """
+        start_date, start_id = start
+        with conn.cursor(RowCursor) as cursor:
+            cursor.execute(
+                """SELECT s.id, s.user_id, s.plan_type, s.end_date, s.auto_renew
+                FROM subscriptions s
+                WHERE s.is_active = TRUE AND s.end_date >= %s AND s.end_date < %s
+                AND (s.end_date > %s OR s.id > %s)
+                AND NOT EXISTS (
+                    SELECT 1 FROM subscriptions r
+                    WHERE r.user_id = s.user_id AND r.is_active = TRUE AND r.end_date > s.end_date
+                )
+                ORDER BY s.end_date, s.id LIMIT %s""",
+                (start_date, upper, start_date, start_id, page_size)
+            )
+            return cursor.fetchall()
+
+    @staticmethod
+    def claim_reminders(conn, subscriptions, tier):
+        """
+        写入提醒记录，返回本档位还没有提醒过的订阅
+        """
+        if not subscriptions:
+            return []
+        ids = [s['id'] for s in subscriptions]
+        placeholders = ', '.join(['%s'] * len(ids))
+        with conn.cursor(RowCursor) as cursor:
+            cursor.execute(
+                f"""SELECT subscription_id FROM subscription_reminders
+                WHERE tier = %s AND subscription_id IN ({placeholders})""",
+                [tier] + ids
+            )
+            reminded = {row['subscription_id'] for row in cursor.fetchall()}
+            due = [s for s in subscriptions if s['id'] not in reminded]
+            if due:
+                cursor.executemany(
+                    "INSERT INTO subscription_reminders (subscription_id, tier) VALUES (%s, %s)",
+                    [(s['id'], tier) for s in due]
+                )
+        return due
+
+    @staticmethod
+    def build_notifications(subscriptions, now):
+        """
+        用到期提醒模板批量生成通知字段，与create_notifications的参数顺序一致
+        """
+        rows = [{
+            'plan_name': SUBSCRIPTION_PLANS.get(s['plan_type'], {}).get('name', s['plan_type']),
+            'end_date': s['end_date'],
+            'auto_renew': s['auto_renew'],
+            'days_before_expiry': max(1, math.ceil((s['end_date'] - now).total_seconds() / 86400)),
+        } for s in subscriptions]
+        messages = get_template_registry().render_many('subscription_expiry', rows)
+        return [
+            (s['user_id'], 'subscription_expiry', title, content, True, True)
+            for s, (title, content) in zip(subscriptions, messages)
+        ]
+
+
+if __name__ == '__main__':
+    # 由cron等定时执行: python -m services.expiry_sweep
+    result = ExpirySweep.run()
+    if result is not None:
+        for tier, count in result.items():
+            print(f"到期前{tier}天提醒: 创建{count}条通知")
@@ -1,7 +1,34 @@
 # 消息服务
 
+import base64
+import datetime
+import warnings
+
 from database.db_manager import DatabaseManager
 
+# 分页游标中送达时间的格式
+MESSAGE_CURSOR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def encode_message_cursor(delivered_at, message_id):
+    """
+    把分页位置 (delivered_at, message_id) 编码为不透明的游标字符串
+    """
+    raw = f"{delivered_at.strftime(MESSAGE_CURSOR_TIME_FORMAT)}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_message_cursor(cursor):
+    """
+    解码分页游标，游标无效时抛出ValueError
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        delivered_at, message_id = raw.split('|')
+        return datetime.datetime.strptime(delivered_at, MESSAGE_CURSOR_TIME_FORMAT), int(message_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"无效的分页游标: {cursor}") from e
+
 
 class MessageService:
     """
@@ -80,8 +107,15 @@ class MessageService:
             if not success:
                 return False, message_id  # 返回错误信息
             
-            # 发送给所有VIP用户
-            return MessageService.send_message_to_users(message_id)
+            # 为所有VIP用户写入发送记录
+            success, sent_count = MessageService.send_message_to_users(message_id)
+            if not success:
+                return False, sent_count
+
+            # 在后台通过Telegram群发（按页并发、限速，进度保存在检查点中）
+            from services.broadcast import start_broadcast
+            start_broadcast(message_id)
+            return True, sent_count
         except Exception as e:
             print(f"发送VIP专属消息失败: {e}")
             return False, f"发送VIP专属消息失败: {str(e)}"
@@ -122,7 +156,8 @@ class MessageService:
     @staticmethod
     def get_user_messages(user_id, include_read=False, limit=20, offset=0):
         """
-        获取用户的消息列表
+        获取用户的消息列表（已弃用）
+        OFFSET分页越往后越慢，请使用按游标分页的get_user_messages_page
         
         参数:
             user_id: 用户ID
@@ -133,6 +168,9 @@ class MessageService:
         返回:
             消息列表
         """
+        warnings.warn(
+            "get_user_messages已弃用，请使用get_user_messages_page", DeprecationWarning, stacklevel=2
+        )
         try:
             query = """
             SELECT m.*, md.is_read, md.delivered_at, md.read_at 
@@ -153,28 +191,120 @@ class MessageService:
         except Exception as e:
             print(f"获取用户消息失败: {e}")
             return []
-    
+
+    @staticmethod
+    def get_user_messages_page(user_id, include_read=False, limit=20, cursor=None):
+        """
+        按游标分页获取用户的消息列表（按送达时间倒序）
+
+        以 (delivered_at, message_id) 为键集分页，每页都从索引上的游标位置开始读取，
+        第1页和第500页的开销相同；排序和过滤都在message_deliveries的覆盖索引上完成，
+        只对本页的消息回表读取messages。
+
+        参数:
+            user_id: 用户ID
+            include_read: 是否包含已读消息
+            limit: 每页消息数量
+            cursor: 上一页返回的next_cursor，为None时获取第一页
+
+        返回:
+            (消息列表, next_cursor)，没有下一页时next_cursor为None
+        """
+        try:
+            query = """
+            SELECT m.*, md.is_read, md.delivered_at, md.read_at
+            FROM message_deliveries md
+            JOIN messages m ON m.id = md.message_id
+            WHERE md.user_id = %s
+            """
+
+            params = [user_id]
+
+            if not include_read:
+                query += " AND md.is_read = FALSE"
+
+            if cursor:
+                delivered_at, message_id = decode_message_cursor(cursor)
+                query += " AND md.delivered_at <= %s AND (md.delivered_at < %s OR md.message_id < %s)"
+                params.extend([delivered_at, delivered_at, message_id])
+
+            # 多取一条用于判断是否还有下一页
+            query += " ORDER BY md.delivered_at DESC, md.message_id DESC LIMIT %s"
+            params.append(limit + 1)
+
+            messages = DatabaseManager.execute_query(query, params)
+            if len(messages) <= limit:
+                return messages, None
+
+            messages = messages[:limit]
+            last = messages[-1]
+            return messages, encode_message_cursor(last['delivered_at'], last['id'])
+        except Exception as e:
+            print(f"获取用户消息失败: {e}")
+            return [], None
+
     @staticmethod
     def mark_message_as_read(message_id, user_id):
         """
         标记消息为已读
-        
+        回执先进入已读回执缓冲，由后台线程与其他回执合并为一条UPDATE写入
+
         参数:
             message_id: 消息ID
             user_id: 用户ID
-            
+
         返回:
             是否成功
         """
         try:
-            query = """
-            UPDATE message_deliveries 
-            SET is_read = TRUE, read_at = NOW() 
-            WHERE message_id = %s AND user_id = %s
-            """
-            
-            DatabaseManager.execute_query(query, (message_id, user_id))
+            from services.read_receipts import get_read_receipt_buffer
+            get_read_receipt_buffer().add(message_id, user_id)
             return True
         except Exception as e:
             print(f"标记消息已读失败: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    @staticmethod
+    def mark_all_read_before(user_id, cursor=None):
+        """
+        把用户在游标位置及之前送达的消息全部标记为已读
+
+        参数:
+            user_id: 用户ID
+            cursor: get_user_messages_page返回的游标，为None时标记全部消息
+
+        返回:
+            (success, 标记数量或错误信息)
+        """
+        try:
+            from services.read_receipts import get_read_receipt_buffer
+            return True, get_read_receipt_buffer().mark_all_read_before(user_id, cursor)
+        except Exception as e:
+            print(f"标记消息已读失败: {e}")
+            return False, f"标记消息已读失败: {str(e)}"
+
+    @staticmethod
+    def get_unread_count(user_id):
+        """
+        获取用户的未读消息数（未读角标），读取计数表而不统计发送记录
+
+        返回:
+            未读消息数，查询失败时返回0
+        """
+        try:
+            return DatabaseManager.get_unread_count(user_id)
+        except Exception as e:
+            print(f"获取未读消息数失败: {e}")
+            return 0
+
+
+if __name__ == '__main__':
+    # 用法: python -m services.message_service rebuild-unread [user_id]
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'rebuild-unread':
+        target = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        print(f"已重算{DatabaseManager.rebuild_unread_counters(target)}个用户的未读消息数")
+    else:
+        print(f"未知命令: {' '.join(sys.argv[1:])}")
+        sys.exit(1)
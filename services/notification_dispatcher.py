@@ -0,0 +1,437 @@
+# 通知分发器（按渠道并发发送，Telegram消息限速）
+
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import RetryAfter, TelegramError
+
+from config import (
+    NOTIFICATION_EMAIL_CONCURRENCY, NOTIFICATION_TELEGRAM_CONCURRENCY,
+    NOTIFICATION_TELEGRAM_RATE, NOTIFICATION_TELEGRAM_BURST,
+    NOTIFICATION_TELEGRAM_CHAT_INTERVAL, NOTIFICATION_MAX_RETRIES,
+    NOTIFICATION_CLAIM_BATCH_SIZE, NOTIFICATION_LEASE_SECONDS, NOTIFICATION_POLL_INTERVAL,
+    NOTIFICATION_RETRY_BASE_DELAY, NOTIFICATION_RETRY_MAX_DELAY, NOTIFICATION_MAX_ATTEMPTS,
+    NOTIFICATION_COALESCE_WINDOW, NOTIFICATION_DIGEST_MAX_SIZE, OUTBOX_ENABLED
+)
+from database.db_manager import DatabaseManager
+from database.outbox import get_outbox
+from services.notification_service import NotificationService
+from services.smtp_pool import get_smtp_sender
+from services.telegram_sender import get_telegram_sender
+
+# 全局通知分发器（首次使用时创建）
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    线程安全的令牌桶
+
+    参数:
+        rate: 每秒补充的令牌数，为0或None时不限速
+        capacity: 令牌桶容量（允许的突发数量），默认等于rate
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        预定一个令牌，返回使用该令牌前需要等待的秒数
+        令牌不足时允许透支，后来的调用方排在更后面
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not self.rate:
+                return max(0.0, self._updated - now)
+            # 暂停期间_updated在未来，此时不补充令牌
+            if now > self._updated:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+            self._tokens -= 1
+            wait = self._updated - now
+            if self._tokens < 0:
+                wait += -self._tokens / self.rate
+            return wait
+
+    def acquire(self):
+        """
+        获取一个令牌（必要时等待），返回等待的秒数
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        暂停发放令牌（如收到429后的retry_after），恢复后不允许突发
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.rate and now > self._updated:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._tokens = min(self._tokens, 0)
+            self._updated = max(self._updated, now + seconds)
+
+
+class NotificationDispatcher:
+    """
+    通知分发器
+
+    邮件和Telegram通知各用一个常驻线程池并发发送（首次使用时创建，各批次共用，close()时关闭）；Telegram消息共享一个全局令牌桶
+    （Telegram群发限制约30条/秒），同一聊天的消息之间至少间隔per_chat_interval秒，
+    收到429时按retry_after暂停所有Telegram发送后重试。
+    两个渠道依次处理：邮件发送成功的通知会标记为已发送，不再通过Telegram重复发送。
+
+    通知通过claim_notifications按批认领（带租约），多个进程同时运行时不会重复发送；
+    令牌桶和单聊天间隔只在本进程内生效，多进程部署时应按进程数分摊telegram_rate。
+
+    发送失败的通知按指数退避（带随机抖动）安排下一次重试时间，未到时间前不会被认领；
+    尝试max_attempts次仍失败的通知进入死信状态，不再自动重试。
+
+    coalesce_window大于0时，通知创建后至少等待coalesce_window秒才会被认领，
+    同一用户在同一渠道上待发送的多条通知合并为一条摘要消息发送（每条摘要最多digest_max_size条），
+    避免连续操作（如取消后立即重新订阅）产生的一连串通知分别占用SMTP和Bot API额度。
+
+    参数:
+        email_concurrency: 邮件发送线程数
+        telegram_concurrency: Telegram发送线程数
+        telegram_rate: Telegram全局速率（条/秒）
+        telegram_burst: Telegram突发上限
+        per_chat_interval: 同一聊天两条消息的最小间隔（秒）
+        max_retries: 收到429后同一条消息的最大重试次数
+        batch_size: 每次认领的通知数量
+        lease_seconds: 认领租约秒数
+        worker_id: 认领者标识，默认由主机名、进程号和随机后缀组成
+        max_attempts: 最大尝试次数，达到后进入死信状态
+        retry_base_delay: 第一次失败后的重试等待秒数，之后每次翻倍
+        retry_max_delay: 重试等待秒数上限
+        coalesce_window: 合并窗口秒数，为0时不合并
+        digest_max_size: 每条摘要最多合并的通知数量
+    """
+
+    def __init__(self, email_concurrency=NOTIFICATION_EMAIL_CONCURRENCY,
+                 telegram_concurrency=NOTIFICATION_TELEGRAM_CONCURRENCY,
+                 telegram_rate=NOTIFICATION_TELEGRAM_RATE, telegram_burst=NOTIFICATION_TELEGRAM_BURST,
+                 per_chat_interval=NOTIFICATION_TELEGRAM_CHAT_INTERVAL, max_retries=NOTIFICATION_MAX_RETRIES,
+                 batch_size=NOTIFICATION_CLAIM_BATCH_SIZE, lease_seconds=NOTIFICATION_LEASE_SECONDS,
+                 worker_id=None, max_attempts=NOTIFICATION_MAX_ATTEMPTS,
+                 retry_base_delay=NOTIFICATION_RETRY_BASE_DELAY, retry_max_delay=NOTIFICATION_RETRY_MAX_DELAY,
+                 coalesce_window=NOTIFICATION_COALESCE_WINDOW, digest_max_size=NOTIFICATION_DIGEST_MAX_SIZE):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.email_concurrency = email_concurrency
+        self.telegram_concurrency = telegram_concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.coalesce_window = coalesce_window
+        self.digest_max_size = max(1, digest_max_size)
+        self.telegram_bucket = TokenBucket(telegram_rate, telegram_burst)
+        self._chat_next = {}  # chat_id -> 下一条消息最早的发送时间
+        self._errors = {}  # notification_id -> 本轮发送失败的原因
+        self._lock = threading.Lock()
+        self._executors = {}  # 渠道 -> 发送线程池
+        self._counters = {
+            channel: {'sent': 0, 'failed': 0, 'throttled': 0, 'retried': 0, 'dead': 0, 'coalesced': 0}
+            for channel in ('email', 'telegram')
+        }
+
+    def process_pending(self):
+        """
+        认领并发送所有待发送的通知（可在多个进程、多台主机上同时运行）
+
+        返回:
+            (email_sent_count, telegram_sent_count)
+        """
+        email_sent = self._drain(self.send_email, is_email=True)
+
+        # 邮件渠道处理完后再认领，已通过邮件发送的通知不会重复发送
+        telegram_sent = self._drain(self.send_telegram, is_telegram=True)
+
+        return email_sent, telegram_sent
+
+    def run_forever(self, poll_interval=NOTIFICATION_POLL_INTERVAL, stop_event=None):
+        """
+        常驻发送：持续认领并发送通知，没有发送任何通知时等待poll_interval秒后再轮询
+        """
+        stop_event = stop_event or threading.Event()
+        print(f"通知发送进程已启动: {self.worker_id}")
+        if OUTBOX_ENABLED:
+            # 回放本机发件箱中遗留的通知（数据库不可用期间其他进程写入的）
+            get_outbox()
+        while not stop_event.is_set():
+            try:
+                email_sent, telegram_sent = self.process_pending()
+            except Exception as e:
+                print(f"处理待发送通知失败: {e}")
+                email_sent = telegram_sent = 0
+            if not email_sent and not telegram_sent:
+                stop_event.wait(poll_interval)
+
+    def dispatch(self, notifications, send, channel):
+        """
+        用渠道的常驻线程池并发发送一批通知，返回每条通知是否发送成功的列表
+        """
+        if not notifications:
+            return []
+        return list(self._executor(channel).map(send, notifications))
+
+    def close(self):
+        """
+        关闭各渠道的发送线程池（等待正在发送的通知完成）
+        """
+        with self._lock:
+            executors, self._executors = list(self._executors.values()), {}
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+    def _executor(self, channel):
+        """
+        获取渠道的发送线程池，首次使用时创建，之后所有批次共用
+        """
+        with self._lock:
+            executor = self._executors.get(channel)
+            if executor is None:
+                workers = self.email_concurrency if channel == 'email' else self.telegram_concurrency
+                executor = ThreadPoolExecutor(
+                    max_workers=max(1, workers), thread_name_prefix=f'notification-{channel}'
+                )
+                self._executors[channel] = executor
+            return executor
+
+    def _drain(self, send, is_email=None, is_telegram=None):
+        """
+        逐批认领并发送一个渠道的通知，返回发送成功的数量
+
+        认领结果已联表带上用户的email和telegram_id，发送时不再逐条查询用户；
+        每批发送成功的通知用一条UPDATE统一标记为已发送。
+        发送失败的通知记录一次失败并按退避时间安排重试；
+        邮件发送失败但还需要发送Telegram的通知不计失败，在本轮结束前保持认领状态
+        （避免本渠道内反复认领），结束后释放给Telegram渠道发送。
+        """
+        sent = 0
+        release_ids = []
+        try:
+            while True:
+                batch = DatabaseManager.claim_notifications(
+                    self.worker_id, self.batch_size, self.lease_seconds,
+                    is_email=is_email, is_telegram=is_telegram, coalesce_window=self.coalesce_window
+                )
+                if not batch:
+                    return sent
+
+                channel = 'email' if is_email else 'telegram'
+                groups = self.coalesce(batch)
+                with self._lock:
+                    self._counters[channel]['coalesced'] += len(batch) - len(groups)
+
+                results = self.dispatch(groups, lambda group: self._send_group(send, group), channel)
+                sent_ids = []
+                failures = []
+                for group, ok in zip(groups, results):
+                    # 合并发送时整组共用一个结果，失败原因记录在第一条通知的ID上
+                    error = self._pop_error(group[0]['id'])
+                    for notification in group:
+                        if ok:
+                            sent_ids.append(notification['id'])
+                        elif is_email and notification['is_telegram']:
+                            release_ids.append(notification['id'])
+                        else:
+                            delay = self.retry_delay(notification['attempts'] + 1)
+                            failures.append((notification['id'], delay, error))
+
+                # 标记失败时通知仍处于认领状态，租约到期后会被重新发送
+                DatabaseManager.mark_notifications_sent(sent_ids)
+                sent += len(sent_ids)
+                self._reschedule(channel, failures)
+        finally:
+            if release_ids:
+                DatabaseManager.release_notifications(release_ids, self.worker_id)
+
+    def coalesce(self, batch):
+        """
+        将一批通知按用户分组，每组最多digest_max_size条，组内保持原有顺序
+        coalesce_window为0时不合并，每条通知单独成组
+        """
+        if not self.coalesce_window:
+            return [[notification] for notification in batch]
+
+        by_user = {}
+        for notification in batch:
+            by_user.setdefault(notification['user_id'], []).append(notification)
+
+        groups = []
+        for notifications in by_user.values():
+            for start in range(0, len(notifications), self.digest_max_size):
+                groups.append(notifications[start:start + self.digest_max_size])
+        return groups
+
+    @staticmethod
+    def _send_group(send, group):
+        """
+        发送一组通知：只有一条时原样发送，多条时合并为一条摘要
+        """
+        if len(group) == 1:
+            return send(group[0])
+        return send(NotificationService.build_digest(group))
+
+    def retry_delay(self, attempt):
+        """
+        第attempt次失败后的重试等待秒数：指数退避，在[delay/2, delay]内随机抖动，
+        避免同时失败的大量通知在同一时刻重试
+        """
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1))
+        return int(delay / 2 + random.uniform(0, delay / 2))
+
+    def _reschedule(self, channel, failures):
+        """
+        记录一批发送失败，达到最大尝试次数的通知进入死信状态
+        """
+        if not failures:
+            return
+        dead_ids = DatabaseManager.reschedule_notifications(failures, self.worker_id, self.max_attempts)
+        if dead_ids:
+            with self._lock:
+                self._counters[channel]['dead'] += len(dead_ids)
+            print(f"{len(dead_ids)}条通知多次发送失败，已进入死信状态: {dead_ids}")
+
+    def send_email(self, notification):
+        """
+        发送一条邮件通知，返回是否成功
+        """
+        try:
+            email = NotificationService.get_recipient(notification, 'email')
+            if not email:
+                return self._fail('email', notification, f"用户 {notification['user_id']} 没有设置邮箱")
+
+            msg = NotificationService.build_email_message(notification, email)
+            get_smtp_sender().send(msg)
+            self._count('email', 'sent')
+            return True
+        except Exception as e:
+            return self._fail('email', notification, f"发送邮件通知失败: {e}")
+
+    def send_telegram(self, notification):
+        """
+        按速率限制发送一条Telegram通知，返回是否成功
+        """
+        try:
+            chat_id = NotificationService.get_recipient(notification, 'telegram_id')
+            if not chat_id:
+                return self._fail('telegram', notification, f"用户 {notification['user_id']} 没有关联Telegram账号")
+
+            self.deliver_telegram(chat_id, NotificationService.build_telegram_text(notification))
+            self._count('telegram', 'sent')
+            return True
+        except TelegramError as te:
+            return self._fail('telegram', notification, f"Telegram API错误: {te}")
+        except Exception as e:
+            return self._fail('telegram', notification, f"发送Telegram通知失败: {e}")
+
+    def deliver_telegram(self, chat_id, text, **kwargs):
+        """
+        按全局速率和单聊天间隔发送一条Telegram消息，收到429时暂停后重试，失败时抛出异常
+        通知和群发共用这一套限速，保证整个进程不超过Bot API的限制
+        """
+        sender = get_telegram_sender()
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_chat(chat_id)
+            self.telegram_bucket.acquire()
+            try:
+                return sender.send(chat_id, text, **kwargs)
+            except RetryAfter as e:
+                self._count('telegram', 'throttled')
+                if attempt == self.max_retries:
+                    raise
+                # 429：所有Telegram发送暂停retry_after秒后重试
+                self.telegram_bucket.pause(self._retry_after_seconds(e))
+                self._count('telegram', 'retried')
+
+    def stats(self):
+        """
+        获取各渠道的发送、失败、被限流（429）、重试和进入死信的次数，以及被合并进摘要的通知数
+        """
+        with self._lock:
+            return {channel: dict(counters) for channel, counters in self._counters.items()}
+
+    def _wait_for_chat(self, chat_id):
+        """
+        保证同一聊天的两条消息至少间隔per_chat_interval秒
+        """
+        if not self.per_chat_interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # 清理已过期的记录，避免字典无限增长
+            if len(self._chat_next) > 10000:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+            start = max(now, self._chat_next.get(chat_id, 0.0))
+            self._chat_next[chat_id] = start + self.per_chat_interval
+        if start > now:
+            time.sleep(start - now)
+
+    def _count(self, channel, counter):
+        with self._lock:
+            self._counters[channel][counter] += 1
+
+    def _fail(self, channel, notification, error):
+        """
+        记录一次发送失败及其原因（写入通知的last_error），返回False
+        """
+        print(error)
+        with self._lock:
+            self._counters[channel]['failed'] += 1
+            self._errors[notification['id']] = error
+        return False
+
+    def _pop_error(self, notification_id):
+        with self._lock:
+            return self._errors.pop(notification_id, None)
+
+    @staticmethod
+    def _retry_after_seconds(error):
+        # 新版本python-telegram-bot中retry_after是timedelta
+        retry_after = error.retry_after
+        if hasattr(retry_after, 'total_seconds'):
+            return retry_after.total_seconds()
+        return float(retry_after)
+
+
+def get_notification_dispatcher():
+    """
+    获取全局通知分发器
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = NotificationDispatcher()
+    return _dispatcher
+
+
+if __name__ == '__main__':
+    # 常驻发送进程，可以在多个进程或主机上同时运行: python -m services.notification_dispatcher
+    # 启动时在后台继续上次退出时未完成（或失败）的群发（同一条消息只会由一个进程群发）
+    from services.broadcast import resume_broadcasts_in_background
+    resume_broadcasts_in_background()
+    try:
+        get_notification_dispatcher().run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        get_notification_dispatcher().close()
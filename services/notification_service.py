@@ -1,13 +1,14 @@
 # 通知服务
 
 import datetime
-import smtplib
-import asyncio
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from database.db_manager import DatabaseManager
-from config import SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, TELEGRAM_BOT_TOKEN
-from telegram import Bot
+from database.outbox import DB_UNAVAILABLE_ERRORS, get_outbox, new_dedupe_key
+from services.smtp_pool import get_smtp_sender
+from services.telegram_sender import get_telegram_sender
+from services.templates import get_template_registry
+from config import SMTP_USER, OUTBOX_ENABLED
 from telegram.error import TelegramError
 
 
@@ -16,18 +17,6 @@ class NotificationService:
     通知服务类，处理通知相关的业务逻辑
     """
 
-    # 初始化Telegram Bot实例
-    _bot = None
-
-    @classmethod
-    def get_bot(cls):
-        """
-        获取或创建Telegram Bot实例
-        """
-        if cls._bot is None:
-            cls._bot = Bot(TELEGRAM_BOT_TOKEN)
-        return cls._bot
-
     @staticmethod
     def create_notification(user_id, notification_type, title, content, is_email=False, is_telegram=True):
         """
@@ -43,16 +32,97 @@ class NotificationService:
 
         返回:
             (success, notification_id或错误信息)
+            数据库不可用、通知暂存到本地发件箱时notification_id为None
         """
+        # 写入前生成dedupe_key：提交后连接断开时通知可能已经写入，
+        # 转存到发件箱的记录使用同一个dedupe_key，回放时被INSERT IGNORE忽略
+        dedupe_key = new_dedupe_key()
         try:
             notification_id = DatabaseManager.create_notification(
-                user_id, notification_type, title, content, is_email, is_telegram
+                user_id, notification_type, title, content, is_email, is_telegram, dedupe_key=dedupe_key
             )
             return True, notification_id
+        except DB_UNAVAILABLE_ERRORS as e:
+            if not OUTBOX_ENABLED:
+                print(f"创建通知失败: {e}")
+                return False, f"创建通知失败: {str(e)}"
+            try:
+                get_outbox().append(
+                    user_id, notification_type, title, content, is_email, is_telegram, dedupe_key=dedupe_key
+                )
+                print(f"数据库不可用，通知已暂存到本地发件箱: {e}")
+                return True, None
+            except Exception as outbox_error:
+                print(f"写入本地发件箱失败: {outbox_error}")
+                return False, f"创建通知失败: {str(e)}"
         except Exception as e:
             print(f"创建通知失败: {e}")
             return False, f"创建通知失败: {str(e)}"
 
+    @staticmethod
+    def get_recipient(notification, field):
+        """
+        获取通知接收人的邮箱或Telegram ID
+        通知记录已通过联表查询带上用户字段时直接使用，否则查询用户表
+
+        参数:
+            notification: 通知记录
+            field: 'email' 或 'telegram_id'
+        """
+        if field in notification:
+            return notification[field]
+        user = DatabaseManager.get_user_by_id(notification['user_id'])
+        return user[field] if user else None
+
+    @staticmethod
+    def build_email_message(notification, email):
+        """
+        根据通知记录创建邮件
+
+        参数:
+            notification: 通知记录
+            email: 收件人邮箱
+
+        返回:
+            MIMEMultipart邮件
+        """
+        msg = MIMEMultipart()
+        msg['From'] = SMTP_USER
+        msg['To'] = email
+        msg['Subject'] = notification['title']
+
+        # 添加邮件内容
+        msg.attach(MIMEText(notification['content'], 'plain'))
+        return msg
+
+    @staticmethod
+    def build_telegram_text(notification):
+        """
+        根据通知记录生成Telegram消息内容
+        """
+        return f"*{notification['title']}*\n\n{notification['content']}"
+
+    @staticmethod
+    def build_digest(notifications):
+        """
+        将同一用户的多条通知合并为一条摘要通知
+
+        参数:
+            notifications: 同一用户的通知记录列表（按时间顺序）
+
+        返回:
+            摘要通知（dict，id为第一条通知的ID，接收人字段取自第一条通知）
+        """
+        first = notifications[0]
+        digest = {key: first[key] for key in ('id', 'user_id', 'email', 'telegram_id') if key in first}
+        digest['type'] = 'digest'
+        digest['title'] = f"您有{len(notifications)}条新通知"
+        digest['content'] = "\n\n".join(
+            f"{index}. {notification['title']}\n{notification['content']}"
+            for index, notification in enumerate(notifications, 1)
+        )
+        return digest
+
     @staticmethod
     def send_email_notification(notification):
         """
@@ -66,25 +136,14 @@ class NotificationService:
         """
         try:
             # 获取用户邮箱
-            user = DatabaseManager.get_user_by_id(notification['user_id'])
-            if not user or not user['email']:
+            email = NotificationService.get_recipient(notification, 'email')
+            if not email:
                 print(f"用户 {notification['user_id']} 没有设置邮箱")
                 return False
 
-            # 创建邮件
-            msg = MIMEMultipart()
-            msg['From'] = SMTP_USER
-            msg['To'] = user['email']
-            msg['Subject'] = notification['title']
-
-            # 添加邮件内容
-            msg.attach(MIMEText(notification['content'], 'plain'))
-
-            # 发送邮件
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-                server.starttls()
-                server.login(SMTP_USER, SMTP_PASSWORD)
-                server.send_message(msg)
+            # 创建并发送邮件（复用连接池中已登录的SMTP连接）
+            msg = NotificationService.build_email_message(notification, email)
+            get_smtp_sender().send(msg)
 
             # 标记通知为已发送
             DatabaseManager.mark_notification_sent(notification['id'])
@@ -106,30 +165,17 @@ class NotificationService:
         """
         try:
             # 获取用户Telegram ID
-            user = DatabaseManager.get_user_by_id(notification['user_id'])
-            if not user or not user['telegram_id']:
+            telegram_id = NotificationService.get_recipient(notification, 'telegram_id')
+            if not telegram_id:
                 print(f"用户 {notification['user_id']} 没有关联Telegram账号")
                 return False
 
             # 准备消息内容
-            message = f"*{notification['title']}*\n\n{notification['content']}"
-
-            # 获取Bot实例
-            bot = NotificationService.get_bot()
-
-            # 使用python-telegram-bot发送消息
-            # 创建一个事件循环来运行异步函数
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+            message = NotificationService.build_telegram_text(notification)
 
             try:
-                # 发送消息
-                loop.run_until_complete(
-                    bot.send_message(
-                        chat_id=user['telegram_id'],
-                        text=message
-                    )
-                )
+                # 提交到常驻的发送服务（共用事件循环和HTTP连接池）并等待结果
+                get_telegram_sender().send(telegram_id, message)
 
                 # 标记通知为已发送
                 DatabaseManager.mark_notification_sent(notification['id'])
@@ -137,8 +183,6 @@ class NotificationService:
             except TelegramError as te:
                 print(f"Telegram API错误: {te}")
                 return False
-            finally:
-                loop.close()
 
         except Exception as e:
             print(f"发送Telegram通知失败: {e}")
@@ -148,33 +192,21 @@ class NotificationService:
     def process_pending_notifications():
         """
         处理所有待发送的通知
+        由通知分发器按渠道并发发送，Telegram消息受全局速率和单聊天间隔限制
 
         返回:
             (email_sent_count, telegram_sent_count)
         """
-        email_sent = 0
-        telegram_sent = 0
+        from services.notification_dispatcher import get_notification_dispatcher
 
         try:
-            # 处理邮件通知
-            email_notifications = DatabaseManager.get_pending_notifications(is_email=True)
-            for notification in email_notifications:
-                if NotificationService.send_email_notification(notification):
-                    email_sent += 1
-
-            # 处理Telegram通知
-            telegram_notifications = DatabaseManager.get_pending_notifications(is_telegram=True)
-            for notification in telegram_notifications:
-                if NotificationService.send_telegram_notification(notification):
-                    telegram_sent += 1
-
-            return email_sent, telegram_sent
+            return get_notification_dispatcher().process_pending()
         except Exception as e:
             print(f"处理待发送通知失败: {e}")
-            return email_sent, telegram_sent
+            return 0, 0
 
     @staticmethod
-    def create_payment_success_notification(user_id, payment_info, subscription_info):
+    def create_payment_success_notification(user_id, payment_info, subscription_info, locale=None):
         """
         创建支付成功通知
 
@@ -182,25 +214,22 @@ class NotificationService:
             user_id: 用户ID
             payment_info: 支付信息
             subscription_info: 订阅信息
+            locale: 通知语言，默认使用配置中的默认语言
 
         返回:
             (success, notification_id或错误信息)
         """
-        title = "支付成功通知"
-        content = f"您的支付已成功处理。\n\n"
-        content += f"支付金额: {payment_info['amount']} {payment_info['currency']}\n"
-        content += f"支付方式: {payment_info['payment_type']}\n"
-
+        row = dict(payment_info, has_subscription=bool(subscription_info))
         if subscription_info:
-            content += f"订阅计划: {subscription_info['plan_name']}\n"
-            content += f"有效期至: {subscription_info['end_date'].strftime('%Y-%m-%d %H:%M:%S')}"
+            row.update(plan_name=subscription_info['plan_name'], end_date=subscription_info['end_date'])
+        title, content = get_template_registry().render('payment_success', row, locale)
 
         return NotificationService.create_notification(
             user_id, 'payment_success', title, content, is_email=True, is_telegram=True
         )
 
     @staticmethod
-    def create_payment_failed_notification(user_id, payment_info, error_message):
+    def create_payment_failed_notification(user_id, payment_info, error_message, locale=None):
         """
         创建支付失败通知
 
@@ -208,23 +237,21 @@ class NotificationService:
             user_id: 用户ID
             payment_info: 支付信息
             error_message: 错误信息
+            locale: 通知语言，默认使用配置中的默认语言
 
         返回:
             (success, notification_id或错误信息)
         """
-        title = "支付失败通知"
-        content = f"您的支付处理失败。\n\n"
-        content += f"支付金额: {payment_info['amount']} {payment_info['currency']}\n"
-        content += f"支付方式: {payment_info['payment_type']}\n"
-        content += f"错误信息: {error_message}\n\n"
-        content += "请稍后重试或联系客服获取帮助。"
+        title, content = get_template_registry().render(
+            'payment_failed', dict(payment_info, error_message=error_message), locale
+        )
 
         return NotificationService.create_notification(
             user_id, 'payment_failed', title, content, is_email=True, is_telegram=True
         )
 
     @staticmethod
-    def create_subscription_expiry_notification(user_id, subscription_info, days_before_expiry):
+    def create_subscription_expiry_notification(user_id, subscription_info, days_before_expiry, locale=None):
         """
         创建订阅即将到期通知
 
@@ -232,40 +259,49 @@ class NotificationService:
             user_id: 用户ID
             subscription_info: 订阅信息
             days_before_expiry: 到期前天数
+            locale: 通知语言，默认使用配置中的默认语言
 
         返回:
             (success, notification_id或错误信息)
         """
-        title = "订阅即将到期提醒"
-        content = f"您的{subscription_info['plan_name']}订阅即将到期。\n\n"
-        content += f"到期时间: {subscription_info['end_date'].strftime('%Y-%m-%d %H:%M:%S')}\n"
-        content += f"剩余天数: {days_before_expiry}天\n\n"
-
-        if subscription_info['auto_renew']:
-            content += "您的订阅已设置为自动续费，将在到期时自动续订。"
-        else:
-            content += "请及时续费以继续享受VIP服务。"
-
+        title, content = NotificationService.build_subscription_expiry_message(
+            subscription_info, days_before_expiry, locale
+        )
         return NotificationService.create_notification(
             user_id, 'subscription_expiry', title, content, is_email=True, is_telegram=True
         )
 
     @staticmethod
-    def create_subscription_expired_notification(user_id, subscription_info):
+    def build_subscription_expiry_message(subscription_info, days_before_expiry, locale=None):
+        """
+        生成订阅即将到期提醒的标题和内容（批量生成请使用模板注册表的render_many）
+
+        参数:
+            subscription_info: 订阅信息（plan_name, end_date, auto_renew）
+            days_before_expiry: 到期前天数
+            locale: 通知语言
+
+        返回:
+            (title, content)
+        """
+        return get_template_registry().render(
+            'subscription_expiry', dict(subscription_info, days_before_expiry=days_before_expiry), locale
+        )
+
+    @staticmethod
+    def create_subscription_expired_notification(user_id, subscription_info, locale=None):
         """
         创建订阅已到期通知
 
         参数:
             user_id: 用户ID
             subscription_info: 订阅信息
+            locale: 通知语言，默认使用配置中的默认语言
 
         返回:
             (success, notification_id或错误信息)
         """
-        title = "订阅已到期通知"
-        content = f"您的{subscription_info['plan_name']}订阅已经到期。\n\n"
-        content += f"到期时间: {subscription_info['end_date'].strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-        content += "您将无法继续享受VIP服务，请及时续费。"
+        title, content = get_template_registry().render('subscription_expired', subscription_info, locale)
 
         return NotificationService.create_notification(
             user_id, 'subscription_expiry', title, content, is_email=True, is_telegram=True
@@ -0,0 +1,171 @@
+# 消息已读回执（内存缓冲，批量写入）
+
+import atexit
+import threading
+
+from config import READ_RECEIPT_BATCH_SIZE, READ_RECEIPT_FLUSH_INTERVAL
+from database.db_manager import DatabaseManager
+from services.message_service import decode_message_cursor
+
+# 全局已读回执缓冲（首次使用时创建）
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+class ReadReceiptBuffer:
+    """
+    已读回执缓冲
+
+    add()只把 (message_id, user_id) 记录在内存中，后台线程在缓冲数量达到batch_size
+    或距上次写入超过flush_interval秒时，用一条多行UPDATE把缓冲的回执一起写入。
+    写入失败时回执放回缓冲，下次重试；进程退出时（atexit）写入剩余的回执。
+    已读时间为写入时间，最多比实际阅读晚flush_interval秒。
+
+    参数:
+        batch_size: 触发写入的缓冲数量，也是单条UPDATE的最大回执数
+        flush_interval: 最长缓冲秒数
+    """
+
+    def __init__(self, batch_size=READ_RECEIPT_BATCH_SIZE, flush_interval=READ_RECEIPT_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = set()
+        self._closed = False
+        self._thread = None
+        self._added = 0
+        self._written = 0
+        self._flushes = 0
+
+    def add(self, message_id, user_id):
+        """
+        记录一条已读回执（同一回执重复记录只写入一次）
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("已读回执缓冲已关闭")
+            self._pending.add((message_id, user_id))
+            self._added += 1
+            self._start()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self):
+        """
+        立即写入缓冲中的全部回执
+
+        返回:
+            由未读变为已读的数量
+        """
+        with self._flush_lock:
+            with self._cond:
+                receipts, self._pending = list(self._pending), set()
+            if not receipts:
+                return 0
+
+            marked = 0
+            for start in range(0, len(receipts), self.batch_size):
+                try:
+                    marked += DatabaseManager.mark_messages_read(receipts[start:start + self.batch_size])
+                except Exception:
+                    with self._cond:
+                        self._pending.update(receipts[start:])
+                    raise
+
+            with self._cond:
+                self._written += marked
+                self._flushes += 1
+            return marked
+
+    def mark_all_read_before(self, user_id, cursor=None):
+        """
+        把用户在游标位置及之前送达的消息全部标记为已读（一条UPDATE）
+
+        参数:
+            user_id: 用户ID
+            cursor: MessageService.get_user_messages_page返回的游标，
+                    为None时标记该用户的全部消息
+
+        返回:
+            标记的数量
+        """
+        if cursor is None:
+            return DatabaseManager.mark_messages_read_before(user_id)
+        delivered_at, message_id = decode_message_cursor(cursor)
+        return DatabaseManager.mark_messages_read_before(user_id, delivered_at, message_id)
+
+    def pending(self):
+        """
+        缓冲中等待写入的回执数量
+        """
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self):
+        """
+        获取记录、写入和批次的统计信息
+        """
+        with self._cond:
+            return {
+                'added': self._added,
+                'written': self._written,
+                'flushes': self._flushes,
+                'pending': len(self._pending),
+            }
+
+    def close(self, timeout=10):
+        """
+        停止后台线程并写入剩余的回执
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"写入剩余的已读回执失败（{self.pending()}条）: {e}")
+
+    def _start(self):
+        """
+        启动后台写入线程，调用方需持有self._cond
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='read-receipts', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or len(self._pending) >= self.batch_size, self.flush_interval
+                )
+                if self._closed:
+                    return
+                if not self._pending:
+                    continue
+
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"写入已读回执失败，稍后重试: {e}")
+                with self._cond:
+                    self._cond.wait(self.flush_interval)
+
+
+def get_read_receipt_buffer():
+    """
+    获取全局已读回执缓冲（进程退出时写入剩余的回执）
+    """
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                buffer = ReadReceiptBuffer()
+                atexit.register(buffer.close)
+                _buffer = buffer
+    return _buffer
@@ -0,0 +1,242 @@
+# SMTP连接池（复用已登录的SMTP连接发送邮件）
+
+import smtplib
+import threading
+import time
+
+from config import (
+    SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, SMTP_STARTTLS, SMTP_TIMEOUT,
+    SMTP_POOL_SIZE, SMTP_POOL_IDLE_TIMEOUT, SMTP_POOL_WAIT_TIMEOUT, SMTP_POOL_PING_INTERVAL,
+    SMTP_MAX_MESSAGES_PER_CONNECTION
+)
+from database.pool import ConnectionPool
+
+# 服务端关闭连接的响应码（如超过单连接邮件数限制、空闲超时）
+SMTP_SERVICE_CLOSING = 421
+
+# 全局邮件发送器（首次使用时创建）
+_sender = None
+_sender_lock = threading.Lock()
+
+
+class SmtpSession:
+    """
+    一个已完成STARTTLS和登录的SMTP连接
+    """
+
+    def __init__(self, host, port, username, password, starttls=True, timeout=30):
+        self.smtp = smtplib.SMTP(host, port, timeout=timeout)
+        try:
+            if starttls:
+                self.smtp.starttls()
+            if username:
+                self.smtp.login(username, password)
+        except Exception:
+            self.smtp.close()
+            raise
+        self.sent = 0
+        self.broken = False
+
+    def send_message(self, msg):
+        """
+        发送一封邮件，连接断开或服务端关闭连接时标记为不可用
+        """
+        try:
+            self.smtp.send_message(msg)
+        except smtplib.SMTPRecipientsRefused:
+            # 收件人被拒绝不影响连接，smtplib已经RSET
+            raise
+        except smtplib.SMTPResponseException as e:
+            if e.smtp_code == SMTP_SERVICE_CLOSING:
+                self.broken = True
+            raise
+        except OSError:
+            # SMTPServerDisconnected、超时等连接错误
+            self.broken = True
+            raise
+        self.sent += 1
+
+    def noop(self):
+        """
+        检测连接是否可用
+        """
+        return self.smtp.noop()[0] == 250
+
+    def close(self):
+        try:
+            if not self.broken:
+                self.smtp.quit()
+        except Exception:
+            pass
+        finally:
+            self.smtp.close()
+
+
+class SmtpConnectionPool(ConnectionPool):
+    """
+    SMTP连接池：在数据库连接池的基础上，
+    用NOOP代替ping检测空闲连接，并在连接不可用或达到单连接邮件数上限时关闭连接
+
+    参数:
+        max_messages: 单个连接最多发送的邮件数，为0时不限制（很多服务端会限制单连接邮件数）
+        其他参数同ConnectionPool
+    """
+
+    def __init__(self, connect, max_messages=100, **kwargs):
+        super().__init__(connect, **kwargs)
+        self.max_messages = max_messages
+
+    def is_exhausted(self, session):
+        """
+        连接是否已达到单连接邮件数上限
+        """
+        return bool(self.max_messages) and session.sent >= self.max_messages
+
+    def release(self, conn):
+        if conn.broken or self.is_exhausted(conn):
+            self._discard(conn)
+            return
+        super().release(conn)
+
+    def _is_healthy(self, conn, idle_since):
+        if time.monotonic() - idle_since < self.ping_interval:
+            return True
+        try:
+            return conn.noop()
+        except Exception:
+            conn.broken = True
+            return False
+
+    @staticmethod
+    def _in_transaction(conn):
+        return False
+
+
+class SmtpSender:
+    """
+    基于SMTP连接池的邮件发送器
+
+    一批邮件在同一个连接上连续发送；连接被服务端关闭或断开时重连并重试当前邮件一次，
+    达到单连接邮件数上限时换用新连接。
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._failed = 0
+        self._reconnects = 0
+        self._busy_seconds = 0.0
+
+    def send(self, msg):
+        """
+        发送一封邮件，失败时抛出异常
+        """
+        _, failures = self.send_many([msg])
+        if failures:
+            raise failures[0][1]
+
+    def send_many(self, messages):
+        """
+        批量发送邮件
+
+        参数:
+            messages: email.message.Message列表
+
+        返回:
+            (发送成功数量, [(失败邮件的下标, 异常)])
+        """
+        sent = 0
+        failures = []
+        reconnects = 0
+        start = time.monotonic()
+        session = None
+        try:
+            for index, msg in enumerate(messages):
+                session, error, retried = self._deliver(session, msg)
+                reconnects += retried
+                if error is None:
+                    sent += 1
+                else:
+                    failures.append((index, error))
+        finally:
+            if session is not None:
+                session.close()
+            with self._lock:
+                self._sent += sent
+                self._failed += len(failures)
+                self._reconnects += reconnects
+                self._busy_seconds += time.monotonic() - start
+
+        return sent, failures
+
+    def stats(self):
+        """
+        获取发送统计信息（发送数、失败数、重连数、每个连接发送的邮件数、吞吐量）
+        """
+        pool_stats = self.pool.stats()
+        with self._lock:
+            return {
+                'sent': self._sent,
+                'failed': self._failed,
+                'reconnects': self._reconnects,
+                'connections': pool_stats['created'],
+                'open_connections': pool_stats['size'],
+                'messages_per_connection': self._sent / pool_stats['created'] if pool_stats['created'] else 0.0,
+                'messages_per_second': self._sent / self._busy_seconds if self._busy_seconds else 0.0,
+            }
+
+    def close(self):
+        """
+        关闭所有空闲连接
+        """
+        self.pool.close_all()
+
+    def _deliver(self, session, msg):
+        """
+        在session上发送一封邮件，必要时重新获取连接
+        返回 (继续使用的连接, 异常或None, 重连次数)
+        """
+        error = None
+        for attempt in range(2):
+            if session is not None and self.pool.is_exhausted(session):
+                session.close()
+                session = None
+            if session is None:
+                session = self.pool.acquire()
+
+            try:
+                session.send_message(msg)
+                return session, None, attempt
+            except Exception as e:
+                error = e
+                if not session.broken:
+                    return session, e, attempt
+
+            # 连接已不可用：归还时会被关闭，换新连接重试一次
+            session.close()
+            session = None
+
+        return None, error, 1
+
+
+def get_smtp_sender():
+    """
+    获取全局邮件发送器
+    """
+    global _sender
+    if _sender is None:
+        with _sender_lock:
+            if _sender is None:
+                pool = SmtpConnectionPool(
+                    lambda: SmtpSession(SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASSWORD,
+                                        SMTP_STARTTLS, SMTP_TIMEOUT),
+                    max_messages=SMTP_MAX_MESSAGES_PER_CONNECTION,
+                    min_size=0,
+                    max_size=SMTP_POOL_SIZE,
+                    idle_timeout=SMTP_POOL_IDLE_TIMEOUT,
+                    wait_timeout=SMTP_POOL_WAIT_TIMEOUT,
+                    ping_interval=SMTP_POOL_PING_INTERVAL
+                )
+                _sender = SmtpSender(pool)
+    return _sender
@@ -0,0 +1,193 @@
+# Telegram消息发送服务（长期运行的事件循环 + 共享Bot实例）
+
+import asyncio
+import atexit
+import threading
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from config import TELEGRAM_BOT_TOKEN, TELEGRAM_SENDER_POOL_SIZE, TELEGRAM_SENDER_TIMEOUT
+
+# 全局发送服务（首次使用时启动）
+_sender = None
+_sender_lock = threading.Lock()
+
+
+class TelegramSender:
+    """
+    异步Telegram消息发送服务
+
+    所有消息共用一个Bot实例和它的HTTP连接池，在一个长期运行的事件循环中发送：
+    - 同步代码调用submit()得到concurrent.futures.Future，或调用send()等待结果；
+    - 异步代码（如机器人自身的处理函数）调用await send_async()。
+
+    start()不传loop时在后台线程中运行自己的事件循环；
+    传入机器人正在运行的事件循环时直接使用该循环，不再另开线程。
+
+    参数:
+        token: Bot Token
+        bot: 已有的Bot实例（如Application.bot），传入时不再创建新的Bot
+        pool_size: HTTP连接池大小
+    """
+
+    def __init__(self, token=TELEGRAM_BOT_TOKEN, bot=None, pool_size=TELEGRAM_SENDER_POOL_SIZE):
+        self._token = token
+        self._bot = bot
+        self._owns_bot = bot is None
+        self._pool_size = pool_size
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._submitted = 0
+        self._sent = 0
+        self._failed = 0
+
+    @property
+    def running(self):
+        return self._loop is not None and not self._loop.is_closed()
+
+    def start(self, loop=None):
+        """
+        启动发送服务（重复调用无副作用）
+
+        参数:
+            loop: 已在运行的事件循环，为None时在后台线程中创建事件循环
+        """
+        with self._lock:
+            if self.running:
+                return
+
+            if loop is not None:
+                self._loop = loop
+                return
+
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, args=(loop, ready), name='telegram-sender', daemon=True
+            )
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+
+    def stop(self, timeout=10):
+        """
+        停止发送服务，关闭Bot的HTTP连接
+        """
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+
+        if loop is None or thread is None:
+            # 使用外部事件循环时由外部负责关闭
+            return
+
+        try:
+            if self._bot is not None and self._owns_bot:
+                asyncio.run_coroutine_threadsafe(self._bot.shutdown(), loop).result(timeout)
+        except Exception as e:
+            print(f"关闭Telegram Bot失败: {e}")
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout)
+
+    def submit(self, chat_id, text, **kwargs):
+        """
+        从同步代码提交一条消息，返回concurrent.futures.Future（结果为发送的Message）
+        """
+        self.start()
+        if self._in_loop_thread():
+            raise RuntimeError("在发送服务的事件循环中请使用await send_async()")
+
+        with self._stats_lock:
+            self._submitted += 1
+        return asyncio.run_coroutine_threadsafe(self._send(chat_id, text, **kwargs), self._loop)
+
+    def send(self, chat_id, text, timeout=TELEGRAM_SENDER_TIMEOUT, **kwargs):
+        """
+        从同步代码发送一条消息并等待结果，发送失败时抛出异常
+        """
+        return self.submit(chat_id, text, **kwargs).result(timeout)
+
+    async def send_async(self, chat_id, text, **kwargs):
+        """
+        从异步代码发送一条消息
+        在发送服务的事件循环中直接执行，在其他事件循环中则提交后等待
+        """
+        self.start()
+        if self._in_loop_thread():
+            with self._stats_lock:
+                self._submitted += 1
+            return await self._send(chat_id, text, **kwargs)
+        return await asyncio.wrap_future(self.submit(chat_id, text, **kwargs))
+
+    def stats(self):
+        """
+        获取发送统计信息
+        """
+        with self._stats_lock:
+            return {
+                'submitted': self._submitted,
+                'sent': self._sent,
+                'failed': self._failed,
+                'pending': self._submitted - self._sent - self._failed,
+            }
+
+    async def _send(self, chat_id, text, **kwargs):
+        try:
+            bot = await self._get_bot()
+            message = await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except Exception:
+            with self._stats_lock:
+                self._failed += 1
+            raise
+        with self._stats_lock:
+            self._sent += 1
+        return message
+
+    async def _get_bot(self):
+        """
+        在事件循环中创建并初始化Bot（只执行一次）
+        """
+        if self._bot is None:
+            request = HTTPXRequest(connection_pool_size=self._pool_size)
+            bot = Bot(self._token, request=request)
+            await bot.initialize()
+            if self._bot is None:
+                self._bot = bot
+            else:
+                await bot.shutdown()
+        return self._bot
+
+    def _in_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    @staticmethod
+    def _run(loop, ready):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+
+def get_telegram_sender():
+    """
+    获取全局Telegram发送服务（首次调用时启动，进程退出时停止）
+    """
+    global _sender
+    if _sender is None:
+        with _sender_lock:
+            if _sender is None:
+                sender = TelegramSender()
+                sender.start()
+                atexit.register(sender.stop)
+                _sender = sender
+    return _sender
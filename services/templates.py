@@ -0,0 +1,206 @@
+# 通知模板（启动时预编译，支持多语言和批量渲染）
+
+import re
+import string
+import threading
+
+from config import NOTIFICATION_TEMPLATES, NOTIFICATION_DEFAULT_LOCALE
+
+# 模板字段名只允许标识符（不允许属性访问和下标）
+_FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# 全局模板注册表（首次使用时编译）
+_registry = None
+_registry_lock = threading.Lock()
+
+
+class TemplateError(Exception):
+    """
+    模板不存在或格式错误
+    """
+
+
+class _ChoiceFields:
+    """
+    渲染时传给str.format_map的映射：选择字段由对应函数根据整行生成，其他字段从row读取
+    """
+
+    __slots__ = ('row', 'choices')
+
+    def __init__(self, row, choices):
+        self.row = row
+        self.choices = choices
+
+    def __getitem__(self, key):
+        choice = self.choices.get(key)
+        if choice is not None:
+            return choice(self.row)
+        return self.row[key]
+
+
+def compile_text(text, choices=None):
+    """
+    将str.format风格的模板编译为渲染函数 render(row) -> str
+
+    模板在编译时用string.Formatter解析一次，校验字段名和格式说明，
+    渲染时直接调用str.format_map。字段从row[字段名]读取（row可以是dict或Row），
+    支持格式说明，如 {end_date:%Y-%m-%d %H:%M:%S}、{amount:.2f}。
+
+    参数:
+        text: 模板文本
+        choices: {字段名: 渲染函数}，这些字段的值由对应函数根据整行生成
+
+    返回:
+        渲染函数
+    """
+    choices = choices or {}
+    used = {}
+    has_fields = False
+    for literal, field, spec, conversion in string.Formatter().parse(text):
+        if field is None:
+            continue
+        has_fields = True
+        if field in choices:
+            used[field] = choices[field]
+        elif not _FIELD_NAME.match(field):
+            raise TemplateError(f"模板字段名无效: {field}")
+        # 格式说明中嵌套的字段不做校验，直接拒绝
+        if spec and ('{' in spec or '}' in spec):
+            raise TemplateError(f"模板格式说明无效: {spec}")
+
+    if not has_fields:
+        # 纯文本模板只需处理{{和}}转义一次
+        constant = text.format_map({})
+        return lambda row: constant
+    if not used:
+        return text.format_map
+
+    format_map = text.format_map
+    return lambda row: format_map(_ChoiceFields(row, used))
+
+
+def compile_choice(field, values):
+    """
+    编译一个选择字段：根据row[field]的值选择对应的模板渲染
+    选项是布尔值（true/false）时按bool(row[field])匹配，数据库返回的1/0和NULL都能匹配到；
+    没有匹配的值时使用default，默认为空字符串
+    """
+    renderers = {key: compile_text(str(value)) for key, value in values.items() if key != 'default'}
+    default = compile_text(str(values.get('default', '')))
+
+    if renderers and all(isinstance(key, bool) for key in renderers):
+        def render(row):
+            return renderers.get(bool(row[field]), default)(row)
+    else:
+        def render(row):
+            return renderers.get(row[field], default)(row)
+
+    return render
+
+
+class Template:
+    """
+    编译后的通知模板（标题和内容）
+
+    参数:
+        name: 模板名称
+        locale: 语言
+        definition: {'title': ..., 'content': ..., 'choices': {字段名: {'field': ..., 'values': {...}}}}
+    """
+
+    __slots__ = ('name', 'locale', 'title', 'content')
+
+    def __init__(self, name, locale, definition):
+        self.name = name
+        self.locale = locale
+        try:
+            choices = {
+                key: compile_choice(choice['field'], choice['values'])
+                for key, choice in (definition.get('choices') or {}).items()
+            }
+            self.title = compile_text(definition['title'], choices)
+            self.content = compile_text(definition['content'], choices)
+        except (KeyError, ValueError) as e:
+            raise TemplateError(f"模板{name}({locale})格式错误: {e}")
+
+    def render(self, row):
+        """
+        渲染一行数据，返回(title, content)
+        """
+        return self.title(row), self.content(row)
+
+    def render_many(self, rows):
+        """
+        批量渲染，返回[(title, content), ...]
+        """
+        title, content = self.title, self.content
+        return [(title(row), content(row)) for row in rows]
+
+
+class TemplateRegistry:
+    """
+    通知模板注册表
+
+    所有模板在创建注册表时一次性编译；同一模板可以有多个语言版本，
+    查找时依次尝试完整的语言（如zh_CN）、语言前缀（如zh）和默认语言。
+
+    参数:
+        templates: {模板名称: {语言: 模板定义}}
+        default_locale: 默认语言
+    """
+
+    def __init__(self, templates=NOTIFICATION_TEMPLATES, default_locale=NOTIFICATION_DEFAULT_LOCALE):
+        self.default_locale = default_locale
+        self._templates = {
+            (name, locale): Template(name, locale, definition)
+            for name, variants in templates.items()
+            for locale, definition in variants.items()
+        }
+        self._resolved = {}  # (name, 请求的locale) -> 回退后的模板
+
+    def get(self, name, locale=None):
+        """
+        获取编译后的模板（语言回退的结果会被缓存）
+        """
+        template = self._resolved.get((name, locale))
+        if template is not None:
+            return template
+
+        candidates = [locale, locale.split('_')[0]] if locale else []
+        candidates.append(self.default_locale)
+        for candidate in candidates:
+            template = self._templates.get((name, candidate))
+            if template is not None:
+                self._resolved[(name, locale)] = template
+                return template
+        raise TemplateError(f"模板不存在: {name}({locale or self.default_locale})")
+
+    def render(self, name, row, locale=None):
+        """
+        渲染一条通知，返回(title, content)
+        """
+        return self.get(name, locale).render(row)
+
+    def render_many(self, name, rows, locale=None):
+        """
+        用同一模板批量渲染多行数据（如到期提醒扫描、群发），返回[(title, content), ...]
+        """
+        return self.get(name, locale).render_many(rows)
+
+    def locales(self, name):
+        """
+        获取模板的所有语言版本
+        """
+        return sorted(locale for template_name, locale in self._templates if template_name == name)
+
+
+def get_template_registry():
+    """
+    获取全局模板注册表
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = TemplateRegistry()
+    return _registry
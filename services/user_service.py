@@ -1,8 +1,9 @@
 # 用户服务
 
 import datetime
-from database.models import User, Subscription
+from database.models import User, Subscription, transaction, read_transaction
 from database.db_manager import DatabaseManager
+from database.vip_index import vip_index, ensure_vip_index_loaded
 
 class UserService:
     """
@@ -55,8 +56,12 @@ class UserService:
     def check_vip_status(telegram_id):
         """
         检查用户VIP状态
+        优先查询内存VIP索引，索引不可用时回退到数据库查询
         """
         try:
+            if ensure_vip_index_loaded():
+                return vip_index.lookup(telegram_id)
+
             user = DatabaseManager.get_user_by_telegram_id(telegram_id)
             if not user:
                 return False, None
@@ -70,116 +75,127 @@ class UserService:
     def activate_vip_with_card(telegram_id, card_key):
         """
         使用卡密激活VIP
+        用户查询、卡密核销、订阅、支付记录和通知在同一个事务中完成，任一步失败整体回滚
         """
         try:
-            # 获取用户ID
-            user = DatabaseManager.get_user_by_telegram_id(telegram_id)
-            if not user:
-                return False, "用户不存在"
-                
-            # 使用卡密
-            card = DatabaseManager.use_card_key(card_key, user['id'])
-            if not card:
-                return False, "卡密无效或已被使用"
-                
-            # 创建订阅
-            from config import SUBSCRIPTION_PLANS
-            plan_type = card['plan_type']
-            
-            if plan_type not in SUBSCRIPTION_PLANS:
-                return False, "无效的订阅计划"
-                
-            plan = SUBSCRIPTION_PLANS[plan_type]
-            start_date = datetime.datetime.now()
-            end_date = start_date + datetime.timedelta(days=plan['duration_days'])
-            
-            subscription = Subscription(user['id'], plan_type, start_date, end_date)
-            subscription_id = subscription.save()
-            
-            # 创建支付记录
-            DatabaseManager.create_payment(
-                user['id'], 
-                'card', 
-                plan['price'], 
-                'CNY', 
-                subscription_id,
-                {'card_key_id': card['id']}
-            )
-            
-            # 创建通知
-            notification_title = "VIP激活成功"
-            notification_content = f"您已成功激活{plan['name']}，有效期至{end_date.strftime('%Y-%m-%d %H:%M:%S')}"
-            
-            DatabaseManager.create_notification(
-                user['id'],
-                'payment_success',
-                notification_title,
-                notification_content,
-                is_email=True,
-                is_telegram=True
-            )
-            
+            with transaction() as conn:
+                # 获取用户ID
+                user = DatabaseManager.get_user_by_telegram_id(telegram_id, conn=conn)
+                if not user:
+                    return False, "用户不存在"
+
+                # 使用卡密
+                card = DatabaseManager.use_card_key(card_key, user['id'], conn=conn)
+                if not card:
+                    return False, "卡密无效或已被使用"
+
+                # 创建订阅
+                from config import SUBSCRIPTION_PLANS
+                plan_type = card['plan_type']
+
+                if plan_type not in SUBSCRIPTION_PLANS:
+                    # 计划无效时不核销卡密
+                    conn.rollback()
+                    return False, "无效的订阅计划"
+
+                plan = SUBSCRIPTION_PLANS[plan_type]
+                start_date = datetime.datetime.now()
+                end_date = start_date + datetime.timedelta(days=plan['duration_days'])
+
+                subscription = Subscription(user['id'], plan_type, start_date, end_date)
+                subscription_id = subscription.save(conn=conn)
+
+                # 创建支付记录
+                DatabaseManager.create_payment(
+                    user['id'],
+                    'card',
+                    plan['price'],
+                    'CNY',
+                    subscription_id,
+                    {'card_key_id': card['id']},
+                    conn=conn
+                )
+
+                # 创建通知
+                notification_title = "VIP激活成功"
+                notification_content = f"您已成功激活{plan['name']}，有效期至{end_date.strftime('%Y-%m-%d %H:%M:%S')}"
+
+                DatabaseManager.create_notification(
+                    user['id'],
+                    'payment_success',
+                    notification_title,
+                    notification_content,
+                    is_email=True,
+                    is_telegram=True,
+                    conn=conn
+                )
+
             return True, f"成功激活{plan['name']}，有效期至{end_date.strftime('%Y-%m-%d %H:%M:%S')}"
-            
+
         except Exception as e:
             print(f"激活VIP失败: {e}")
             return False, f"激活失败: {str(e)}"
-    
+
     @staticmethod
     def cancel_subscription(telegram_id):
         """
         取消用户订阅
+        订阅状态、VIP状态和通知在同一个事务中提交
         """
         try:
-            # 获取用户ID
-            user = DatabaseManager.get_user_by_telegram_id(telegram_id)
-            if not user:
-                return False, "用户不存在"
-                
-            # 获取活跃订阅
-            subscription = Subscription.get_active_by_user_id(user['id'])
-            if not subscription:
-                return False, "没有活跃的订阅"
-                
-            # 取消订阅
-            result = Subscription.cancel_subscription(subscription['id'])
-            if not result:
-                return False, "取消订阅失败"
-                
-            # 创建通知
-            notification_title = "订阅已取消"
-            notification_content = "您的VIP订阅已成功取消"
-            
-            DatabaseManager.create_notification(
-                user['id'],
-                'system',
-                notification_title,
-                notification_content,
-                is_email=True,
-                is_telegram=True
-            )
-            
+            with transaction() as conn:
+                # 获取用户ID
+                user = DatabaseManager.get_user_by_telegram_id(telegram_id, conn=conn)
+                if not user:
+                    return False, "用户不存在"
+
+                # 获取活跃订阅
+                subscription = Subscription.get_active_by_user_id(user['id'], conn=conn)
+                if not subscription:
+                    return False, "没有活跃的订阅"
+
+                # 取消订阅
+                result = Subscription.cancel_subscription(subscription['id'], conn=conn)
+                if not result:
+                    return False, "取消订阅失败"
+
+                # 创建通知
+                notification_title = "订阅已取消"
+                notification_content = "您的VIP订阅已成功取消"
+
+                DatabaseManager.create_notification(
+                    user['id'],
+                    'system',
+                    notification_title,
+                    notification_content,
+                    is_email=True,
+                    is_telegram=True,
+                    conn=conn
+                )
+
             return True, "订阅已成功取消"
-            
+
         except Exception as e:
             print(f"取消订阅失败: {e}")
             return False, f"取消失败: {str(e)}"
-    
+
     @staticmethod
     def get_subscription_info(telegram_id):
         """
         获取用户订阅信息
         """
         try:
-            # 获取用户ID
-            user = DatabaseManager.get_user_by_telegram_id(telegram_id)
-            if not user:
-                return None
-                
-            # 获取活跃订阅
-            subscription = Subscription.get_active_by_user_id(user['id'])
-            if not subscription:
-                return None
+            # 只读查询，两次读取共用一个（副本）连接，不开启写事务
+            with read_transaction() as conn:
+                # 获取用户ID
+                user = DatabaseManager.get_user_by_telegram_id(telegram_id, conn=conn)
+                if not user:
+                    return None
+
+                # 获取活跃订阅
+                subscription = Subscription.get_active_by_user_id(user['id'], conn=conn)
+                if not subscription:
+                    return None
                 
             from config import SUBSCRIPTION_PLANS
             plan_type = subscription['plan_type']
@@ -0,0 +1,110 @@
+# 异步数据库管理器测试（SQLite后端，离线运行）
+
+import asyncio
+import re
+from pathlib import Path
+
+import pytest
+
+from database.async_db_manager import AsyncDatabaseManager, SQLiteBackend, async_transaction, set_async_backend
+from database.migrations import MIGRATIONS
+
+# MySQL建表语句中不是列定义的行
+_NON_COLUMN_WORDS = {'PRIMARY', 'FOREIGN', 'UNIQUE', 'INDEX', 'KEY', 'CONSTRAINT'}
+_CREATE_TABLE = re.compile(r'CREATE TABLE IF NOT EXISTS (\w+)\s*\((.*?)\)\s*ENGINE', re.DOTALL)
+_ADD_COLUMN = re.compile(r'ALTER TABLE (\w+) ADD COLUMN (\w+)')
+
+
+def mysql_schema():
+    """
+    从init_database和迁移中解析出MySQL的表和列：{表名: {列名}}
+    """
+    statements = [(Path(__file__).parent.parent / 'database' / 'models.py').read_text(encoding='utf-8')]
+    statements += [statement for _, _, migration in MIGRATIONS for statement in migration]
+
+    tables = {}
+    for statement in statements:
+        for table, body in _CREATE_TABLE.findall(statement):
+            columns = tables.setdefault(table, set())
+            for line in body.splitlines():
+                word = line.strip().split(' ', 1)[0]
+                if word and word.upper() not in _NON_COLUMN_WORDS and re.match(r'^\w+$', word):
+                    columns.add(word)
+        for table, column in _ADD_COLUMN.findall(statement):
+            tables.setdefault(table, set()).add(column)
+    return tables
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def backend():
+    backend = SQLiteBackend()
+    set_async_backend(backend)
+    run(AsyncDatabaseManager.initialize_database())
+    yield backend
+    run(backend.close())
+    set_async_backend(None)
+
+
+async def _create_users(count, vip=lambda user_id: True):
+    async with async_transaction() as session:
+        await session.executemany(
+            "INSERT INTO users (telegram_id, is_vip, email) VALUES (%s, %s, %s)",
+            [(1000 + i, vip(i), f"user{i}@example.com") for i in range(1, count + 1)]
+        )
+
+
+def test_sqlite_schema_matches_mysql(backend):
+    async def sqlite_schema():
+        async with async_transaction() as session:
+            result = await session.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            tables = {}
+            for row in result.fetchall():
+                if row['name'].startswith('sqlite_'):
+                    continue
+                info = await session.execute(f"PRAGMA table_info({row['name']})")
+                tables[row['name']] = {column['name'] for column in info.fetchall()}
+            return tables
+
+    assert run(sqlite_schema()) == mysql_schema()
+
+
+def test_create_card_key_inserts_batch(backend):
+    keys = run(AsyncDatabaseManager.create_card_key('monthly', count=5))
+
+    assert len({key['card_key'] for key in keys}) == 5
+    assert all(key['plan_type'] == 'monthly' for key in keys)
+    stored = run(AsyncDatabaseManager.execute_query("SELECT id, card_key FROM card_keys ORDER BY id"))
+    assert sorted((key['id'], key['card_key']) for key in keys) == [(row['id'], row['card_key']) for row in stored]
+
+
+def test_send_message_chunks_and_counts_unread(backend):
+    run(_create_users(7, vip=lambda user_id: user_id % 2 == 1))
+    message_id = run(AsyncDatabaseManager.create_message('标题', '内容', is_vip_only=True))
+
+    chunks = run(AsyncDatabaseManager.materialize_audience(message_id, chunk_size=2))
+    assert [(c['first_id'], c['last_id'], c['count']) for c in chunks] == [(1, 3, 2), (5, 7, 2)]
+
+    # 重新执行和重叠的指定用户列表只为新写入的记录计数
+    assert run(AsyncDatabaseManager.send_message_to_users(message_id)) == 0
+    assert run(AsyncDatabaseManager.send_message_to_users(message_id, user_ids=[2, 3, 2])) == 1
+
+    unread = [run(AsyncDatabaseManager.get_unread_count(user_id)) for user_id in range(1, 8)]
+    assert unread == [1, 1, 1, 0, 1, 0, 1]
+    assert run(AsyncDatabaseManager.send_message_to_users(999)) is False
+
+
+def test_pending_notifications_include_recipient(backend):
+    run(_create_users(2))
+    run(AsyncDatabaseManager.create_notification(1, 'system', '标题', '内容', is_email=True, dedupe_key='a' * 32))
+    run(AsyncDatabaseManager.create_notification(2, 'system', '标题', '内容', is_email=False))
+
+    pending = run(AsyncDatabaseManager.get_pending_notifications(is_email=True))
+
+    assert len(pending) == 1
+    assert pending[0]['email'] == 'user1@example.com'
+    assert pending[0]['telegram_id'] == 1001
+    assert pending[0]['dedupe_key'] == 'a' * 32
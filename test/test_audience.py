@@ -0,0 +1,163 @@
+# 消息发送记录分块写入和未读数测试（内存中的users / message_deliveries / user_unread_counters表替身）
+
+from database.db_manager import DatabaseManager
+
+
+class FakeAudienceConnection:
+    """
+    只支持materialize_audience所用语句的连接替身
+
+    参数:
+        users: {user_id: is_vip}
+        is_vip_only: 消息是否仅VIP可见
+    """
+
+    def __init__(self, users, is_vip_only=True):
+        self.users = users
+        self.is_vip_only = is_vip_only
+        self.deliveries = {}  # (message_id, user_id) -> 自增ID
+        self.unread = {}  # user_id -> 未读数
+        self.queries = []
+
+    def cursor(self, cursor_class=None):
+        return FakeAudienceCursor(self)
+
+    def recipients(self, sql):
+        vip_only = 'is_vip = TRUE' in sql
+        return sorted(user_id for user_id, is_vip in self.users.items() if is_vip or not vip_only)
+
+
+class FakeAudienceCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+        self._row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=()):
+        sql = ' '.join(query.split())
+        self.conn.queries.append(sql)
+        params = list(params)
+
+        if sql.startswith('SELECT is_vip_only FROM messages'):
+            self._row = {'is_vip_only': self.conn.is_vip_only}
+        elif sql.startswith('SELECT id FROM messages WHERE id = %s FOR UPDATE'):
+            self._row = {'id': params[0]}
+        elif sql.startswith('SELECT COALESCE(MAX(id), 0) AS max_id FROM message_deliveries'):
+            assert sql.endswith('FOR SHARE'), sql
+            message_id, first_id, last_id = params
+            self._row = {'max_id': max((
+                delivery_id for (delivery_message_id, user_id), delivery_id in self.conn.deliveries.items()
+                if delivery_message_id == message_id and first_id <= user_id <= last_id
+            ), default=0)}
+        elif sql.startswith('SELECT MIN(id) AS first_id'):
+            after_id, limit = params
+            ids = [user_id for user_id in self.conn.recipients(sql) if user_id > after_id][:limit]
+            self._row = {'first_id': min(ids, default=None), 'last_id': max(ids, default=None), 'users': len(ids)}
+        elif sql.startswith('INSERT IGNORE INTO message_deliveries (message_id, user_id) SELECT'):
+            message_id, first_id, last_id = params
+            self._insert(message_id, [u for u in self.conn.recipients(sql) if first_id <= u <= last_id])
+        elif sql.startswith('INSERT INTO user_unread_counters'):
+            # 按本事务新写入的发送记录加1
+            message_id, first_id, last_id, max_id = params
+            for (delivery_message_id, user_id), delivery_id in self.conn.deliveries.items():
+                if delivery_message_id == message_id and first_id <= user_id <= last_id and delivery_id > max_id:
+                    self.conn.unread[user_id] = self.conn.unread.get(user_id, 0) + 1
+        else:
+            raise AssertionError(f"未预期的语句: {sql}")
+
+    def executemany(self, query, rows):
+        sql = ' '.join(query.split())
+        self.conn.queries.append(sql)
+        assert sql.startswith('INSERT IGNORE INTO message_deliveries'), sql
+        message_ids = {message_id for message_id, _ in rows}
+        assert len(message_ids) == 1
+        self._insert(message_ids.pop(), [user_id for _, user_id in rows])
+
+    def fetchone(self):
+        return self._row
+
+    def _insert(self, message_id, user_ids):
+        self.rowcount = 0
+        for user_id in user_ids:
+            if (message_id, user_id) not in self.conn.deliveries:
+                self.conn.deliveries[(message_id, user_id)] = len(self.conn.deliveries) + 1
+                self.rowcount += 1
+
+
+def _chunks(chunks):
+    return [(chunk['first_id'], chunk['last_id'], chunk['count']) for chunk in chunks]
+
+
+def test_sparse_vip_audience_is_chunked_by_keyset():
+    # 100个用户中只有4个VIP：每块都包含chunk_size个接收用户，而不是按ID窗口切出大量空块
+    users = {user_id: user_id in (5, 50, 51, 99) for user_id in range(1, 101)}
+    conn = FakeAudienceConnection(users)
+
+    chunks = DatabaseManager.materialize_audience(1, chunk_size=2, conn=conn)
+
+    assert _chunks(chunks) == [(5, 50, 2), (51, 99, 2)]
+    assert set(conn.deliveries) == {(1, 5), (1, 50), (1, 51), (1, 99)}
+
+
+def test_last_short_chunk_ends_without_extra_query():
+    users = {user_id: True for user_id in range(1, 6)}
+    conn = FakeAudienceConnection(users)
+
+    chunks = DatabaseManager.materialize_audience(1, chunk_size=2, conn=conn)
+
+    assert _chunks(chunks) == [(1, 2, 2), (3, 4, 2), (5, 5, 1)]
+    assert sum(1 for q in conn.queries if q.startswith('SELECT MIN(id)')) == 3
+
+
+def test_rerun_skips_existing_deliveries():
+    users = {1: False, 2: False, 3: False}
+    conn = FakeAudienceConnection(users, is_vip_only=False)
+
+    assert DatabaseManager.send_message_to_users(1, conn=conn) == 3
+    assert DatabaseManager.send_message_to_users(1, conn=conn) == 0
+
+
+def test_explicit_user_ids_are_sorted_and_deduplicated():
+    conn = FakeAudienceConnection({})
+
+    chunks = DatabaseManager.materialize_audience(1, user_ids=[3, 1, 3, 2, 1], chunk_size=2, conn=conn)
+
+    assert _chunks(chunks) == [(1, 2, 2), (3, 3, 1)]
+    assert set(conn.deliveries) == {(1, 1), (1, 2), (1, 3)}
+
+
+def test_unread_counters_follow_inserted_rows():
+    users = {user_id: True for user_id in range(1, 6)}
+    conn = FakeAudienceConnection(users)
+
+    DatabaseManager.send_message_to_users(1, conn=conn)
+    # 重新执行和与已有记录重叠的指定用户列表都只为新写入的记录计数
+    DatabaseManager.send_message_to_users(1, conn=conn)
+    DatabaseManager.send_message_to_users(1, user_ids=[4, 5, 6], conn=conn)
+    DatabaseManager.send_message_to_users(2, user_ids=[1, 6], conn=conn)
+
+    assert conn.unread == {1: 2, 2: 1, 3: 1, 4: 1, 5: 1, 6: 2}
+
+
+def test_message_locked_before_chunk_reads():
+    # 每块先锁定消息行，再读取范围和已有发送记录的最大ID
+    users = {user_id: True for user_id in range(1, 6)}
+    conn = FakeAudienceConnection(users)
+
+    DatabaseManager.materialize_audience(1, chunk_size=2, conn=conn)
+    DatabaseManager.materialize_audience(2, user_ids=[1, 2, 3], chunk_size=2, conn=conn)
+
+    chunk_reads = [
+        i for i, q in enumerate(conn.queries)
+        if q.startswith('SELECT MIN(id)') or q.startswith('SELECT COALESCE(MAX(id)')
+    ]
+    for i in chunk_reads:
+        previous = [q for q in conn.queries[:i] if 'FOR UPDATE' in q or q.startswith('INSERT')]
+        assert previous and 'FOR UPDATE' in previous[-1]
@@ -0,0 +1,48 @@
+# 进程内缓存测试
+
+from database.cache import LRUCache, UnreadCounterCache, UserCache
+
+
+def test_set_skipped_after_invalidation_during_read():
+    cache = LRUCache(max_size=10, ttl=0)
+    generation = cache.generation()
+    # 读取数据库期间，另一个线程提交了修改并失效了该条目
+    cache.invalidate('a')
+    assert cache.set('a', 'stale', generation) is False
+    assert cache.get('a', None) is None
+
+    assert cache.set('a', 'fresh', cache.generation()) is True
+    assert cache.get('a') == 'fresh'
+
+
+def test_forgotten_invalidations_reject_old_generations():
+    cache = LRUCache(max_size=2, ttl=0)
+    generation = cache.generation()
+    for key in range(5):
+        cache.invalidate(key)
+    # 失效记录已被清理，无法确认key是否被失效过，按过期处理
+    assert cache.set('other', 1, generation) is False
+    assert cache.set('other', 1, cache.generation()) is True
+
+
+def test_user_cache_invalidate_user_id_before_first_fill():
+    cache = UserCache(max_size=10, ttl=0)
+    generation = cache.generation()
+    # 用户还不在缓存中（没有telegram_id映射）时按用户ID失效
+    cache.invalidate_user_id(7)
+    assert cache.set(1007, {'id': 7, 'is_vip': False}, generation) is False
+
+    cache.set(1007, {'id': 7, 'is_vip': True}, cache.generation())
+    cache.invalidate_user_id(7)
+    assert cache.get(1007, None) is None
+
+
+def test_unread_range_invalidation_discards_inflight_reads():
+    cache = UnreadCounterCache(max_size=10, ttl=60)
+    generation = cache.generation()
+    # 读取计数期间群发写入了这一范围的发送记录
+    cache.invalidate_range(1, 100)
+
+    assert cache.set(42, 3, generation) is False
+    assert cache.get(42, None) is None
+    assert cache.set(42, 4, cache.generation()) is True
@@ -0,0 +1,42 @@
+# 数据库迁移与热点查询检查测试
+
+import re
+
+from database.migrations import HOT_QUERIES, MIGRATIONS, find_scans
+
+
+def _plan_row(table, scan_type, rows, possible_keys=None, key=None):
+    return {'table': table, 'type': scan_type, 'rows': rows, 'possible_keys': possible_keys, 'key': key}
+
+
+def test_full_table_scan_without_index_is_flagged():
+    plan = [_plan_row('md', 'ALL', 10)]
+    assert find_scans('q', 'md', plan, min_rows=1000) == ["q: 表md没有可用索引"]
+
+
+def test_full_index_scan_is_flagged():
+    plan = [_plan_row('md', 'index', 50000, key='idx_user_delivered')]
+    failures = find_scans('q', 'md', plan, min_rows=1000)
+    assert len(failures) == 1
+    assert '全索引扫描' in failures[0]
+
+
+def test_small_or_indexed_scans_pass():
+    plan = [
+        _plan_row('md', 'index', 10, key='idx_user_delivered'),
+        _plan_row('md', 'ALL', 10, possible_keys='idx_user_delivered'),
+        _plan_row('md', 'ref', 50000, possible_keys='idx_user_delivered', key='idx_user_delivered'),
+        _plan_row('u', 'ALL', 50000),
+    ]
+    assert find_scans('q', 'md', plan, min_rows=1000) == []
+
+
+def test_hot_queries_reference_checked_table():
+    for name, table, query, params in HOT_QUERIES:
+        assert re.search(rf'\b{re.escape(table)}\b', query), name
+        assert query.count('%s') == len(params), name
+
+
+def test_migration_versions_are_sequential():
+    versions = [version for version, _, _ in MIGRATIONS]
+    assert versions == list(range(1, len(MIGRATIONS) + 1))
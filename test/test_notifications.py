@@ -0,0 +1,110 @@
+# 通知认领测试（内存中的notifications表替身，按SQL中的条件过滤）
+
+from database.db_manager import DatabaseManager
+
+
+class FakeNotificationsConnection:
+    """
+    只支持claim_notifications所用语句的连接替身
+
+    每条通知是一个dict，due表示已到重试时间，leased表示租约未过期；
+    兄弟通知查询只应用SQL中实际写出的条件，用于检查合并认领的过滤条件。
+    """
+
+    def __init__(self, notifications):
+        self.notifications = {n['id']: n for n in notifications}
+        self.first_ids = []
+        self.claimed = []
+        self.queries = []
+
+    def cursor(self, cursor_class=None):
+        return FakeNotificationsCursor(self)
+
+
+class FakeNotificationsCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=()):
+        sql = ' '.join(query.split())
+        self.conn.queries.append(sql)
+        params = list(params)
+        notifications = self.conn.notifications.values()
+
+        if sql.startswith('SELECT id, user_id FROM notifications'):
+            # 第一批：已到重试时间、未认领且已过合并窗口的通知
+            limit = params[-1]
+            rows = [n for n in notifications if self._pending(n) and n['due'] and not n['leased']]
+            self._rows = [{'id': n['id'], 'user_id': n['user_id']} for n in rows[:limit]]
+            self.conn.first_ids = [row['id'] for row in self._rows]
+        elif sql.startswith('SELECT id FROM notifications'):
+            # 合并认领：只应用SQL中写出的条件
+            user_ids = params[:-len(self.conn.first_ids)]
+            rows = [
+                n for n in notifications
+                if n['user_id'] in user_ids and n['id'] not in self.conn.first_ids and self._pending(n)
+                and ('next_attempt_at <= NOW()' not in sql or n['due'])
+                and ('lease_until IS NULL' not in sql or not n['leased'])
+            ]
+            self._rows = [{'id': n['id']} for n in rows]
+        elif sql.startswith('UPDATE notifications SET claimed_by'):
+            self.conn.claimed = params[2:]
+            self._rows = []
+        elif sql.startswith('SELECT n.*'):
+            self._rows = [dict(self.conn.notifications[i]) for i in sorted(params)]
+        else:
+            raise AssertionError(f"未预期的语句: {sql}")
+
+    def fetchall(self):
+        return self._rows
+
+    @staticmethod
+    def _pending(notification):
+        return not notification['is_sent'] and not notification['is_dead']
+
+
+def _notification(notification_id, user_id, due=True, leased=False):
+    return {
+        'id': notification_id, 'user_id': user_id, 'is_sent': False, 'is_dead': False,
+        'is_email': False, 'is_telegram': True, 'due': due, 'leased': leased,
+    }
+
+
+def test_coalesce_claims_due_siblings():
+    conn = FakeNotificationsConnection([
+        _notification(1, 10),
+        _notification(2, 20, leased=True),
+        _notification(3, 10),
+    ])
+
+    # 第一批只取1条，同用户的通知3被合并认领
+    claimed = DatabaseManager.claim_notifications(
+        'worker', 1, 60, is_telegram=True, coalesce_window=30, conn=conn
+    )
+
+    assert [n['id'] for n in claimed] == [1, 3]
+    assert conn.claimed == [1, 3]
+
+
+def test_backed_off_sibling_is_not_coalesced():
+    conn = FakeNotificationsConnection([
+        _notification(1, 10),
+        _notification(2, 10, due=False),  # 发送失败后正在退避等待重试
+    ])
+
+    claimed = DatabaseManager.claim_notifications(
+        'worker', 10, 60, is_telegram=True, coalesce_window=30, conn=conn
+    )
+
+    assert [n['id'] for n in claimed] == [1]
+    assert conn.claimed == [1]
+    sibling_query = next(q for q in conn.queries if q.startswith('SELECT id FROM notifications'))
+    assert 'next_attempt_at <= NOW()' in sibling_query
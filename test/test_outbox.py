@@ -0,0 +1,44 @@
+# 本地通知发件箱测试
+
+import pytest
+
+from database.db_manager import DatabaseManager
+from database.outbox import NotificationOutbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = NotificationOutbox(path=str(tmp_path))
+    yield outbox
+    outbox.close()
+
+
+@pytest.fixture
+def replayed(monkeypatch):
+    records = []
+
+    def insert_spooled_notifications(batch, conn=None):
+        records.extend(batch)
+        return len(batch)
+
+    monkeypatch.setattr(DatabaseManager, 'insert_spooled_notifications', insert_spooled_notifications)
+    return records
+
+
+def test_spooled_notification_keeps_dedupe_key(outbox, replayed):
+    # 直接写入数据库时使用的dedupe_key，转存时原样保留，回放由INSERT IGNORE去重
+    key = outbox.append(1, 'system', '标题', '内容', durable=False, dedupe_key='a' * 32)
+    assert key == 'a' * 32
+
+    assert outbox.flush() == 1
+    assert [r['dedupe_key'] for r in replayed] == ['a' * 32]
+    assert outbox.pending_segments() == 0
+
+
+def test_spooled_notification_generates_dedupe_key(outbox, replayed):
+    first = outbox.append(1, 'system', '标题', '内容', durable=False)
+    second = outbox.append(1, 'system', '标题', '内容', durable=False)
+
+    assert first != second
+    assert outbox.flush() == 2
+    assert [r['dedupe_key'] for r in replayed] == [first, second]
@@ -0,0 +1,246 @@
+# SMTP连接池测试（本机进程内的SMTP替身服务器）
+
+import base64
+import socket
+import socketserver
+import threading
+from email.message import EmailMessage
+
+import pytest
+
+from services.smtp_pool import SmtpConnectionPool, SmtpSender, SmtpSession
+
+USERNAME = 'bot@example.com'
+PASSWORD = 'secret'
+
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    """
+    只实现发送邮件所需命令的SMTP服务器，记录连接、登录、NOOP和收到的邮件
+
+    参数:
+        messages_per_connection: 单个连接收到这么多封邮件后，下一封邮件回复421并断开，为0时不限制
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages_per_connection=0):
+        super().__init__(('127.0.0.1', 0), FakeSmtpHandler)
+        self.messages_per_connection = messages_per_connection
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.logins = 0
+        self.noops = 0
+        self.quits = 0
+        self.messages = []  # (连接序号, 邮件内容)
+        self.sockets = set()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
+
+    def drop_connections(self):
+        """
+        从服务端断开所有客户端连接（模拟网络中断或服务端重启）
+        """
+        with self.lock:
+            sockets, self.sockets = list(self.sockets), set()
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            connection = server.connections
+            server.sockets.add(self.connection)
+
+        received = 0
+        self.reply('220 fake ESMTP')
+        while True:
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                return
+            if not line:
+                return
+            command = line.decode('ascii').strip()
+            verb = command.split(' ', 1)[0].upper()
+
+            if verb == 'EHLO':
+                self.reply('250-fake', '250 AUTH PLAIN')
+            elif verb == 'HELO':
+                self.reply('250 fake')
+            elif verb == 'AUTH':
+                credentials = base64.b64decode(command.split()[2]).split(b'\0')
+                if credentials[1:] == [USERNAME.encode(), PASSWORD.encode()]:
+                    with server.lock:
+                        server.logins += 1
+                    self.reply('235 authenticated')
+                else:
+                    self.reply('535 authentication failed')
+            elif verb == 'MAIL':
+                if server.messages_per_connection and received >= server.messages_per_connection:
+                    self.reply('421 too many messages')
+                    return
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 end with .')
+                body = []
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                    body.append(data)
+                received += 1
+                with server.lock:
+                    server.messages.append((connection, b''.join(body)))
+                self.reply('250 queued')
+            elif verb == 'NOOP':
+                with server.lock:
+                    server.noops += 1
+                self.reply('250 ok')
+            elif verb == 'RSET':
+                self.reply('250 ok')
+            elif verb == 'QUIT':
+                with server.lock:
+                    server.quits += 1
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+    def reply(self, *lines):
+        try:
+            self.wfile.write(''.join(f"{line}\r\n" for line in lines).encode('ascii'))
+        except OSError:
+            pass
+
+
+@pytest.fixture
+def smtp_server():
+    server = FakeSmtpServer().start()
+    yield server
+    server.stop()
+
+
+def make_sender(server, max_messages=0, ping_interval=30, max_size=2):
+    pool = SmtpConnectionPool(
+        lambda: SmtpSession('127.0.0.1', server.port, USERNAME, PASSWORD, starttls=False, timeout=5),
+        max_messages=max_messages,
+        min_size=0,
+        max_size=max_size,
+        idle_timeout=300,
+        wait_timeout=5,
+        ping_interval=ping_interval
+    )
+    return SmtpSender(pool)
+
+
+def make_message(index):
+    msg = EmailMessage()
+    msg['From'] = USERNAME
+    msg['To'] = f"user{index}@example.com"
+    msg['Subject'] = f"通知{index}"
+    msg.set_content(f"内容{index}")
+    return msg
+
+
+def test_batch_reuses_one_authenticated_session(smtp_server):
+    sender = make_sender(smtp_server)
+
+    sent, failures = sender.send_many([make_message(i) for i in range(10)])
+    # 之后的单封发送从连接池取回同一个连接
+    for i in range(10, 15):
+        sender.send(make_message(i))
+
+    assert (sent, failures) == (10, [])
+    assert len(smtp_server.messages) == 15
+    assert smtp_server.connections == 1
+    assert smtp_server.logins == 1
+    assert sender.stats()['connections'] == 1
+    sender.close()
+
+
+def test_dropped_connection_is_replaced(smtp_server):
+    sender = make_sender(smtp_server)
+    sender.send(make_message(0))
+
+    # 池中的空闲连接被服务端断开，取出时未到ping间隔，发送失败后重连并重试
+    smtp_server.drop_connections()
+    sender.send(make_message(1))
+
+    assert len(smtp_server.messages) == 2
+    assert smtp_server.connections == 2
+    assert smtp_server.logins == 2
+    assert sender.stats()['reconnects'] == 1
+    sender.close()
+
+
+def test_idle_connection_checked_with_noop(smtp_server):
+    sender = make_sender(smtp_server, ping_interval=0)
+    sender.send(make_message(0))
+    sender.send(make_message(1))
+
+    assert smtp_server.noops == 1
+    assert smtp_server.connections == 1
+
+    # NOOP失败的连接被丢弃，直接换新连接，不需要重试邮件
+    smtp_server.drop_connections()
+    sender.send(make_message(2))
+
+    assert len(smtp_server.messages) == 3
+    assert smtp_server.connections == 2
+    assert sender.stats()['reconnects'] == 0
+    sender.close()
+
+
+def test_connection_recycled_after_max_messages(smtp_server):
+    sender = make_sender(smtp_server, max_messages=3)
+
+    sent, failures = sender.send_many([make_message(i) for i in range(7)])
+
+    assert (sent, failures) == (7, [])
+    per_connection = {}
+    for connection, _ in smtp_server.messages:
+        per_connection[connection] = per_connection.get(connection, 0) + 1
+    assert sorted(per_connection.values()) == [1, 3, 3]
+    assert smtp_server.logins == 3
+    # 达到上限的连接正常QUIT
+    assert smtp_server.quits >= 2
+    sender.close()
+
+
+def test_service_closing_reply_reconnects():
+    server = FakeSmtpServer(messages_per_connection=2).start()
+    try:
+        sender = make_sender(server)
+        sent, failures = sender.send_many([make_message(i) for i in range(5)])
+
+        assert (sent, failures) == (5, [])
+        assert len(server.messages) == 5
+        assert server.connections == 3
+        assert sender.stats()['reconnects'] == 2
+        sender.close()
+    finally:
+        server.stop()
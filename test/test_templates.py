@@ -0,0 +1,69 @@
+# 通知模板测试
+
+import datetime
+
+import pytest
+
+from services.templates import TemplateError, TemplateRegistry, compile_choice, compile_text
+
+END_DATE = datetime.datetime(2026, 1, 31, 8, 30, 0)
+
+
+def test_fields_and_format_specs():
+    render = compile_text("{plan_name}到期: {end_date:%Y-%m-%d %H:%M:%S}，金额{amount:.2f}，{{保留}}")
+    row = {'plan_name': '月度VIP', 'end_date': END_DATE, 'amount': 9.5}
+    assert render(row) == "月度VIP到期: 2026-01-31 08:30:00，金额9.50，{保留}"
+
+
+def test_plain_text_template():
+    assert compile_text("没有字段{{}}")({}) == "没有字段{}"
+
+
+@pytest.mark.parametrize('text', ["{user.__class__}", "{items[0]}", "{amount:{width}}"])
+def test_unsafe_fields_rejected(text):
+    with pytest.raises(TemplateError):
+        compile_text(text)
+
+
+@pytest.mark.parametrize('auto_renew, expected', [
+    (True, "自动续费"),
+    (1, "自动续费"),
+    (False, "请续费"),
+    (0, "请续费"),
+    (None, "请续费"),
+])
+def test_boolean_choice_coerces_value(auto_renew, expected):
+    render = compile_choice('auto_renew', {True: "自动续费", False: "请续费"})
+    assert render({'auto_renew': auto_renew}) == expected
+
+
+def test_choice_default():
+    render = compile_choice('status', {'paid': "已支付", 'default': "未知状态{status}"})
+    assert render({'status': 'paid'}) == "已支付"
+    assert render({'status': 'refund'}) == "未知状态refund"
+
+
+def test_registry_renders_choices_and_falls_back_to_default_locale():
+    registry = TemplateRegistry({
+        'expiry': {
+            'zh_CN': {
+                'title': "订阅即将到期",
+                'content': "{plan_name}\n{renew_hint}",
+                'choices': {
+                    'renew_hint': {
+                        'field': 'auto_renew',
+                        'values': {True: "将自动续订。", False: "请及时续费以继续享受VIP服务。"},
+                    },
+                },
+            },
+        },
+    }, default_locale='zh_CN')
+
+    rows = [
+        {'plan_name': '月度VIP', 'auto_renew': None},
+        {'plan_name': '年度VIP', 'auto_renew': 1},
+    ]
+    assert registry.render_many('expiry', rows, locale='en') == [
+        ("订阅即将到期", "月度VIP\n请及时续费以继续享受VIP服务。"),
+        ("订阅即将到期", "年度VIP\n将自动续订。"),
+    ]
@@ -0,0 +1,88 @@
+# VIP权益内存索引测试
+
+import datetime
+import threading
+
+from database import vip_index as vip_index_module
+from database.vip_index import VipIndex
+
+
+def _future(days):
+    return datetime.datetime.now() + datetime.timedelta(days=days)
+
+
+def test_grant_during_load_survives_swap():
+    index = VipIndex()
+
+    def entries():
+        yield 1001, _future(5), 1
+        # 读取期间另一个线程提交了新的激活（加载读到的数据里没有这个用户）
+        index.grant(1002, _future(30), 2)
+        yield 1003, _future(5), 3
+
+    index.load(entries())
+    assert index.is_vip(1001)
+    assert index.is_vip(1002)
+    assert index.is_vip(1003)
+    assert index.telegram_id_for(2) == 1002
+
+
+def test_revoke_during_load_survives_swap():
+    index = VipIndex()
+
+    def entries():
+        yield 1001, _future(5), 1
+        # 读取到1001之后它被撤销
+        index.revoke(1001)
+
+    index.load(entries())
+    assert not index.is_vip(1001)
+
+
+def test_load_keeps_latest_expiry_per_user():
+    index = VipIndex()
+    later = _future(30)
+    index.load([(1001, _future(5), 1), (1001, later, 1), (1001, _future(1), 1)])
+    is_vip, expiry = index.lookup(1001)
+    assert is_vip
+    assert expiry == datetime.datetime.fromtimestamp(later.timestamp())
+
+
+def test_expired_entries_removed_without_query():
+    index = VipIndex()
+    index.load([(1001, _future(5), 1)])
+    index.grant(1002, datetime.datetime.now() - datetime.timedelta(seconds=1))
+    assert index.is_vip(1001)
+    assert not index.is_vip(1002)
+    # 永久VIP
+    index.grant(1003, None)
+    assert index.lookup(1003) == (True, None)
+
+
+def test_stale_index_reloads_once_in_background(monkeypatch):
+    monkeypatch.setattr(vip_index_module, 'VIP_INDEX_REFRESH_INTERVAL', 60)
+    index = VipIndex()
+    assert index.ensure_loaded(lambda: [(1001, _future(5), 1)])
+
+    started = threading.Event()
+    release = threading.Event()
+    loads = []
+
+    def slow_source():
+        loads.append(1)
+        started.set()
+        release.wait(5)
+        return [(1002, _future(5), 2)]
+
+    # 超过刷新间隔：请求线程不等待加载，多次检查只启动一个后台加载
+    index.loaded_at -= 120
+    for _ in range(5):
+        assert index.ensure_loaded(slow_source)
+        assert index.is_vip(1001)
+    assert started.wait(5)
+    release.set()
+    index._reload_thread.join(5)
+
+    assert loads == [1]
+    assert index.is_vip(1002)
+    assert not index.is_vip(1001)